@@ -0,0 +1,191 @@
+import math
+import threading
+import time
+import roslibpy
+from roslibpy.actionlib import GoalStatus
+
+class GoalHandle:
+    '''
+    One goal received by a ConcurrentActionServer. Handlers use it to send
+    feedback and the result of this particular goal.
+    '''
+
+    def __init__(self, server, message):
+        self.server = server
+        self.goal_id = message["goal_id"]
+        self.goal = message["goal"]
+        self.status = GoalStatus.ACTIVE
+        self.received = time.monotonic()
+
+    @property
+    def is_active(self):
+        return self.status == GoalStatus.ACTIVE
+
+    def cancel_requested(self):
+        '''
+        Indicates whether the client asked for this goal to be cancelled.
+        '''
+        return self.server._cancel_requested(self)
+
+    def on_cancel(self, callback):
+        '''
+        Registers a callable run, without arguments, when the client asks for
+        this goal to be cancelled. It runs right away if the client already
+        has, and is dropped once the goal finishes.
+        '''
+        self.server._add_cancel_callback(self, callback)
+
+    def send_feedback(self, feedback):
+        '''
+        :param feedback: dict of the feedback message
+        '''
+        if not self.is_active:
+            return
+        self.server.feedback_publisher.publish(roslibpy.Message({
+            "status": {"goal_id": self.goal_id, "status": GoalStatus.ACTIVE},
+            "feedback": feedback}))
+
+    def set_succeeded(self, result):
+        '''
+        :param result: dict of the result message
+        '''
+        self.server._finish(self, GoalStatus.SUCCEEDED, result)
+
+    def set_aborted(self, result):
+        self.server._finish(self, GoalStatus.ABORTED, result)
+
+    def set_preempted(self, result):
+        self.server._finish(self, GoalStatus.PREEMPTED, result)
+
+    def set_canceled(self, result):
+        '''
+        Ends the goal after a cancel request from the client. Goals are active
+        from the moment they arrive, so like actionlib this reports them as
+        preempted.
+        '''
+        self.server._finish(self, GoalStatus.PREEMPTED, result)
+
+
+class ConcurrentActionServer:
+    '''
+    Action server that keeps any number of goals active at once.
+
+    roslibpy's SimpleActionServer only tracks one goal: a new goal preempts
+    the current one, so goals are handled strictly one after another. This
+    server instead hands every goal to the callback as its own GoalHandle as
+    soon as it arrives, and publishes the status of all active goals. The
+    callback must not block; it is expected to queue the work (e.g. on a
+    CommandExecutor) and finish the goal through its handle later.
+
+    It uses the same topics as SimpleActionServer, so clients do not need to
+    change.
+    '''
+
+    STATUS_PUBLISH_INTERVAL = 0.5 # In seconds
+
+    def __init__(self, ros, server_name, action_name):
+        self.ros = ros
+        self.server_name = server_name
+        self.action_name = action_name
+        self._lock = threading.Lock()
+        self._goals = dict() # Map between goal ids and active GoalHandles
+        self._cancelled = set() # Ids of active goals asked to cancel
+        # Map between goal ids and callables to run when they are cancelled
+        self._cancel_callbacks = dict()
+        self._finished = [] # Statuses of goals finished since last publish
+        self._callback = None
+        # Optional callable invoked with (GoalHandle, status, result) when a
+        # goal finishes
+        self.on_finish = None
+
+        self.feedback_publisher = roslibpy.Topic(ros, server_name + '/feedback', action_name + 'Feedback')
+        self.status_publisher = roslibpy.Topic(ros, server_name + '/status', 'actionlib_msgs/GoalStatusArray')
+        self.result_publisher = roslibpy.Topic(ros, server_name + '/result', action_name + 'Result')
+        self.goal_listener = roslibpy.Topic(ros, server_name + '/goal', action_name + 'Goal')
+        self.cancel_listener = roslibpy.Topic(ros, server_name + '/cancel', 'actionlib_msgs/GoalID')
+
+        self.feedback_publisher.advertise()
+        self.status_publisher.advertise()
+        self.result_publisher.advertise()
+
+    def start(self, callback):
+        '''
+        Starts accepting goals.
+
+        :param callback: callable invoked with a GoalHandle for every new goal
+        '''
+        self._callback = callback
+        self.goal_listener.subscribe(self._on_goal_message)
+        self.cancel_listener.subscribe(self._on_cancel_message)
+        self.ros.call_later(self.STATUS_PUBLISH_INTERVAL, self._periodic_publish_status)
+
+    def active_goals(self):
+        with self._lock:
+            return list(self._goals.values())
+
+    def _on_goal_message(self, message):
+        handle = GoalHandle(self, message)
+        with self._lock:
+            self._goals[handle.goal_id["id"]] = handle
+        self._callback(handle)
+
+    def _on_cancel_message(self, message):
+        # An empty id with a zero stamp cancels every goal
+        with self._lock:
+            if message["id"] == "" and message["stamp"]["secs"] == 0:
+                ids = set(self._goals)
+            elif message["id"] in self._goals:
+                ids = {message["id"]}
+            else:
+                ids = set()
+            self._cancelled.update(ids)
+            callbacks = [c for i in ids for c in self._cancel_callbacks.pop(i, ())]
+        # Outside the lock, as callbacks may finish their goals
+        for callback in callbacks:
+            callback()
+
+    def _add_cancel_callback(self, handle, callback):
+        with self._lock:
+            cancelled = handle.goal_id["id"] in self._cancelled
+            if not cancelled and handle.is_active:
+                self._cancel_callbacks.setdefault(handle.goal_id["id"], []).append(callback)
+        if cancelled:
+            callback()
+
+    def _cancel_requested(self, handle):
+        with self._lock:
+            return handle.goal_id["id"] in self._cancelled
+
+    def _finish(self, handle, status, result):
+        with self._lock:
+            if not handle.is_active:
+                return
+            handle.status = status
+            self._goals.pop(handle.goal_id["id"], None)
+            self._cancelled.discard(handle.goal_id["id"])
+            self._cancel_callbacks.pop(handle.goal_id["id"], None)
+            goal_status = dict(goal_id=handle.goal_id, status=status)
+            self._finished.append(goal_status)
+        self.result_publisher.publish(roslibpy.Message({
+            "status": goal_status, "result": result}))
+        if self.on_finish:
+            self.on_finish(handle, status, result)
+
+    def _periodic_publish_status(self):
+        # Status publishing is required for clients to know they've connected.
+        # Skipped while disconnected, as roslibpy would queue every message
+        # until the reconnect.
+        if not self.ros.is_connected:
+            self.ros.call_later(self.STATUS_PUBLISH_INTERVAL, self._periodic_publish_status)
+            return
+        current_time = time.time()
+        secs = int(math.floor(current_time))
+        nsecs = int(round(1e9 * (current_time - secs)))
+        with self._lock:
+            status_list = [dict(goal_id=h.goal_id, status=h.status)
+                    for h in self._goals.values()] + self._finished
+            self._finished = []
+        self.status_publisher.publish(roslibpy.Message({
+            "header": {"stamp": {"secs": secs, "nsecs": nsecs}, "frame_id": ""},
+            "status_list": status_list}))
+        self.ros.call_later(self.STATUS_PUBLISH_INTERVAL, self._periodic_publish_status)
@@ -0,0 +1,124 @@
+'''
+Measures message size and encode/decode time of the high-volume payloads
+(fleet state, mission upload, topic listing) in their dict form and their
+packed form, as JSON and, if the optional cbor2 package is installed, as
+CBOR. "cbor typed" encodes float arrays as RFC 8746 typed arrays, the way
+rosbridge's cbor compression sends them.
+
+Usage: python3 src/benchmark/bench_encoding.py [--drones 50] [--waypoints 5000] [--topics 2000]
+'''
+
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import waypoints as waypoint_arrays
+from fleet_state import FleetStatePublisher
+from topic_index import pack_topics
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+# RFC 8746 tag of a little-endian float64 array
+CBOR_FLOAT64_LE = 86
+
+
+def navsatfix(lat, lon, alt):
+    return {"header": {"seq": 885, "stamp": {"secs": 1552399290, "nsecs": 267234086}, "frame_id": "/wgs84"},
+            "status": {"status": 0, "service": 1}, "latitude": lat, "longitude": lon,
+            "altitude": alt, "position_covariance": [0] * 9, "position_covariance_type": 0}
+
+
+def fleet_state(count, rng):
+    lat = (-35.36 + rng.random(count) * 0.01).tolist()
+    lon = (149.16 + rng.random(count) * 0.01).tolist()
+    alt = (rng.random(count) * 50).tolist()
+    drones = [{"id": i + 1, "changed": 3, "latitude": lat[i], "longitude": lon[i],
+               "altitude": alt[i], "flight_status": 3} for i in range(count)]
+    message = {"seq": 1, "stamp": 1552399290.5, "keyframe": True, "drones": drones, "removed": []}
+    return message, FleetStatePublisher.pack(message)
+
+
+def mission(count, rng):
+    lat = (-35.36 + rng.random(count) * 0.01).tolist()
+    lon = (149.16 + rng.random(count) * 0.01).tolist()
+    alt = (rng.random(count) * 50).tolist()
+    dicts = {"id": 1, "waypoints": [navsatfix(*wp) for wp in zip(lat, lon, alt)]}
+    packed = {"id": 1, "packed_waypoints": waypoint_arrays.to_packed(
+            waypoint_arrays.to_array(dicts["waypoints"]))}
+    return dicts, packed
+
+
+def topic_listing(count):
+    types = ["sensor_msgs/NavSatFix", "mavros_msgs/State", "sensor_msgs/Image",
+             "geometry_msgs/PoseStamped", "std_msgs/Float64"]
+    topics = [{"name": f"/drone_{i // 20}/topic_{i % 20}", "type": types[i % len(types)]}
+              for i in range(count)]
+    names, type_names, type_indices = pack_topics(topics)
+    return ({"topics": topics, "success": True},
+            {"names": names, "types": type_names, "type_indices": type_indices, "success": True})
+
+
+def typed(value):
+    # Replaces float lists by typed arrays, recursively
+    if isinstance(value, dict):
+        return {k: typed(v) for k, v in value.items()}
+    if isinstance(value, list) and value and all(isinstance(v, float) for v in value):
+        return cbor2.CBORTag(CBOR_FLOAT64_LE, np.asarray(value, dtype='<f8').tobytes())
+    if isinstance(value, list):
+        return [typed(v) for v in value]
+    return value
+
+
+def decode_typed(*args):
+    # cbor2 5 calls tag hooks with (decoder, tag), cbor2 6 with (tag, immutable)
+    tag = next(a for a in args if isinstance(a, cbor2.CBORTag))
+    if tag.tag == CBOR_FLOAT64_LE:
+        return np.frombuffer(tag.value, dtype='<f8')
+    return tag
+
+
+def codecs():
+    yield "json", lambda m: json.dumps(m).encode(), lambda b: json.loads(b)
+    if cbor2:
+        yield "cbor", cbor2.dumps, cbor2.loads
+        yield "cbor typed", lambda m: cbor2.dumps(typed(m)), \
+                lambda b: cbor2.loads(b, tag_hook=decode_typed)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--drones', type=int, default=50)
+    parser.add_argument('--waypoints', type=int, default=5000)
+    parser.add_argument('--topics', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    payloads = [
+        (f"fleet_state ({args.drones} drones)", fleet_state(args.drones, rng)),
+        (f"upload_mission ({args.waypoints} waypoints)", mission(args.waypoints, rng)),
+        (f"filter_topics ({args.topics} topics)", topic_listing(args.topics)),
+    ]
+    if not cbor2:
+        print("cbor2 is not installed; only measuring JSON")
+    print(f"{'payload':<34} {'form':<7} {'encoding':<11} {'bytes':>10} {'encode ms':>10} {'decode ms':>10}")
+    for name, forms in payloads:
+        for form, message in zip(("dicts", "packed"), forms):
+            for codec, encode, decode in codecs():
+                data = encode(message)
+                encode_time = min(timeit.repeat(lambda: encode(message), number=1, repeat=args.repeat))
+                decode_time = min(timeit.repeat(lambda: decode(data), number=1, repeat=args.repeat))
+                print(f"{name:<34} {form:<7} {codec:<11} {len(data):>10} "
+                      f"{encode_time * 1000:>10.2f} {decode_time * 1000:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
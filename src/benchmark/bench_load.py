@@ -0,0 +1,449 @@
+'''
+Load test of the whole server. Starts a local rosbridge stand-in
+(local_rosbridge.py), the operator and a fleet of simulated drones
+(dji_sim.py), then drives a mix of service calls and action goals from many
+concurrent clients and reports the throughput and latency percentiles of
+each operation, as seen by the clients and as recorded by the server.
+
+Every client has its own rosbridge connection and makes one call after
+another for --duration seconds. Clients are spread over --processes worker
+processes, so that the clients' own event loops do not limit the load.
+Write the results with --json and compare a later run against them with
+--baseline to track regressions across commits.
+
+Usage: python3 src/benchmark/bench_load.py [--drones 20] [--clients 16]
+    [--processes 2] [--duration 20] [--latency 20]
+    [--mix query_topics=4,all_drones_available=4,register_drone=1,save_drone_topics=1,control_drone=2]
+    [--operator-args "--command-workers 16"] [--json results.json] [--baseline results.json]
+'''
+
+import argparse
+import json
+import os
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(SRC)
+
+import roslibpy
+import roslibpy.actionlib
+
+HOST = '127.0.0.1'
+PORT = 9090 # The operator always connects to rosbridge on this port
+CALL_TIMEOUT = 30 # Seconds a call may take before it counts as timed out
+PERCENTILES = (50, 95, 99)
+
+# Runs a script of src. src/operator.py has the name of a standard library
+# module, so src goes at the end of sys.path instead of in front of it, where
+# running the script directly would put it.
+BOOTSTRAP = ('import runpy, sys; sys.path.append({src!r}); sys.argv.pop(0); '
+             'runpy.run_path(sys.argv[0], run_name="__main__")')
+
+DEFAULT_MIX = 'query_topics=4,all_drones_available=4,register_drone=1,save_drone_topics=1,control_drone=2'
+
+# Operations the clients can make, with the kind of endpoint of the server
+# they call: service or action
+OPERATIONS = {
+    'register_drone': 'service',
+    'save_drone_topics': 'service',
+    'query_topics': 'service',
+    'all_drones_available': 'service',
+    'drones_changed_since': 'service',
+    'control_drone': 'action',
+    'get_speed': 'action',
+}
+
+
+class Client:
+    '''
+    One simulated VR client with its own rosbridge connection.
+    '''
+
+    # Connections are opened one at a time: the first one starts the event
+    # loop shared by every connection of the process
+    connect_lock = threading.Lock()
+
+    def __init__(self, name, drone_ids, tasks, rng):
+        self.name = name
+        self.drone_ids = drone_ids
+        self.tasks = tasks
+        self.rng = rng
+        with Client.connect_lock:
+            self.ros = roslibpy.Ros(host=HOST, port=PORT)
+            self.ros.run()
+        self.services = dict()
+        self.action_clients = dict()
+        self.registered = [] # Ids of the drones this client registered
+        self.version = 0 # Fleet version of the last drones_changed_since
+
+    def service(self, name, service_type):
+        service = self.services.get(name)
+        if service is None:
+            service = self.services[name] = roslibpy.Service(self.ros, f'isaacs_server/{name}', service_type)
+        return service
+
+    def call(self, name, service_type, request):
+        return self.service(name, service_type).call(roslibpy.ServiceRequest(request), timeout=CALL_TIMEOUT)
+
+    def send_goal(self, name, action_type, goal):
+        action_client = self.action_clients.get(name)
+        if action_client is None:
+            action_client = self.action_clients[name] = roslibpy.actionlib.ActionClient(
+                    self.ros, f'isaacs_server/{name}', action_type)
+        goal = roslibpy.actionlib.Goal(action_client, roslibpy.Message(goal))
+        # Goal.wait() also waits for a status message marking the goal done,
+        # which the server only publishes every STATUS_PUBLISH_INTERVAL, so
+        # the goal is timed to its result message instead
+        received = threading.Event()
+        goal.send(lambda result: received.set())
+        try:
+            if not received.wait(CALL_TIMEOUT):
+                raise roslibpy.core.RosTimeoutError("Goal failed to receive result")
+            return goal.result
+        finally:
+            action_client.goals.pop(goal.goal_id, None)
+
+    # Each operation makes one call and returns its response or result
+
+    def register_drone(self):
+        response = self.call('register_drone', 'isaacs_server/RegisterDrone',
+                {"drone_name": f"{self.name}_{len(self.registered)}_{self.rng.getrandbits(32):x}",
+                 "drone_type": "DjiMatrice"})
+        if response["success"]:
+            self.registered.append(response["id"])
+        return response
+
+    def save_drone_topics(self):
+        # Topics of a drone this client registered, so the simulated fleet
+        # keeps its own topics
+        drone_id = self.registered[-1] if self.registered else self.rng.choice(self.drone_ids)
+        publishes = [{"name": f"/drone_{drone_id}/bench/topic_{i}", "type": "std_msgs/String"}
+                     for i in range(self.rng.randint(1, 8))]
+        return self.call('save_drone_topics', 'isaacs_server/TypeToTopic',
+                {"id": drone_id, "publishes": publishes})
+
+    def query_topics(self):
+        # Occasionally every topic, which is the expensive query
+        drone_id = 0 if self.rng.random() < 0.1 else self.rng.choice(self.drone_ids)
+        return self.call('query_topics', 'isaacs_server/QueryTopics', {"id": drone_id})
+
+    def all_drones_available(self):
+        return self.call('all_drones_available', 'isaacs_server/AllDronesAvailable', {})
+
+    def drones_changed_since(self):
+        response = self.call('drones_changed_since', 'isaacs_server/DronesChangedSince',
+                {"version": self.version})
+        self.version = response.get("version", self.version)
+        return response
+
+    def control_drone(self):
+        return self.send_goal('control_drone', 'isaacs_server/ControlDroneAction',
+                {"id": self.rng.choice(self.drone_ids), "control_task": self.rng.choice(self.tasks)})
+
+    def get_speed(self):
+        return self.send_goal('get_speed', 'isaacs_server/GetSpeedAction',
+                {"id": self.rng.choice(self.drone_ids)})
+
+
+def parse_mix(mix):
+    '''
+    :param mix: comma separated operation=weight pairs
+    returns: dict of {operation: weight}
+    '''
+    weights = dict()
+    for item in mix.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise SystemExit(f"Unknown operation {name}, expected one of {', '.join(OPERATIONS)}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def percentile(samples, q):
+    # samples must be sorted
+    return samples[min(len(samples) - 1, len(samples) * q // 100)] if samples else 0.0
+
+
+def run_worker(args):
+    # Runs this process's clients and prints their calls as JSON
+    weights = parse_mix(args.mix)
+    names = list(weights)
+    drone_ids = [int(i) for i in args.drone_ids.split(',')]
+    tasks = args.tasks.split(',')
+    results = {name: {"latencies": [], "failed": 0, "errors": 0, "timeouts": 0} for name in names}
+    lock = threading.Lock()
+    start_barrier = threading.Barrier(args.clients)
+    warmup_end = time.monotonic() + 3600 # Set once every client is connected
+
+    def client_loop(index):
+        nonlocal warmup_end
+        rng = random.Random(args.seed * 1000003 + args.worker * 1009 + index)
+        client = Client(f"bench_{args.worker}_{index}", drone_ids, tasks, rng)
+        if start_barrier.wait() == 0:
+            warmup_end = time.monotonic() + args.warmup
+        start_barrier.wait()
+        end = warmup_end + args.duration
+        while True:
+            name = rng.choices(names, weights=[weights[n] for n in names])[0]
+            start = time.perf_counter()
+            outcome = None
+            try:
+                response = getattr(client, name)()
+                if not response.get("success", True):
+                    outcome = "failed"
+            except roslibpy.core.RosTimeoutError:
+                outcome = "timeouts"
+            except Exception:
+                outcome = "errors"
+            now = time.monotonic()
+            if now >= end:
+                break
+            if now < warmup_end:
+                continue
+            elapsed = time.perf_counter() - start
+            with lock:
+                result = results[name]
+                if outcome != "timeouts":
+                    result["latencies"].append(elapsed * 1000)
+                if outcome:
+                    result[outcome] += 1
+        # terminate() would stop the event loop of the other clients too
+        client.ros.close()
+
+    threads = [threading.Thread(target=client_loop, args=(i,), daemon=True) for i in range(args.clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    json.dump(results, sys.stdout)
+
+
+def wait_for_port(timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with socket.socket() as s:
+            if s.connect_ex((HOST, PORT)) == 0:
+                return
+        time.sleep(0.1)
+    raise SystemExit(f"Nothing is listening on {HOST}:{PORT}")
+
+
+def wait_for_line(path, prefix, process, timeout):
+    # Waits until a line starting with prefix appears in a process's log
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"{os.path.basename(process.args[3])} exited, see {path}")
+        with open(path) as log:
+            for line in log:
+                if line.startswith(prefix):
+                    return line
+        time.sleep(0.2)
+    raise SystemExit(f"Timed out waiting for {os.path.basename(process.args[3])}, see {path}")
+
+
+def wait_for_operator(ros, process, log, timeout):
+    service = roslibpy.Service(ros, 'isaacs_server/all_drones_available', 'isaacs_server/AllDronesAvailable')
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit(f"The operator exited, see {log}")
+        try:
+            if service.call(roslibpy.ServiceRequest({}), timeout=2)["success"]:
+                return
+        except Exception:
+            time.sleep(0.2)
+    raise SystemExit(f"Timed out waiting for the operator, see {log}")
+
+
+def start(command, log_dir, name):
+    # command is the script, relative to src, and its arguments
+    path = os.path.join(log_dir, f'{name}.log')
+    log = open(path, 'w')
+    process = subprocess.Popen([sys.executable, '-c', BOOTSTRAP.format(src=SRC),
+            os.path.join(SRC, command[0])] + command[1:], cwd=log_dir, stdout=log,
+            stderr=subprocess.STDOUT)
+    log.close()
+    return process, path
+
+
+def server_metrics(ros):
+    # Latencies the server recorded for its endpoints and drone calls
+    service = roslibpy.Service(ros, 'isaacs_server/metrics', 'isaacs_server/Metrics')
+    try:
+        return service.call(roslibpy.ServiceRequest({"prometheus": False}), timeout=10)
+    except Exception as e:
+        print(f"Could not read the server's metrics: {e}")
+        return {"endpoints": [], "gauge_names": [], "gauge_values": []}
+
+
+def summarize(results, seconds):
+    summary = dict()
+    for name, result in results.items():
+        latencies = sorted(result["latencies"])
+        summary[name] = {"calls": len(latencies) + result["timeouts"],
+                "throughput": len(latencies) / seconds,
+                "failed": result["failed"], "errors": result["errors"], "timeouts": result["timeouts"],
+                **{f"p{q}": percentile(latencies, q) for q in PERCENTILES},
+                "max": latencies[-1] if latencies else 0.0}
+    return summary
+
+
+def report(summary, endpoints, baseline):
+    server = {(e["kind"], e["name"]): e for e in endpoints}
+    print(f"{'operation':>22} {'calls':>7} {'per s':>8} {'failed':>7} {'errors':>7} {'timeouts':>8} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8} {'server p50':>11} {'server p99':>11}")
+    for name, s in sorted(summary.items()):
+        e = server.get((OPERATIONS[name], name))
+        server_p50 = f"{e['p50'] * 1000:11.1f}" if e else f"{'-':>11}"
+        server_p99 = f"{e['p99'] * 1000:11.1f}" if e else f"{'-':>11}"
+        print(f"{name:>22} {s['calls']:7d} {s['throughput']:8.1f} {s['failed']:7d} {s['errors']:7d} "
+              f"{s['timeouts']:8d} {s['p50']:8.1f} {s['p95']:8.1f} {s['p99']:8.1f} {s['max']:8.1f} "
+              f"{server_p50} {server_p99}")
+    total = sum(s['throughput'] for s in summary.values())
+    print(f"{'total':>22} {sum(s['calls'] for s in summary.values()):7d} {total:8.1f}")
+    drone_calls = [e for e in endpoints if e["metric"] == "drone_call_seconds"]
+    if drone_calls:
+        print(f"\n{'drone service':>40} {'calls':>7} {'p50 ms':>8} {'p99 ms':>8}")
+        for e in drone_calls:
+            print(f"{e['kind'] + ' ' + e['name']:>40} {e['calls']:7d} {e['p50'] * 1000:8.1f} {e['p99'] * 1000:8.1f}")
+    if baseline:
+        print(f"\nChange from baseline {baseline.get('commit', '')[:12]}")
+        print(f"{'operation':>22} {'per s':>8} {'p50':>8} {'p99':>8}")
+        for name, s in sorted(summary.items()):
+            before = baseline["operations"].get(name)
+            if not before:
+                continue
+            changes = [_change(s[key], before[key]) for key in ('throughput', 'p50', 'p99')]
+            print(f"{name:>22} " + ' '.join(f"{c:>8}" for c in changes))
+
+
+def _change(now, before):
+    return f"{100 * (now - before) / before:+.0f}%" if before else "-"
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=SRC, capture_output=True,
+                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--drones', type=int, default=20, help='Simulated drones')
+    parser.add_argument('--clients', type=int, default=16, help='Concurrent clients in all')
+    parser.add_argument('--processes', type=int, default=2, help='Worker processes the clients are spread over')
+    parser.add_argument('--duration', type=float, default=20, help='Seconds measured')
+    parser.add_argument('--warmup', type=float, default=3, help='Seconds of load before measuring')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+            help=f'Weights of the operations; any of {", ".join(OPERATIONS)}')
+    parser.add_argument('--tasks', default='land_drone,pause_mission,resume_mission',
+            help='Control tasks of the control_drone goals')
+    parser.add_argument('--latency', type=float, default=20, help='Milliseconds the drones take to answer')
+    parser.add_argument('--telemetry-rate', type=float, default=1,
+            help='Position and status messages per second of each drone')
+    parser.add_argument('--operator-args', default='', help='Extra arguments of the operator')
+    parser.add_argument('--external-bridge', action='store_true',
+            help=f'Use the rosbridge already running on {HOST}:{PORT} instead of the stand-in')
+    parser.add_argument('--log-dir', help='Directory for the logs of the started processes')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='File to write the results to')
+    parser.add_argument('--baseline', help='Results of an earlier run to compare with')
+    # Set on the worker processes started by the benchmark
+    parser.add_argument('--worker', type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--drone-ids', default='', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker is not None:
+        run_worker(args)
+        return
+
+    parse_mix(args.mix)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    log_dir = args.log_dir or tempfile.mkdtemp(prefix='bench_load_')
+    os.makedirs(log_dir, exist_ok=True)
+    processes = []
+    try:
+        if not args.external_bridge:
+            with socket.socket() as s:
+                if s.connect_ex((HOST, PORT)) == 0:
+                    raise SystemExit(f"{HOST}:{PORT} is in use; stop it or pass --external-bridge")
+            bridge, _ = start(['benchmark/local_rosbridge.py', '--host', HOST, '--port', str(PORT)],
+                    log_dir, 'rosbridge')
+            processes.append(bridge)
+        wait_for_port(10)
+        ros = roslibpy.Ros(host=HOST, port=PORT)
+        ros.run()
+
+        operator, operator_log = start(['operator.py', '--ip', HOST, '--log-level', 'WARNING']
+                + shlex.split(args.operator_args), log_dir, 'operator')
+        processes.append(operator)
+        wait_for_operator(ros, operator, operator_log, 30)
+
+        sim, sim_log = start(['dji_sim.py', '--ip', HOST, '--drones', str(args.drones), '--latency',
+                str(args.latency), '--telemetry-rate', str(args.telemetry_rate), '--quiet',
+                '--name', f'sim_{os.getpid()}'], log_dir, 'dji_sim')
+        processes.append(sim)
+        drone_ids = wait_for_line(sim_log, 'Registered', sim, 60).split(':')[1].split()
+
+        print(f"{args.drones} drones answering in {args.latency:g} ms, {args.clients} clients in "
+              f"{args.processes} processes, {args.duration:g} s after {args.warmup:g} s warmup, "
+              f"logs in {log_dir}")
+        workers = []
+        for worker in range(args.processes):
+            clients = args.clients // args.processes + (worker < args.clients % args.processes)
+            if clients == 0:
+                continue
+            command = [sys.executable, os.path.abspath(__file__), '--worker', str(worker),
+                    '--clients', str(clients), '--duration', str(args.duration),
+                    '--warmup', str(args.warmup), '--mix', args.mix, '--tasks', args.tasks,
+                    '--seed', str(args.seed), '--drone-ids', ','.join(drone_ids)]
+            workers.append(subprocess.Popen(command, stdout=subprocess.PIPE))
+        results = {name: {"latencies": [], "failed": 0, "errors": 0, "timeouts": 0}
+                   for name in parse_mix(args.mix)}
+        for worker in workers:
+            output, _ = worker.communicate()
+            if worker.returncode != 0:
+                raise SystemExit("A worker process failed")
+            for name, result in json.loads(output).items():
+                results[name]["latencies"] += result["latencies"]
+                for key in ("failed", "errors", "timeouts"):
+                    results[name][key] += result[key]
+
+        summary = summarize(results, args.duration)
+        metrics = server_metrics(ros)
+        report(summary, metrics["endpoints"], baseline)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({"commit": git_commit(), "time": time.strftime('%Y-%m-%dT%H:%M:%S'),
+                        "config": {k: v for k, v in vars(args).items()
+                                   if k not in ('worker', 'drone_ids', 'json', 'baseline', 'log_dir')},
+                        "operations": summary, "server": metrics["endpoints"],
+                        "gauges": dict(zip(metrics["gauge_names"], metrics["gauge_values"]))},
+                        f, indent=1)
+        ros.terminate()
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+if __name__ == '__main__':
+    main()
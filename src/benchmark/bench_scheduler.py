@@ -0,0 +1,65 @@
+'''
+Measures how long a land command waits to start while the command executor
+is loaded with mission uploads, with land queued like any other command
+(the behaviour before priorities) and as an EMERGENCY command.
+
+Usage: python3 src/benchmark/bench_scheduler.py [--drones 20] [--workers 8]
+    [--uploads 3] [--upload-time 0.2]
+'''
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from command_executor import CommandExecutor, Priority
+
+
+def run(args, priority):
+    executor = CommandExecutor(args.workers)
+    for drone_id in range(args.drones):
+        for _ in range(args.uploads):
+            executor.submit(drone_id, lambda: time.sleep(args.upload_time),
+                    priority=Priority.BULK)
+    # Let the workers pick up the first uploads
+    time.sleep(args.upload_time / 4)
+    latencies = []
+    lock = threading.Lock()
+    futures = []
+    for drone_id in range(args.drones):
+        submitted = time.monotonic()
+        def started(submitted=submitted):
+            with lock:
+                latencies.append(time.monotonic() - submitted)
+        futures.append(executor.submit(drone_id, lambda: None, on_start=started,
+                priority=priority, name="land_drone"))
+    for future in futures:
+        future.result()
+    executor.shutdown()
+    latencies.sort()
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--drones', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--uploads', type=int, default=3, help='Uploads queued per drone')
+    parser.add_argument('--upload-time', type=float, default=0.2, help='Seconds per upload')
+    args = parser.parse_args()
+
+    print(f"{args.drones} drones, {args.workers} workers, {args.uploads} uploads of "
+          f"{args.upload_time * 1000:.0f} ms queued per drone")
+    print(f"{'land queued as':>16} {'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for priority in (Priority.NORMAL, Priority.EMERGENCY):
+        latencies = run(args, priority)
+        p50 = latencies[len(latencies) // 2]
+        p99 = latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)]
+        print(f"{priority.name:>16} {p50 * 1000:9.1f} {p99 * 1000:9.1f} {latencies[-1] * 1000:9.1f}")
+
+
+if __name__ == '__main__':
+    main()
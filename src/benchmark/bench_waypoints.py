@@ -0,0 +1,87 @@
+'''
+Compares the batched waypoint conversion in waypoints.py with the per-waypoint
+loops the drivers used before.
+
+Usage: python3 src/benchmark/bench_waypoints.py [--counts 100 1000 10000] [--repeat 5]
+'''
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import waypoints as waypoint_arrays
+from djimatrice_drone import DjiMatriceDrone
+from mavros_drone import MavrosDrone
+
+
+def make_mission(count):
+    rng = np.random.default_rng(0)
+    lat = -35.36 + rng.random(count) * 0.01
+    lon = 149.16 + rng.random(count) * 0.01
+    alt = rng.random(count) * 50
+    return [{"latitude": a, "longitude": b, "altitude": c}
+            for a, b, c in zip(lat.tolist(), lon.tolist(), alt.tolist())]
+
+
+def mavros_loop(drone, mission):
+    return [drone.convert_navsatfix_mavroswaypoint(wp) for wp in mission]
+
+
+def dji_loop(mission):
+    # The conversion DjiMatriceDrone.create_waypoint_task did per waypoint
+    waypoints = []
+    for wp in mission:
+        command_list = []
+        command_params = []
+        for i in range(16):
+            command_list.append(0)
+            command_params.append(0)
+        action = {"action_repeat": 0, "command_list": command_list, "command_parameter": command_params}
+        waypoints.append({"latitude": wp["latitude"], "longitude": wp["longitude"],
+                          "altitude": wp["altitude"], "damping_distance": 3,
+                          "target_yaw": 0, "target_gimbal_pitch": 0, "turn_mode": 0,
+                          "has_action": 0, "action_time_limit": 30,
+                          "waypoint_action": action})
+    return waypoints
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--counts', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    mavros = MavrosDrone("bench_mavros", "Mavros", None, 0)
+    dji = DjiMatriceDrone("bench_dji", "DjiMatrice", None, 0)
+
+    # What the drivers' upload_mission does before calling the drone
+    def batched_mavros(mission):
+        columns = waypoint_arrays.columns(mission)
+        waypoint_arrays.invalid_indices(columns)
+        return mavros.convert_waypoints(columns)
+
+    def batched_dji(mission):
+        columns = waypoint_arrays.columns(mission)
+        waypoint_arrays.invalid_indices(columns)
+        return dji.create_waypoint_task(columns)
+
+    # "list" starts from NavSatFix dicts and "array" from a mission that is
+    # already packed; both include validating every waypoint, which the
+    # loops did not do
+    print(f"{'waypoints':>10} {'driver':>8} {'loop ms':>10} {'list ms':>10} {'array ms':>10}")
+    for count in args.counts:
+        mission = make_mission(count)
+        array = waypoint_arrays.to_array(mission)
+        for name, loop, batched in (
+                ("mavros", lambda: mavros_loop(mavros, mission), batched_mavros),
+                ("dji", lambda: dji_loop(mission), batched_dji)):
+            times = [min(timeit.repeat(f, number=1, repeat=args.repeat)) * 1000
+                     for f in (loop, lambda: batched(mission), lambda: batched(array))]
+            print(f"{count:>10} {name:>8} {times[0]:>10.2f} {times[1]:>10.2f} {times[2]:>10.2f}")
+
+if __name__ == '__main__':
+    main()
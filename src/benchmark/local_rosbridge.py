@@ -0,0 +1,185 @@
+'''
+Stand-in for rosbridge_server, for running the server and its benchmarks on
+a machine without ROS.
+
+It speaks the part of the rosbridge v2 protocol that roslibpy uses: clients
+advertise services and topics, call services and publish and subscribe to
+topics, and it relays the messages between them over websockets. Nothing
+goes through ROS: message types are not checked and there are no rosapi
+services. It runs on a single thread, so under heavy load it adds latency
+of its own, the way a busy rosbridge does.
+
+Usage: python3 src/benchmark/local_rosbridge.py [--port 9090]
+'''
+
+import argparse
+import json
+import sys
+
+from autobahn.twisted.websocket import WebSocketServerFactory, WebSocketServerProtocol
+from twisted.internet import reactor
+
+
+def normalize(name):
+    # rosbridge resolves names against the root namespace, so "a/b" and
+    # "/a/b" are the same service or topic
+    return name if name.startswith('/') else '/' + name
+
+
+class Subscription:
+
+    def __init__(self, client, topic, throttle_rate):
+        self.client = client
+        self.topic = topic # Name as subscribed, which roslibpy dispatches on
+        self.interval = throttle_rate / 1000 # Seconds between messages
+        self.last = None # Time the last message was sent
+
+
+class Bridge:
+    '''
+    Routes service calls to the clients advertising the services, and
+    published messages to the clients subscribed to the topics.
+    '''
+
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        # Map between service names and (client, name as advertised)
+        self.services = dict()
+        # Map between topic names and their Subscriptions
+        self.subscriptions = dict()
+        # Map between relayed call ids and (caller, call id of the caller,
+        # service, advertiser)
+        self.pending = dict()
+        self.next_call = 0
+        self.calls = 0
+        self.messages = 0
+
+    def handle(self, client, message):
+        operation = message.get("op")
+        handler = getattr(self, f"_{operation}", None)
+        if handler is None:
+            if self.verbose:
+                print(f"Ignoring {operation} from {client.peer}")
+            return
+        handler(client, message)
+
+    def disconnected(self, client):
+        for name, (advertiser, _) in list(self.services.items()):
+            if advertiser is client:
+                del self.services[name]
+        for name, subscriptions in list(self.subscriptions.items()):
+            subscriptions[:] = [s for s in subscriptions if s.client is not client]
+            if not subscriptions:
+                del self.subscriptions[name]
+        # Calls the client was answering fail; calls it made are dropped
+        for call_id, (caller, caller_id, service, advertiser) in list(self.pending.items()):
+            if caller is client:
+                del self.pending[call_id]
+            elif advertiser is client:
+                del self.pending[call_id]
+                self._fail(caller, caller_id, service, f"Service {service} is no longer advertised")
+
+    def _advertise_service(self, client, message):
+        self.services[normalize(message["service"])] = (client, message["service"])
+        if self.verbose:
+            print(f"{client.peer} advertised {message['service']}")
+
+    def _unadvertise_service(self, client, message):
+        name = normalize(message["service"])
+        if self.services.get(name, (None,))[0] is client:
+            del self.services[name]
+
+    def _call_service(self, client, message):
+        service = message["service"]
+        advertised = self.services.get(normalize(service))
+        if advertised is None:
+            self._fail(client, message.get("id"), service, f"Service {service} does not exist")
+            return
+        advertiser, advertised_name = advertised
+        self.next_call += 1
+        call_id = f"bridge:{self.next_call}"
+        self.pending[call_id] = (client, message.get("id"), service, advertiser)
+        self.calls += 1
+        advertiser.send({"op": "call_service", "id": call_id, "service": advertised_name,
+                "args": message.get("args", {})})
+
+    def _service_response(self, client, message):
+        pending = self.pending.pop(message.get("id"), None)
+        if pending is None:
+            return
+        caller, caller_id, service, _ = pending
+        response = {"op": "service_response", "service": service,
+                "values": message.get("values", {}), "result": message.get("result", True)}
+        if caller_id is not None:
+            response["id"] = caller_id
+        caller.send(response)
+
+    def _fail(self, client, call_id, service, error):
+        response = {"op": "service_response", "service": service, "values": error, "result": False}
+        if call_id is not None:
+            response["id"] = call_id
+        client.send(response)
+
+    def _advertise(self, client, message):
+        pass
+
+    def _unadvertise(self, client, message):
+        pass
+
+    def _subscribe(self, client, message):
+        name = normalize(message["topic"])
+        subscriptions = self.subscriptions.setdefault(name, [])
+        if not any(s.client is client for s in subscriptions):
+            subscriptions.append(Subscription(client, message["topic"],
+                    message.get("throttle_rate", 0)))
+
+    def _unsubscribe(self, client, message):
+        name = normalize(message["topic"])
+        subscriptions = self.subscriptions.get(name, [])
+        subscriptions[:] = [s for s in subscriptions if s.client is not client]
+
+    def _publish(self, client, message):
+        now = reactor.seconds()
+        for subscription in self.subscriptions.get(normalize(message["topic"]), ()):
+            if subscription.last is not None and now - subscription.last < subscription.interval:
+                continue
+            subscription.last = now
+            self.messages += 1
+            subscription.client.send({"op": "publish", "topic": subscription.topic,
+                    "msg": message.get("msg", {})})
+
+
+class BridgeProtocol(WebSocketServerProtocol):
+
+    def onOpen(self):
+        if self.factory.bridge.verbose:
+            print(f"{self.peer} connected")
+
+    def onMessage(self, payload, is_binary):
+        self.factory.bridge.handle(self, json.loads(payload.decode('utf8')))
+
+    def onClose(self, was_clean, code, reason):
+        self.factory.bridge.disconnected(self)
+
+    def send(self, message):
+        self.sendMessage(json.dumps(message).encode('utf8'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9090)
+    parser.add_argument('--verbose', action='store_true', help='Print advertisements and connections')
+    args = parser.parse_args()
+
+    factory = WebSocketServerFactory(f"ws://{args.host}:{args.port}")
+    factory.protocol = BridgeProtocol
+    factory.bridge = Bridge(args.verbose)
+    reactor.listenTCP(args.port, factory, interface=args.host)
+    print(f"Relaying rosbridge messages on ws://{args.host}:{args.port}")
+    sys.stdout.flush()
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
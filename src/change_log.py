@@ -0,0 +1,45 @@
+from collections import deque
+
+class ChangeLog:
+    '''
+    Bounded record of which keys changed at which version.
+
+    Every call to record() increments the version. changed_since() tells a
+    client that last saw version N which keys have changed after it, so only
+    those have to be sent. Once a client falls further behind than the log
+    reaches back, changed_since() returns None and the client has to be sent
+    everything again.
+    '''
+
+    def __init__(self, max_length=4096):
+        self.version = 0
+        self._changes = deque(maxlen=max_length) # (version, key) pairs
+
+    def record(self, key):
+        '''
+        Records a change of key and returns the new version.
+        '''
+        self.version += 1
+        self._changes.append((self.version, key))
+        return self.version
+
+    def changed_since(self, since_version):
+        '''
+        :param since_version: last version the client has seen
+        returns: set of keys changed after since_version, or None if the log
+        no longer reaches back that far (or the version is from the future,
+        e.g. from before a server restart).
+        '''
+        if since_version > self.version:
+            return None
+        if since_version == self.version:
+            return set()
+        oldest = self._changes[0][0] if self._changes else self.version + 1
+        if since_version < oldest - 1:
+            return None
+        changed = set()
+        for version, key in reversed(self._changes):
+            if version <= since_version:
+                break
+            changed.add(key)
+        return changed
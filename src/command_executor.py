@@ -0,0 +1,229 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from enum import IntEnum
+from profiler import get_profiler
+
+class Priority(IntEnum):
+    '''
+    Priority of a drone command.
+    '''
+    # Safety commands (land, fly home). They run on their own workers and do
+    # not wait for the drone's running command, and queuing one preempts the
+    # drone's queued BULK commands.
+    EMERGENCY = 0
+    NORMAL = 1
+    # Long or superseded-by-safety work (mission uploads, speed changes)
+    BULK = 2
+
+
+class CommandPreempted(Exception):
+    '''
+    Raised by the future of a queued command that an emergency command
+    preempted before it started, or that was dropped because its drone was
+    removed.
+    '''
+
+    def __init__(self, by):
+        super().__init__(f"preempted by {by}")
+        self.by = by # Name of the emergency command or of the removal
+
+
+class CommandExecutor:
+    '''
+    Runs drone commands on a bounded pool of worker threads.
+
+    Every drone has its own queue: commands for the same drone run one at a
+    time in the order they were submitted, while commands for different
+    drones run concurrently, up to max_workers at once. A slow or
+    unresponsive drone therefore only delays its own commands.
+
+    EMERGENCY commands are scheduled separately: they only wait for earlier
+    emergency commands of the same drone, and run on emergency_workers
+    threads of their own, so neither a long command already running on the
+    drone nor a pool busy with other drones delays them. While one is queued
+    or running, the drone's other commands wait. Submitting one cancels the
+    BULK commands still queued for that drone; their futures raise
+    CommandPreempted.
+    '''
+
+    WAIT_SAMPLES = 1000 # Number of recent queue waits kept per priority
+
+    def __init__(self, max_workers=8, emergency_workers=2):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers,
+                thread_name_prefix='drone_command')
+        self._emergency_pool = ThreadPoolExecutor(max_workers=emergency_workers,
+                thread_name_prefix='drone_emergency')
+        self._queues = dict() # Map between drone IDs and queued commands
+        self._emergency_queues = dict() # Same, for EMERGENCY commands
+        self._in_flight = set() # IDs of drones with a command running
+        self._emergency_in_flight = set() # IDs of drones with an emergency running
+        self._waits = {p: deque(maxlen=self.WAIT_SAMPLES) for p in Priority}
+        self._counts = {p: 0 for p in Priority} # Commands started per priority
+        self.preemptions = 0
+        self.max_depth = 0 # Longest queue of a drone seen so far
+        self._lock = threading.Lock()
+
+    def submit(self, drone_id, command, on_start=None, priority=Priority.NORMAL, name=None):
+        '''
+        Queues a command for a drone.
+
+        :param drone_id: id of the drone the command is for
+        :param command: callable run on a worker thread; its return value
+            becomes the result of the future
+        :param on_start: optional callable run on the worker thread right
+            before the command starts
+        :param priority: Priority of the command
+        :param name: name of the command, reported to the commands it preempts
+            and used for its profiling span
+        returns: concurrent.futures.Future of the command's result
+        '''
+        future = Future()
+        entry = (future, command, on_start, priority, time.monotonic(), name)
+        preempted = []
+        with self._lock:
+            if priority == Priority.EMERGENCY:
+                self._emergency_queues.setdefault(drone_id, deque()).append(entry)
+                preempted = self._preempt(drone_id)
+            else:
+                queue = self._queues.setdefault(drone_id, deque())
+                queue.append(entry)
+                self.max_depth = max(self.max_depth, len(queue))
+            self._schedule(drone_id)
+        # Outside the lock, as this runs the futures' done callbacks
+        self._fail_preempted(preempted, name or "an emergency command")
+        return future
+
+    def cancel_drone(self, drone_id, by):
+        '''
+        Drops every command still queued for a drone, e.g. when the drone is
+        removed. Their futures raise CommandPreempted; a command already
+        running is left to finish.
+
+        :param drone_id: id of the drone
+        :param by: name of what dropped the commands, reported by their futures
+        returns: number of commands dropped
+        '''
+        with self._lock:
+            dropped = [entry[0] for entry in self._queues.pop(drone_id, ())]
+            dropped += [entry[0] for entry in self._emergency_queues.pop(drone_id, ())]
+        self._fail_preempted(dropped, by)
+        return len(dropped)
+
+    def pending(self, drone_id):
+        '''
+        returns: number of commands for the drone that are queued or running
+        '''
+        with self._lock:
+            queued = (len(self._queues.get(drone_id, ()))
+                    + len(self._emergency_queues.get(drone_id, ())))
+            return (queued + (drone_id in self._in_flight)
+                    + (drone_id in self._emergency_in_flight))
+
+    def state(self):
+        '''
+        returns: dict of {drone id: (queued commands, command in flight)}
+        '''
+        with self._lock:
+            ids = (set(self._queues) | set(self._emergency_queues)
+                    | self._in_flight | self._emergency_in_flight)
+            return {i: (len(self._queues.get(i, ())) + len(self._emergency_queues.get(i, ())),
+                    i in self._in_flight or i in self._emergency_in_flight)
+                    for i in ids}
+
+    def metrics(self):
+        '''
+        returns: dict of {queued, max_depth, preemptions, waits} where queued
+        is the number of commands waiting now and waits maps each priority
+        name to {started, p50, p99, max} of the seconds recent commands
+        waited between submission and start
+        '''
+        with self._lock:
+            queued = (sum(len(q) for q in self._queues.values())
+                    + sum(len(q) for q in self._emergency_queues.values()))
+            waits = dict()
+            for priority in Priority:
+                samples = sorted(self._waits[priority])
+                summary = {"started": self._counts[priority], "p50": 0.0, "p99": 0.0, "max": 0.0}
+                if samples:
+                    summary.update(p50=samples[len(samples) // 2],
+                            p99=samples[min(len(samples) - 1, len(samples) * 99 // 100)],
+                            max=samples[-1])
+                waits[priority.name] = summary
+            return {"queued": queued, "max_depth": self.max_depth,
+                    "preemptions": self.preemptions, "waits": waits}
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+        self._emergency_pool.shutdown(wait=wait)
+
+    def _preempt(self, drone_id):
+        # Called with self._lock held. Removes the drone's queued BULK commands
+        # and returns their futures, to be failed once the lock is released.
+        queue = self._queues.get(drone_id)
+        if not queue:
+            return []
+        kept = deque()
+        preempted = []
+        for entry in queue:
+            if entry[3] == Priority.BULK:
+                preempted.append(entry[0])
+            else:
+                kept.append(entry)
+        self._queues[drone_id] = kept
+        self.preemptions += len(preempted)
+        return preempted
+
+    def _fail_preempted(self, futures, by):
+        # Called without self._lock, as this runs the futures' done callbacks
+        for future in futures:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(CommandPreempted(by))
+
+    def _schedule(self, drone_id):
+        # Called with self._lock held. Starts the drone's next emergency
+        # command if none is running, and its next other command if nothing
+        # at all is running or waiting to run in the emergency lane.
+        emergencies = self._emergency_queues.get(drone_id)
+        if emergencies and drone_id not in self._emergency_in_flight:
+            self._emergency_in_flight.add(drone_id)
+            self._start(self._emergency_pool, drone_id, emergencies.popleft())
+        if not emergencies:
+            self._emergency_queues.pop(drone_id, None)
+        busy = (drone_id in self._in_flight or drone_id in self._emergency_in_flight
+                or drone_id in self._emergency_queues)
+        queue = self._queues.get(drone_id)
+        if queue and not busy:
+            self._in_flight.add(drone_id)
+            self._start(self._pool, drone_id, queue.popleft())
+        if not self._queues.get(drone_id):
+            self._queues.pop(drone_id, None)
+
+    def _start(self, pool, drone_id, entry):
+        # Called with self._lock held
+        pool.submit(self._run, drone_id, *entry)
+
+    def _run(self, drone_id, future, command, on_start, priority, submitted, name):
+        try:
+            if future.set_running_or_notify_cancel():
+                with self._lock:
+                    self._waits[priority].append(time.monotonic() - submitted)
+                    self._counts[priority] += 1
+                profiler = get_profiler()
+                start = time.perf_counter()
+                try:
+                    if on_start:
+                        on_start()
+                    future.set_result(profiler.call(command))
+                except Exception as e:
+                    future.set_exception(e)
+                finally:
+                    profiler.span("command", name or "command", start, time.perf_counter() - start)
+        finally:
+            with self._lock:
+                if priority == Priority.EMERGENCY:
+                    self._emergency_in_flight.discard(drone_id)
+                else:
+                    self._in_flight.discard(drone_id)
+                self._schedule(drone_id)
@@ -0,0 +1,161 @@
+import threading
+import time
+import roslibpy
+from server_log import get_logger
+
+logger = get_logger('connection')
+
+class ConnectionManager:
+    '''
+    Watches a roslibpy.Ros connection and keeps the server usable across
+    rosbridge restarts.
+
+    roslibpy already reconnects on its own and, from version 1.1 on, sends
+    the advertise and subscribe messages of every Service and Topic again
+    once the new connection is ready, which covers every @custom_service,
+    the action servers' topics and the telemetry subscriptions. Messages
+    sent while disconnected are queued and sent after the reconnect.
+
+    What this adds:
+      * bounded backoff: by default roslibpy waits up to an hour between
+        attempts, so after a long rosbridge restart the server could stay
+        down long after rosbridge is back,
+      * connection state and statistics (disconnects, last downtime),
+      * hooks run after each reconnect, for state clients have to be sent
+        again.
+    '''
+
+    def __init__(self, ros, initial_delay=0.5, max_delay=10, max_retries=None):
+        '''
+        :param ros: roslibpy.Ros connection
+        :param initial_delay: seconds before the first reconnect attempt
+        :param max_delay: the delay doubles after every failed attempt up to
+            this many seconds
+        :param max_retries: attempts before giving up, None to never give up
+        '''
+        self.ros = ros
+        # Set on this connection's factory only; the roslibpy class setters
+        # would change every connection
+        factory = ros.factory
+        factory.initialDelay = factory.delay = initial_delay
+        factory.maxDelay = max_delay
+        factory.maxRetries = max_retries
+        self.disconnects = 0
+        self.last_downtime = None # Seconds the last disconnect lasted
+        self._connected = False
+        self._closed_at = None
+        self._reconnect_hooks = []
+        self._lock = threading.Lock()
+        ros.on('ready', self._on_ready)
+        ros.on('close', self._on_close)
+
+    @property
+    def is_connected(self):
+        return self._connected
+
+    def on_reconnect(self, callback):
+        '''
+        :param callback: called without arguments, on a worker thread, every
+            time the connection is ready again after a disconnect
+        '''
+        self._reconnect_hooks.append(callback)
+
+    def state(self):
+        '''
+        returns: dict of {connected, disconnects, down_for, last_downtime}
+        where down_for is how long the current disconnect has lasted
+        '''
+        with self._lock:
+            down_for = 0.0
+            if self._closed_at is not None:
+                down_for = time.monotonic() - self._closed_at
+            return {"connected": self._connected, "disconnects": self.disconnects,
+                    "down_for": down_for, "last_downtime": self.last_downtime}
+
+    def _on_close(self, proto):
+        with self._lock:
+            if not self._connected:
+                return
+            self._connected = False
+            self._closed_at = time.monotonic()
+            self.disconnects += 1
+        logger.warning("Lost connection to rosbridge, reconnecting...")
+
+    def _on_ready(self, proto):
+        with self._lock:
+            self._connected = True
+            if self._closed_at is None:
+                return
+            self.last_downtime = time.monotonic() - self._closed_at
+            self._closed_at = None
+        logger.info("Reconnected to rosbridge after %.1f s", self.last_downtime)
+        for hook in self._reconnect_hooks:
+            self.ros.call_in_thread(hook)
+
+
+class ConnectionPool:
+    '''
+    Spreads the drones' traffic over several rosbridge connections.
+
+    With a single connection, every drone command and every interface
+    service share one websocket, so a large mission upload delays everything
+    sent after it, including a land command. The pool opens `size` extra
+    connections and gives each new drone the one with the fewest drones,
+    plus an optional connection reserved for safety-critical commands.
+    With size 0 every drone uses the default connection, as before.
+    '''
+
+    def __init__(self, default, host, port, size=0, priority=False,
+            initial_delay=0.5, max_delay=10):
+        '''
+        :param default: roslibpy.Ros connection used when size is 0
+        :param host: rosbridge host of the pool's connections
+        :param port: rosbridge port of the pool's connections
+        :param size: number of connections shared by the drones
+        :param priority: whether to open a connection for priority commands
+        :param initial_delay: see ConnectionManager
+        :param max_delay: see ConnectionManager
+        '''
+        self.default = default
+        self.managers = [ConnectionManager(roslibpy.Ros(host=host, port=port),
+                initial_delay, max_delay) for _ in range(size)]
+        self.connections = [manager.ros for manager in self.managers]
+        self.priority = None
+        if priority:
+            manager = ConnectionManager(roslibpy.Ros(host=host, port=port),
+                    initial_delay, max_delay)
+            self.managers.append(manager)
+            self.priority = manager.ros
+        self._drones = [0] * size # Number of drones on each connection
+        self._lock = threading.Lock()
+
+    def assign(self):
+        '''
+        returns: the connection a new drone should use
+        '''
+        with self._lock:
+            if not self.connections:
+                return self.default
+            index = self._drones.index(min(self._drones))
+            self._drones[index] += 1
+            return self.connections[index]
+
+    def release(self, connection):
+        '''
+        Tells the pool a drone using the connection is gone.
+        '''
+        with self._lock:
+            if connection in self.connections:
+                self._drones[self.connections.index(connection)] -= 1
+
+    def reset(self):
+        with self._lock:
+            self._drones = [0] * len(self.connections)
+
+    def state(self):
+        '''
+        returns: list of {drones, connected} dicts, one per shared connection
+        '''
+        with self._lock:
+            return [{"drones": count, "connected": manager.is_connected}
+                    for count, manager in zip(self._drones, self.managers)]
@@ -1 +1,16 @@
 IP_ADDRESS = '54.161.15.175'
+SERVICE_CACHE_SIZE = 256
+SERVICE_CACHE_TTL = 30.0
+COMMAND_WORKERS = 8
+TELEMETRY_SAMPLES = 600
+TELEMETRY_THROTTLE_RATE = 100
+FLEET_STATE_RATE = 10
+FLEET_STATE_KEYFRAME_INTERVAL = 5
+RECONNECT_INITIAL_DELAY = 0.5
+RECONNECT_MAX_DELAY = 10
+DRONE_CONNECTIONS = 0
+EMERGENCY_WORKERS = 2
+COMMAND_TIMEOUT = 30
+LOG_LEVEL = 'INFO'
+METRICS_INTERVAL = 15
+PROFILE_DIR = 'profiles'
@@ -0,0 +1,46 @@
+import time
+
+class DeadlineExceeded(TimeoutError):
+    '''
+    Raised when a drone service call does not answer before its deadline,
+    or when the deadline has already passed before the call is made.
+    '''
+
+
+class Deadline:
+    '''
+    The time by which a command has to finish.
+
+    A deadline is created when an action goal arrives and passed down
+    through the Drone API, so that every service call made for the goal is
+    bounded by the time the goal has left rather than by a fixed timeout of
+    its own. Time spent queued on the command executor counts too.
+    '''
+
+    def __init__(self, seconds):
+        '''
+        :param seconds: time allowed from now
+        '''
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        '''
+        returns: seconds left, 0 once the deadline has passed
+        '''
+        return max(0.0, self.expires - time.monotonic())
+
+    @property
+    def expired(self):
+        return time.monotonic() >= self.expires
+
+    def timeout(self, limit=None):
+        '''
+        :param limit: optional longest time the next call may take anyway
+        returns: seconds the next call may take
+        raises: DeadlineExceeded if no time is left
+        '''
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"deadline of {self.seconds:g} s passed")
+        return remaining if limit is None else min(limit, remaining)
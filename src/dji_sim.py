@@ -2,12 +2,54 @@
 Since we don't have the physical drone to advertise its services (land, takeoff, etc)
 this script simulates advertising those services. This lets the server actually call them.
 Instead of seeing the perform its action, we will get a print message.
+
+It can also simulate a fleet: with --drones N it registers N DJI drones with
+the server, saves their topics and publishes their position and flight
+status, like the onboard computers would. All simulated drones are answered
+by the same fake services, since the DJI driver calls them without a
+namespace. --latency makes the services answer as slowly as a drone over a
+radio link would, without holding up the calls of other drones.
+Ex: python3 dji_sim.py --ip 127.0.0.1 --drones 20 --latency 50 --quiet
 '''
 
+import argparse
+import random
+import time
 import roslibpy
 import constants
 
-client = roslibpy.Ros(host=constants.IP_ADDRESS, port=9090)
+parser = argparse.ArgumentParser(description='Simulates DJI drones for the server.')
+parser.add_argument('--ip', type=str, default=constants.IP_ADDRESS)
+parser.add_argument('--drones', type=int, default=0,
+        help='Number of drones to register with the server (0 = only advertise the services).')
+parser.add_argument('--latency', type=float, default=0,
+        help='Milliseconds the simulated services take to answer.')
+parser.add_argument('--telemetry-rate', type=float, default=1,
+        help='Position and flight status messages per second of each drone.')
+parser.add_argument('--name', type=str, default='dji_sim',
+        help='Prefix of the names of the registered drones.')
+parser.add_argument('--quiet', action='store_true',
+        help='Do not print every service call.')
+args = parser.parse_args()
+
+client = roslibpy.Ros(host=args.ip, port=9090)
+
+def simulated(message):
+    if not args.quiet:
+        print(message)
+
+class SimulatedService(roslibpy.Service):
+    '''
+    Fake drone service that sends its response --latency milliseconds after
+    the call arrives. The delay is scheduled on the event loop rather than
+    slept, so calls for other drones are answered in the meantime.
+    '''
+    def _service_response_handler(self, request):
+        respond = super()._service_response_handler
+        if args.latency > 0:
+            client.call_later(args.latency / 1000, lambda: respond(request))
+        else:
+            respond(request)
 
 '''
 Simulates advertising the service drone_control from the drone.
@@ -15,8 +57,8 @@ TODO: DroneTaskControl should take care of land, takeoff, etc, depending on the
 We might not need to actually implement each case, depending on how precise we want this "simulator" to be
 '''
 def drone_control(request, response):
-    print("Control task service is being simulated")
-    print(f"Performing task: {request['task']}")
+    simulated("Control task service is being simulated")
+    simulated(f"Performing task: {request['task']}")
     response["result"] = True
     response["cmd_set"] = 0
     response["cmd_id"] = 0
@@ -24,18 +66,18 @@ def drone_control(request, response):
     return True
 
 def drone_waypoint(request, response):
-    print("Drone waypoint service is being simulated")
-    print(f"Performing action: {request['action']}")
+    simulated("Drone waypoint service is being simulated")
+    simulated(f"Performing action: {request['action']}")
     response["result"] = True
     response["cmd_set"] = 0
     response["cmd_id"] = 0
     response["ack_datas"] = 0
     return True
 
-service = roslibpy.Service(client, 'isaacs_server/fake_drone_control', 'isaacs_server/FakeDroneControl')
+service = SimulatedService(client, 'isaacs_server/fake_drone_control', 'isaacs_server/FakeDroneControl')
 service.advertise(drone_control)
 
-service2 = roslibpy.Service(client, 'isaacs_server/fake_drone_waypoint', 'isaacs_server/FakeDroneWaypoint')
+service2 = SimulatedService(client, 'isaacs_server/fake_drone_waypoint', 'isaacs_server/FakeDroneWaypoint')
 service2.advertise(drone_waypoint)
 
 '''
@@ -44,42 +86,101 @@ Simulates advertising the service set_speed from the drone.
 speed = 5
 
 def set_speed(request, response):
-    print("Set speed service is being simulated")
-    print(f"Speed set to {request['speed']}")
+    simulated("Set speed service is being simulated")
+    simulated(f"Speed set to {request['speed']}")
     global speed
     speed = request['speed']
     response["result"] = True
     return True
 
 def get_speed(request, response):
-    print("Get speed service is being simulated")
+    simulated("Get speed service is being simulated")
     response["speed"] = speed
     response["cmd_set"] = 0
     response["cmd_id"] = 0
     response["ack_data"] = 0
     return True
 
-service3 = roslibpy.Service(client, 'isaacs_server/fake_set_speed', 'isaacs_server/FakeSetSpeed')
+service3 = SimulatedService(client, 'isaacs_server/fake_set_speed', 'isaacs_server/FakeSetSpeed')
 service3.advertise(set_speed)
-service4 = roslibpy.Service(client, 'isaacs_server/fake_get_speed', 'isaacs_server/FakeGetSpeed')
+service4 = SimulatedService(client, 'isaacs_server/fake_get_speed', 'isaacs_server/FakeGetSpeed')
 service4.advertise(get_speed)
 
 '''
 Simulates advertising the service upload_mission from the drone.
 '''
 def upload_mission(request, response):
-    print("Upload mission service is being simulated")
-    print(request["waypoint_task"])
+    simulated("Upload mission service is being simulated")
+    simulated(request["waypoint_task"])
     response["result"] = True
     response["cmd_set"] = 0
     response["cmd_id"] = 0
     response["ack_data"] = 0
     return True
 
-service5 = roslibpy.Service(client, 'isaacs_server/fake_mission_waypoint_upload', 'isaacs_server/FakeMissionWaypointUpload')
+service5 = SimulatedService(client, 'isaacs_server/fake_mission_waypoint_upload', 'isaacs_server/FakeMissionWaypointUpload')
 service5.advertise(upload_mission)
 
 print("Fake drone services advertised...")
 
-client.run_forever()
+'''
+Simulates the onboard computers of a fleet of drones.
+'''
+def register_drones(count):
+    '''
+    Registers the drones with the server and saves their position and
+    flight status topics.
+
+    :param count: number of drones
+    returns: list of the ids the server gave the drones
+    '''
+    register = roslibpy.Service(client, 'isaacs_server/register_drone', 'isaacs_server/RegisterDrone')
+    save_topics = roslibpy.Service(client, 'isaacs_server/save_drone_topics', 'isaacs_server/TypeToTopic')
+    ids = []
+    for i in range(count):
+        response = register.call(roslibpy.ServiceRequest({"drone_name": f"{args.name}_{i}",
+                "drone_type": "DjiMatrice"}), timeout=10)
+        if not response["success"]:
+            raise RuntimeError(f"Registering {args.name}_{i} failed: {response['message']}")
+        drone_id = response["id"]
+        save_topics.call(roslibpy.ServiceRequest({"id": drone_id, "publishes": [
+                {"name": f"/drone_{drone_id}/dji_sdk/gps_position", "type": "sensor_msgs/NavSatFix"},
+                {"name": f"/drone_{drone_id}/dji_sdk/flight_status", "type": "std_msgs/UInt8"}]}),
+                timeout=10)
+        ids.append(drone_id)
+    return ids
+
+def publish_telemetry(ids):
+    '''
+    Publishes the position of every drone, drifting slowly, and its flight
+    status (on the ground) at --telemetry-rate, until interrupted.
+    '''
+    positions = []
+    statuses = []
+    for drone_id in ids:
+        positions.append((roslibpy.Topic(client, f"/drone_{drone_id}/dji_sdk/gps_position", "sensor_msgs/NavSatFix"),
+                [-35.36 + random.random() * 0.01, 149.16 + random.random() * 0.01, 0.0]))
+        statuses.append(roslibpy.Topic(client, f"/drone_{drone_id}/dji_sdk/flight_status", "std_msgs/UInt8"))
+    interval = 1 / args.telemetry_rate
+    while client.is_connected:
+        start = time.monotonic()
+        for topic, position in positions:
+            position[0] += random.uniform(-1e-6, 1e-6)
+            position[1] += random.uniform(-1e-6, 1e-6)
+            topic.publish(roslibpy.Message({"status": {"status": 0, "service": 1},
+                    "latitude": position[0], "longitude": position[1], "altitude": position[2]}))
+        for topic in statuses:
+            topic.publish(roslibpy.Message({"data": 1}))
+        time.sleep(max(0, interval - (time.monotonic() - start)))
+
+if args.drones > 0:
+    client.run()
+    ids = register_drones(args.drones)
+    print(f"Registered {len(ids)} drones: {' '.join(str(i) for i in ids)}", flush=True)
+    try:
+        publish_telemetry(ids)
+    except KeyboardInterrupt:
+        pass
+else:
+    client.run_forever()
 client.terminate()
@@ -1,8 +1,13 @@
 import roslibpy
 import numpy as np
+import waypoints as waypoint_arrays
+from deadline import DeadlineExceeded
 from drone import Drone
+from server_log import get_logger, summarize
 from enum import IntEnum
 
+logger = get_logger('djimatrice_drone')
+
 class DjiMatriceDrone(Drone):
     '''
     DJI Matrice API translator layer.
@@ -12,6 +17,9 @@ class DjiMatriceDrone(Drone):
 
     drone_type = "DjiMatrice"
 
+    # A DJI waypoint mission holds at most 99 waypoints
+    max_mission_waypoints = 99
+
     '''
     This enum is used to reference control task numbers as hardcoded in the DJI SDK.
     '''
@@ -25,46 +33,71 @@ class DjiMatriceDrone(Drone):
         assert(drone_type == self.drone_type)
         self.prev_flight_status = Drone.Flight_Status.NULL
 
+    # Values of the dji_sdk/flight_status topic (A3/N3 flight controllers)
+    class DjiFlightStatus(IntEnum):
+        STOPPED = 0
+        ON_GROUND = 1
+        IN_AIR = 2
+
+    def telemetry_kind(self, name, topic_type):
+        if topic_type == "sensor_msgs/NavSatFix" and name.endswith("gps_position"):
+            return "position"
+        if topic_type == "std_msgs/UInt8" and name.endswith("flight_status"):
+            return "state"
+        return None
+
+    # Takes a std_msgs/UInt8 message of dji_sdk/flight_status
+    # The topic only tells whether the drone is in the air, so while it is,
+    # the status set by the last control task is kept.
+    def received_state_update(self, message):
+        if message["data"] != DjiMatriceDrone.DjiFlightStatus.IN_AIR:
+            self.flight_status = Drone.Flight_Status.ON_GROUND_STANDBY
+        elif self.prev_flight_status in (Drone.Flight_Status.NULL, Drone.Flight_Status.ON_GROUND_STANDBY):
+            self.flight_status = Drone.Flight_Status.IN_AIR_STANDBY
+        else:
+            self.flight_status = self.prev_flight_status
+
     # Takes a list of waypoints for drone to follow.
     # Converts waypoints to DJI format(Waypoint Mission Task)
     # Makes a service call to DJI_SDK mission_waypoint_upload.
     # Returns dictionary describing if service call was successful.
-    def upload_mission(self, waypoints):
-        self.waypoints = waypoints
+    def upload_mission(self, waypoints, deadline=None):
+        columns = waypoint_arrays.columns(waypoints)
+        invalid = waypoint_arrays.invalid_indices(columns)
+        if invalid.size:
+            return {"success":False, "message":"Invalid waypoints at indices {}".format(invalid.tolist())}
         self.mission_msg_list = []
-        waypointTask = self.create_waypoint_task(waypoints)
-        result = self.upload_waypoint_task(waypointTask)
+        waypointTask = self.create_waypoint_task(columns)
+        result = self.upload_waypoint_task(waypointTask, deadline)
+        if result["success"]:
+            self.waypoints = waypoints
         return result
 
+    # Mission Waypoint Action with no commands. It is shared by every waypoint
+    # and must not be modified.
+    MISSION_WAYPOINT_ACTION = {"action_repeat":0, "command_list":[0] * 16, "command_parameter":[0] * 16}
+
+    # Fields of a Mission Waypoint that are the same for every waypoint
+    MISSION_WAYPOINT_TEMPLATE = {
+        "damping_distance": 3,
+        "target_yaw": 0,
+        "target_gimbal_pitch": 0,
+        "turn_mode": 0,
+        "has_action": 0,
+        "action_time_limit": 30,
+        "waypoint_action": MISSION_WAYPOINT_ACTION
+    }
+
     # Helper function for upload_mission()
-    # Converts Waypoints to Mission Waypoint Task
+    # Converts Waypoints (NavSatFix list, array from waypoints.to_array or
+    # columns from waypoints.columns) to Mission Waypoint Task
     # Mission Waypoint Task is the Proper Format for DJI Service Requests
     # Returns the Mission Waypoint Task
     def create_waypoint_task(self, waypoints):
-        command_list = [];
-        command_params = [];
-        for i in range(16):
-            command_list.append(0)
-            command_params.append(0)
-
-        # Mission Waypoint Action
-        missionWaypointActionMsg = {"action_repeat":0, "command_list":command_list, "command_parameter":command_params}
-        missionWaypoints = []
-
         #Mission Waypoint
-        for wp in waypoints:
-            missionWp = dict()
-            missionWp["latitude"] = wp["latitude"]
-            missionWp["longitude"] = wp["longitude"]
-            missionWp["altitude"] = wp["altitude"]
-            missionWp["damping_distance"] = 3
-            missionWp["target_yaw"] = 0
-            missionWp["target_gimbal_pitch"] = 0
-            missionWp["turn_mode"] = 0
-            missionWp["has_action"] = 0
-            missionWp["action_time_limit"] = 30
-            missionWp["waypoint_action"] = missionWaypointActionMsg
-            missionWaypoints.append(missionWp)
+        missionWaypoints = waypoint_arrays.emit(waypoints,
+                                                DjiMatriceDrone.MISSION_WAYPOINT_TEMPLATE,
+                                                "latitude", "longitude", "altitude")
 
         #Mission Waypoint Task
         missionWaypointTask = dict()
@@ -83,20 +116,24 @@ class DjiMatriceDrone(Drone):
     # Helper function for upload_mission().
     # Make a Service Call to DJI_SDK upload_mission
     # Return a dictionary revealing whether the call was successful or not
-    def upload_waypoint_task(self, task):
+    def upload_waypoint_task(self, task, deadline=None):
         try:
-            print("Attempting to upload waypoint task...")
+            logger.debug("Attempting to upload waypoint task...")
             # fake_mission_waypoint_upload found in srv folder. Copied directly from DJI SDK for local testing. 
-            # service = roslibpy.Service(self.ROS_master_connection, 'dji_sdk/mission_waypoint_upload', 'dji_sdk/MissionWpUpload')
-            service = roslibpy.Service(self.ROS_master_connection, 'isaacs_server/fake_mission_waypoint_upload',
-                    'isaacs_server/FakeWaypointMissionUpload')
+            # service = self.service_proxy('dji_sdk/mission_waypoint_upload', 'dji_sdk/MissionWpUpload')
+            service = self.service_proxy('isaacs_server/fake_mission_waypoint_upload',
+                                         'isaacs_server/FakeWaypointMissionUpload')
             request = roslibpy.ServiceRequest({"waypoint_task": task})
 
-            print('Calling mission_waypoint_upload service...')
-            result = service.call(request)
+            logger.debug("Calling mission_waypoint_upload service...")
+            result = self.call_service(service, request, deadline)
+            logger.debug("Service response: %s", summarize(result))
             if result["result"]:
                 result = {"success":True, "message":"Upload mission successful"}
-            print('Service response: {}'.format(result))
+            else:
+                result = {"success":False, "message":"Drone refused the mission upload"}
+        except DeadlineExceeded as e:
+            result = self.timed_out(e)
         except:
             result = {"success":False, "message":"Upload mission failed"}
         return result
@@ -104,22 +141,24 @@ class DjiMatriceDrone(Drone):
     # Takes a float32 number as the speed to set drone too
     # Makes a service call to mission_waypoint_setSpeed in DJI SDK
     # Returns a dictionary describing whether service call was successful
-    def set_speed(self, speed):
+    def set_speed(self, speed, deadline=None):
         try:
-            print("Attempting to set speed...")
+            logger.debug("Attempting to set speed...")
             # fake_set_speed found in srv folder. Copied directly from DJI SDK for local testing. 
-            #service = roslibpy.Service(self.ROS_master_connection, 'dji_sdk/mission_waypoint_setSpeed', 'dji_sdk/MissionWpSetSpeed')
-            service = roslibpy.Service(self.ROS_master_connection, 'isaacs_server/fake_set_speed',
-                    'isaacs_server/FakeSetSpeed')
+            #service = self.service_proxy('dji_sdk/mission_waypoint_setSpeed', 'dji_sdk/MissionWpSetSpeed')
+            service = self.service_proxy('isaacs_server/fake_set_speed',
+                                         'isaacs_server/FakeSetSpeed')
             request = roslibpy.ServiceRequest({"speed": speed})
 
-            print('Calling mission_waypoint_setSpeed service...')
-            result = service.call(request)
-            print('Service response: {}'.format(result))
+            logger.debug("Calling mission_waypoint_setSpeed service...")
+            result = self.call_service(service, request, deadline)
+            logger.debug("Service response: %s", summarize(result))
             if result["result"]:
                 result = {"success":True, "message":"New drone speed set"}
             else:
                 result = {"success":False, "message":"Failed to set new drone speed"}
+        except DeadlineExceeded as e:
+            result = self.timed_out(e)
         except:
             result = {"success":False, "message":"Failed to set new drone speed"}
         return result
@@ -128,22 +167,24 @@ class DjiMatriceDrone(Drone):
     # Makes a service call to DJI SDK mission_waypoint_getSpeed
     # Returns a dictionary describing if service call was successful.
     # Dictionary has a key "speed" which is a float32 of the current speed. This param is 0 if service call failed.
-    def get_speed(self):
+    def get_speed(self, deadline=None):
         try:
-            print("Attempting to fetch speed...")
+            logger.debug("Attempting to fetch speed...")
             # fake_get_speed found in srv folder. Copied directly from DJI SDK for local testing.
-            #service = roslibpy.Service(self.ROS_master_connection, 'dji_sdk/mission_waypoint_getSpeed', 'dji_sdk/MissionWpGetSpeed')
-            service = roslibpy.Service(self.ROS_master_connection, 'isaacs_server/fake_get_speed',
-                    'isaacs_server/FakeGetSpeed')
+            #service = self.service_proxy('dji_sdk/mission_waypoint_getSpeed', 'dji_sdk/MissionWpGetSpeed')
+            service = self.service_proxy('isaacs_server/fake_get_speed',
+                                         'isaacs_server/FakeGetSpeed')
             request = roslibpy.ServiceRequest()
 
-            print('Calling mission_waypoint_setSpeed service...')
-            result = service.call(request)
-            print('Service response: {}'.format(result))
+            logger.debug("Calling mission_waypoint_setSpeed service...")
+            result = self.call_service(service, request, deadline)
+            logger.debug("Service response: %s", summarize(result))
             if result["speed"] >= 0:
                 result = {"success":True, "message":"New drone speed set", "speed": result["speed"]}
             else:
                 result = {"success":False, "message":"Failed to set new drone speed", "speed":0}
+        except DeadlineExceeded as e:
+            result = self.timed_out(e)
         except:
             result = {"success":False, "message":"Failed to fetch drone speed", "speed":0}
         return result
@@ -153,25 +194,28 @@ class DjiMatriceDrone(Drone):
     # Makes a service call to mission_waypoint_action in DJI SDK
     # Pass Drone.WaypointActions.START as the action.
     # Returns a dictionary describing whether service call was successful
-    def start_mission(self):
+    def start_mission(self, on_step=None, deadline=None):
+        # DJI starts the mission with a single call, so on_step is not used
         try:
-            print("Attempting to start drone mission...")
+            logger.debug("Attempting to start drone mission...")
             # fake_drone_waypoint found in srv folder. Copied directly from DJI SDK for local testing.
-            # service = roslibpy.Service(self.ROS_master_connection, 'dji_sdk/mission_waypoint_action', 'dji_sdk/MissionWpAction')
-            service = roslibpy.Service(self.ROS_master_connection, 'isaacs_server/fake_drone_waypoint',
-                    'isaacs_server/FakeDroneWaypoint')
+            # service = self.service_proxy('dji_sdk/mission_waypoint_action', 'dji_sdk/MissionWpAction')
+            service = self.service_proxy('isaacs_server/fake_drone_waypoint',
+                                         'isaacs_server/FakeDroneWaypoint')
             request = roslibpy.ServiceRequest({"action": Drone.WaypointActions.START})
 
-            print('Calling mission_waypoint_action start service...')
-            result = service.call(request)
-            print('Service response: {}'.format(result))
+            logger.debug("Calling mission_waypoint_action start service...")
+            result = self.call_service(service, request, deadline)
+            logger.debug("Service response: %s", summarize(result))
             if result["result"]:
                 result = {"success":True, "message":"Start mission successful"}
             else:
                 result = {"success":False, "message":"Mission failed to start"}
+        except DeadlineExceeded as e:
+            result = self.timed_out(e)
         except Exception as e:
             result = {"success":False, "message":"Mission failed to start"}
-            print(e)
+            logger.warning("start_mission of drone %s failed: %s", self.id, e)
         return result
 
     # Stops a Waypoint Mission
@@ -179,22 +223,25 @@ class DjiMatriceDrone(Drone):
     # Pass Drone.Waypoint.Actions.STOP as the action.
     # Returns a dictionary describing whether service call was successful
     
-    def stop_mission(self):
+    def stop_mission(self, deadline=None):
         try:
-            print("Attempting to stop drone mission...")
-            # service = roslibpy.Service(self.ROS_master_connection, 'dji_sdk/mission_waypoint_action', 'dji_sdk/MissionWpAction')
+            logger.debug("Attempting to stop drone mission...")
+            # service = self.service_proxy('dji_sdk/mission_waypoint_action', 'dji_sdk/MissionWpAction')
             # fake_drone_waypoint found in srv folder. Copied directly from DJI SDK for local testing.
-            service = roslibpy.Service(self.ROS_master_connection, 'isaacs_server/fake_drone_waypoint',
-                    'isaacs_server/FakeDroneWaypoint')
+            service = self.service_proxy('isaacs_server/fake_drone_waypoint',
+                                         'isaacs_server/FakeDroneWaypoint')
             request = roslibpy.ServiceRequest({"action": Drone.WaypointActions.STOP})
 
-            print('Calling mission_waypoint_action stop service...')
-            result = service.call(request)
-            print('Service response: {}'.format(result))
+            logger.debug("Calling mission_waypoint_action stop service...")
+            result = self.call_service(service, request, deadline)
+            logger.debug("Service response: %s", summarize(result))
             if result["result"]:
+                self.forget_mission()
                 result = {"success":True, "message":"Stop mission successful"}
             else:
                 result = {"success":False, "message":"Mission failed to stop"}
+        except DeadlineExceeded as e:
+            result = self.timed_out(e)
         except:
             result = {"success":False, "message":"Mission failed to stop"}
         return result
@@ -203,22 +250,24 @@ class DjiMatriceDrone(Drone):
     # Makes a service call to mission_waypoint_action in DJI SDK
     # Pass Drone.Waypoint.Actions.Pause as the action.
     # Returns a dictionary describing whether service call was successful
-    def pause_mission(self):
+    def pause_mission(self, deadline=None):
         try:
-            print("Attempting to pause drone mission...")
+            logger.debug("Attempting to pause drone mission...")
             # fake_drone_waypoint found in srv folder. Copied directly from DJI SDK for local testing.
-            #service = roslibpy.Service(self.ROS_master_connection, 'dji_sdk/mission_waypoint_action', 'dji_sdk/MissionWpAction')
-            service = roslibpy.Service(self.ROS_master_connection, 'isaacs_server/fake_drone_waypoint',
-                    'isaacs_server/FakeDroneWaypoint')
+            #service = self.service_proxy('dji_sdk/mission_waypoint_action', 'dji_sdk/MissionWpAction')
+            service = self.service_proxy('isaacs_server/fake_drone_waypoint',
+                                         'isaacs_server/FakeDroneWaypoint')
             request = roslibpy.ServiceRequest({"action": Drone.WaypointActions.PAUSE})
 
-            print('Calling mission_waypoint_action pause service...')
-            result = service.call(request)
-            print('Service response: {}'.format(result))
+            logger.debug("Calling mission_waypoint_action pause service...")
+            result = self.call_service(service, request, deadline)
+            logger.debug("Service response: %s", summarize(result))
             if result["result"]:
                 result = {"success":True, "message":"Pause mission successful"}
             else:
                 result = {"success":False, "message":"Mission failed to pause"}
+        except DeadlineExceeded as e:
+            result = self.timed_out(e)
         except:
             result = {"success":False, "message":"Mission failed to pause"}
         return result
@@ -228,22 +277,24 @@ class DjiMatriceDrone(Drone):
     # Makes a service call to mission_waypoint_action in DJI SDK
     # Pass Drone.Waypoint.Actions.Resume as the action.
     # Returns a dictionary describing whether service call was successful
-    def resume_mission(self):
+    def resume_mission(self, deadline=None):
         try:
-            print("Attempting to resume drone mission...")
+            logger.debug("Attempting to resume drone mission...")
             # fake_drone_waypoint found in srv folder. Copied directly from DJI SDK for local testing.
-            #service = roslibpy.Service(self.ROS_master_connection, 'dji_sdk/mission_waypoint_action', 'dji_sdk/MissionWpAction')
-            service = roslibpy.Service(self.ROS_master_connection, 'isaacs_server/fake_drone_waypoint',
-                    'isaacs_server/FakeDroneWaypoint')
+            #service = self.service_proxy('dji_sdk/mission_waypoint_action', 'dji_sdk/MissionWpAction')
+            service = self.service_proxy('isaacs_server/fake_drone_waypoint',
+                                         'isaacs_server/FakeDroneWaypoint')
             request = roslibpy.ServiceRequest({"action": Drone.WaypointActions.RESUME})
 
-            print('Calling mission_waypoint_action resume service...')
-            result = service.call(request)
-            print('Service response: {}'.format(result))
+            logger.debug("Calling mission_waypoint_action resume service...")
+            result = self.call_service(service, request, deadline)
+            logger.debug("Service response: %s", summarize(result))
             if result["result"]:
                 result = {"success":True, "message":"Resume mission successful"}
             else:
                 result = {"success":False, "message":"Mission failed to resume"}
+        except DeadlineExceeded as e:
+            result = self.timed_out(e)
         except:
             result = {"success":False, "message":"Mission failed to resume"}
         return result
@@ -253,70 +304,80 @@ class DjiMatriceDrone(Drone):
     # Makes a service call to drone_task_control in DJI SDK
     # Pass Drone.TaskControl.Land as the predefined task.
     # Returns a dictionary describing whether service call was successful
-    def land_drone(self):
+    def land_drone(self, deadline=None):
         try:
-            print("Attempting to call drone specific service...")
+            logger.debug("Attempting to call drone specific service...")
             # fake_drone_control found in srv folder. Copied directly from DJI SDK for local testing.
-            # service = roslibpy.Service(self.ROS_master_connection, 'dji_sdk/drone_task_control', 'dji_sdk/DroneTaskControl')
-            service = roslibpy.Service(self.ROS_master_connection, 'isaacs_server/fake_drone_control',
-                    'isaacs_server/FakeDroneControl')
+            # service = self.service_proxy('dji_sdk/drone_task_control', 'dji_sdk/DroneTaskControl')
+            service = self.service_proxy('isaacs_server/fake_drone_control',
+                                         'isaacs_server/FakeDroneControl', priority=True)
             request = roslibpy.ServiceRequest({"task": Drone.TaskControl.LAND})
 
-            print('Calling land_drone service...')
-            result = service.call(request)
-            print('Service response: {}'.format(result))
+            logger.debug("Calling land_drone service...")
+            result = self.call_service(service, request, deadline)
+            logger.debug("Service response: %s", summarize(result))
             if result["result"]:
+                self.forget_mission()
                 result = {"success":True, "message":"Land drone successful"}
             else:
                 result = {"success":False, "message":"Drone failed to land"}
+        except DeadlineExceeded as e:
+            result = self.timed_out(e)
         except Exception as e:
             result = {"success":False, "message":"Drone landing failed"}
-            print(e)
+            logger.warning("land_drone of drone %s failed: %s", self.id, e)
         return result
 
     # Tells Drone to Fly Home(home is predefined)
     # Makes a service call to drone_task_control in DJI SDK
     # Pass Drone.TaskControl.GO_HOME as the predefined task.
     # Returns a dictionary describing whether service call was successful
-    def fly_home(self):
+    def fly_home(self, deadline=None):
         try:
-            print("Attempting to call drone specific service...")
+            logger.debug("Attempting to call drone specific service...")
             # fake_drone_control found in srv folder. Copied directly from DJI SDK for local testing.
-            #service = roslibpy.Service(self.ROS_master_connection, 'dji_sdk/drone_task_control', 'dji_sdk/DroneTaskControl')
-            service = roslibpy.Service(self.ROS_master_connection, 'isaacs_server/fake_drone_control',
-                    'isaacs_server/FakeDroneControl')
+            #service = self.service_proxy('dji_sdk/drone_task_control', 'dji_sdk/DroneTaskControl')
+            service = self.service_proxy('isaacs_server/fake_drone_control',
+                                         'isaacs_server/FakeDroneControl', priority=True)
             request = roslibpy.ServiceRequest({"task": Drone.TaskControl.GO_HOME})
 
-            print('Calling fly_home service...')
-            result = service.call(request)
-            print('Service response: {}'.format(result))
+            logger.debug("Calling fly_home service...")
+            result = self.call_service(service, request, deadline)
+            logger.debug("Service response: %s", summarize(result))
             if result["result"]:
+                self.forget_mission()
                 result = {"success":True, "message":"Fly home successful"}
             else:
                 result = {"success":False, "message":"Drone failed to fly home"}
+        except DeadlineExceeded as e:
+            result = self.timed_out(e)
         except Exception as e:
             result = {"success":False, "message":"Drone flying home failed"}
-            print(e)
+            logger.warning("fly_home of drone %s failed: %s", self.id, e)
         return result
 
     #TODO
     def shutdown(self):
+        self.clear_service_proxies()
         result = {"success": True, "message": "Drone shutdown successful"}
         return result
         try:
-            print("Attempting to shutdown drone ...")
+            logger.debug("Attempting to shutdown drone ...")
             # TODO: No shutdown in dji_sdk, running stop mission, land, disable arm control,  for now
             result_stop_mission = self.stop_mission()
             result_land = self.land_drone()
-            service = roslibpy.Service(self.ROS_master_connection, 'dji_sdk/drone_arm_control', 'dji_sdk/DroneArmControl')
+            service = self.service_proxy('dji_sdk/drone_arm_control',
+                                         'dji_sdk/DroneArmControl')
             request = roslibpy.ServiceRequest({"arm": 0})
 
-            print('Calling disable arm control service...')
-            result = service.call(request)
-            print('Service response: {}'.format(result))
+            logger.debug("Calling disable arm control service...")
+            result = self.call_service(service, request)
+            logger.debug("Service response: %s", summarize(result))
             if result['success']:
                 # Drone arm control successfully disabled
                 result = {"success": True, "message": "Drone shutdown successful"}
+        except DeadlineExceeded as e:
+            result = self.timed_out(e)
         except:
             result = {"success":False, "message":"Drone failed to shutdown"}
         return result
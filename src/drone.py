@@ -1,7 +1,16 @@
 import roslibpy
+import time
+import waypoints as waypoint_arrays
+from deadline import DeadlineExceeded
+from server_log import get_logger
+import metrics
+from profiler import get_profiler
 from abc import ABC, abstractmethod
+from collections import namedtuple
 from enum import IntEnum
 
+logger = get_logger('drone')
+
 class Drone(ABC):
 
     class Flight_Status(IntEnum):
@@ -29,27 +38,59 @@ class Drone(ABC):
         GO_HOME = 1
         TAKEOFF = 4
 
+    # Largest number of waypoints a single mission upload may hold, or None
+    # if the vendor has no limit. Longer missions are split into segments.
+    max_mission_waypoints = None
+
+    # Seconds a service call may take when the caller gives no deadline
+    SERVICE_TIMEOUT = 10
+
+    # One service call of a multi-step command run by run_service_steps.
+    # succeeded(response) tells whether the call did what it should.
+    ServiceStep = namedtuple('ServiceStep',
+            ['description', 'name', 'service_type', 'request', 'succeeded'])
+
     def __init__(self, drone_name, drone_type, ROS_master_connection, id=None):
         self.id = id
         self.drone_type = drone_type
         self.drone_name = drone_name
         self.connection_status = False
         self.flight_status = Drone.Flight_Status.NULL
-        self.topics = []
         self.services = []
         self.sensors = []
         self.mission_msg_list = []
         self.waypoints = []
         self.waypoints_count = 0
+        # Segments of a split mission that are still waiting to be uploaded
+        self.mission_segments = []
         self.drone_namespace = '/drone_' + str(self.id)
         # define position structure as dictionary: {latitude: int, longitude: int}
         self.position = None
         self.ROS_master_connection = ROS_master_connection
+        # Separate connection for safety-critical commands (land, fly home) so
+        # they never queue behind bulk traffic; None to use the main one
+        self.priority_connection = None
         # Speed of drone in flight; default set to 5
         self.speed = 5
+        # roslibpy.Service proxies for the drone's services, created on first
+        # use and reused for every later call. Keyed on (service name, priority).
+        self.service_proxies = dict()
+        # Number of times each service proxy has been used
+        self.service_proxy_uses = dict()
+        # Number of calls to each service that timed out
+        self.service_timeouts = dict()
 
     @staticmethod
-    def create(drone_name, drone_type, ROS_master_connection, id=None):
+    def create(drone_name, drone_type, ROS_master_connection, id=None, priority_connection=None):
+        '''
+        Creates a drone of the given type.
+        Parameters:
+            ROS_master_connection: roslibpy.Ros connection for the drone's traffic
+            priority_connection: optional roslibpy.Ros connection for its
+                safety-critical commands
+        Return:
+            Drone instance, or False if the type is unknown
+        '''
         from djimatrice_drone import DjiMatriceDrone
         from mavros_drone import MavrosDrone
         drones = {
@@ -59,28 +100,332 @@ class Drone(ABC):
         if drone_type not in drones:
             return False
         else:
-            return drones.get(drone_type)(drone_name, drone_type, ROS_master_connection, id)
+            drone = drones.get(drone_type)(drone_name, drone_type, ROS_master_connection, id)
+            drone.priority_connection = priority_connection
+            return drone
+
+    def service_proxy(self, name, service_type, priority=False):
+        '''
+        Returns the roslibpy.Service for one of the drone's services,
+        creating it the first time it is needed.
+        Parameters:
+            name: full name of the service
+            service_type: service type, e.g. mavros_msgs/SetMode
+            priority: True for safety-critical commands, which are sent over
+                the priority_connection if the drone has one
+        Return:
+            roslibpy.Service
+        '''
+        priority = priority and self.priority_connection is not None
+        service = self.service_proxies.get((name, priority))
+        if service is None:
+            connection = self.priority_connection if priority else self.ROS_master_connection
+            service = roslibpy.Service(connection, name, service_type)
+            self.service_proxies[(name, priority)] = service
+        self.service_proxy_uses[name] = self.service_proxy_uses.get(name, 0) + 1
+        return service
+
+    def call_service(self, service, request, deadline=None, limit=None):
+        '''
+        Calls a service and waits for its response, for no longer than the
+        deadline allows.
+        Parameters:
+            service: roslibpy.Service from service_proxy
+            request: roslibpy.ServiceRequest
+            deadline: optional Deadline of the command making the call;
+                without one the call may take SERVICE_TIMEOUT seconds
+            limit: optional longest time this call may take anyway
+        Return:
+            the service response
+        Raises:
+            DeadlineExceeded if the service does not answer in time; it is
+            counted in service_timeouts
+        The latency and outcome of the call are recorded in the server's
+        metrics, per drone type and service, and as a span if the profiler
+        is tracing.
+        '''
+        start = time.perf_counter()
+        outcome = metrics.ERROR
+        try:
+            if deadline is None:
+                timeout = limit or Drone.SERVICE_TIMEOUT
+            else:
+                timeout = deadline.timeout(limit)
+            response = service.call(request, timeout=timeout)
+            outcome = metrics.OK
+            return response
+        except TimeoutError as e:
+            outcome = metrics.TIMEOUT
+            self.service_timeouts[service.name] = self.service_timeouts.get(service.name, 0) + 1
+            logger.warning("%s of drone %s timed out: %s", service.name, self.id, e)
+            if isinstance(e, DeadlineExceeded):
+                raise
+            raise DeadlineExceeded(f"{service.name} did not answer within {timeout:.1f} s") from e
+        finally:
+            # Without the drone's namespace, so all drones share one series
+            name = service.name
+            if name.startswith(self.drone_namespace + '/'):
+                name = name[len(self.drone_namespace):]
+            elapsed = time.perf_counter() - start
+            metrics.get_metrics().observe_drone_call(self.drone_type, name, elapsed, outcome)
+            get_profiler().span("drone", name, start, elapsed)
+
+    @staticmethod
+    def timed_out(error):
+        '''
+        Result of a command whose service call timed out.
+        Parameters:
+            error: the DeadlineExceeded raised by call_service
+        Return:
+            dictionary {
+                success: False
+                timed_out: True
+                message: descriptive string
+            }
+        '''
+        return {"success": False, "timed_out": True, "message": "Timed out: {}".format(error)}
+
+    def clear_service_proxies(self):
+        '''
+        Drops all cached service proxies, e.g. when the drone shuts down.
+        The usage counts are kept.
+        '''
+        self.service_proxies = dict()
+
+    def telemetry_kind(self, name, topic_type):
+        '''
+        Tells which of the drone's topics carry telemetry.
+        Parameters:
+            name: topic name
+            topic_type: message type of the topic
+        Return:
+            "position" for a sensor_msgs/NavSatFix position topic, "state"
+            for a topic received_state_update understands, or None
+        '''
+        return None
+
+    def received_position_update(self, message):
+        '''
+        Called with every message of the drone's position topic.
+        Parameters:
+            message: sensor_msgs/NavSatFix as a dictionary
+        '''
+        self.position = message
+
+    def received_state_update(self, message):
+        '''
+        Called with every message of the drone's state topic; drivers update
+        self.flight_status from it.
+        '''
+        pass
+
+    def split_mission(self, waypoints):
+        '''
+        Splits a mission into segments the drone can take in one upload.
+        Each segment after the first starts at the last waypoint of the
+        previous one, so the drone continues from where it stopped.
+        Parameters:
+            waypoints: List<NavSatFix msgs> or array from waypoints.to_array
+        Return:
+            list of segments of the same type as waypoints, a single
+            segment if the mission fits
+        '''
+        limit = self.max_mission_waypoints
+        if not limit or len(waypoints) <= limit:
+            return [waypoints]
+        step = limit - 1
+        return [waypoints[start:start + limit]
+                for start in range(0, len(waypoints) - 1, step)]
+
+    def start_next_segment(self, deadline=None):
+        '''
+        Uploads the next staged segment of a split mission and starts it.
+        Parameters:
+            deadline: optional Deadline bounding both service calls
+        Return:
+            dictionary {
+                success: boolean
+                message: descriptive string
+            }
+        '''
+        if not self.mission_segments:
+            return {"success": False, "message": "No mission segments left"}
+        segment = self.mission_segments[0]
+        result = self.upload_mission(segment, deadline=deadline)
+        if not result["success"]:
+            return result
+        self.mission_segments.pop(0)
+        # The drone now holds only this segment, which later updates compare against
+        self.waypoints = segment
+        result = self.start_mission(deadline=deadline)
+        if result["success"]:
+            result = {"success": True, "message": "Started next mission segment, {} left".format(len(self.mission_segments))}
+        return result
+
+    def forget_mission(self):
+        '''
+        Forgets the mission last uploaded and the segments staged after it.
+        Drivers call this once the drone no longer flies the mission (it was
+        stopped, or the drone lands or flies home), so that sending the same
+        mission again uploads it instead of being skipped as unchanged.
+        '''
+        self.waypoints = []
+        self.mission_segments = []
+
+    def plan_mission_update(self, waypoints):
+        '''
+        Compares a mission with the one last uploaded to the drone and picks
+        how to apply it:
+            CONTINUE_MISSION if nothing changed,
+            END_AND_HOVER if the new mission is empty,
+            UPDATE_CURRENT_MISSION otherwise.
+        Parameters:
+            waypoints: List<NavSatFix msgs> or array from waypoints.to_array
+        Return:
+            (Drone.UpdateMissionAction, changed) where changed is an array of
+            the indices of the waypoints that differ, or None if the
+            missions have different lengths
+        '''
+        changed = waypoint_arrays.changed_indices(
+                waypoint_arrays.to_array(self.waypoints), waypoint_arrays.to_array(waypoints))
+        if changed is not None and not changed.size:
+            return Drone.UpdateMissionAction.CONTINUE_MISSION, changed
+        if len(waypoints) == 0:
+            return Drone.UpdateMissionAction.END_AND_HOVER, changed
+        return Drone.UpdateMissionAction.UPDATE_CURRENT_MISSION, changed
+
+    def update_mission(self, waypoints, deadline=None):
+        '''
+        Applies a re-planned mission, uploading only what is needed: nothing
+        if the mission is unchanged, a stop if it is empty, and otherwise the
+        changes through upload_mission_changes.
+        Parameters:
+            waypoints: List<NavSatFix msgs> or array from waypoints.to_array
+            deadline: optional Deadline of the upload
+        Return:
+            dictionary {
+                success: boolean
+                message: descriptive string
+                update_action: Drone.UpdateMissionAction that was taken
+            }
+        '''
+        update_action, changed = self.plan_mission_update(waypoints)
+        if update_action == Drone.UpdateMissionAction.CONTINUE_MISSION:
+            result = {"success": True, "message": "Mission unchanged, upload skipped"}
+        elif update_action == Drone.UpdateMissionAction.END_AND_HOVER:
+            result = self.stop_mission(deadline=deadline)
+        else:
+            result = self.upload_mission_changes(waypoints, changed, deadline=deadline)
+        result["update_action"] = update_action
+        return result
+
+    def upload_mission_changes(self, waypoints, changed, deadline=None):
+        '''
+        Uploads a changed mission. Uploads the whole mission; drivers whose
+        vendor can update part of a mission override this.
+        Parameters:
+            waypoints: the complete new mission, as for update_mission
+            changed: array of the indices of the changed waypoints, or None
+                if the mission length changed
+            deadline: optional Deadline of the upload
+        Return:
+            dictionary {
+                success: boolean
+                message: descriptive string
+            }
+        '''
+        return self.upload_mission(waypoints, deadline=deadline)
+
+    def run_service_steps(self, steps, timeout, retries=0, backoff=0.5, on_step=None, deadline=None):
+        '''
+        Calls a sequence of services, one after another. Every call is bounded
+        by timeout. A step that times out, raises or does not succeed is
+        retried up to retries more times, waiting backoff seconds before the
+        first retry and twice as long before each following one. If a step
+        still fails the remaining steps are skipped. Nothing is retried once
+        the deadline has passed.
+        Parameters:
+            steps: List<Drone.ServiceStep>
+            timeout: seconds each service call may take
+            retries: number of times a failed step is retried
+            backoff: seconds to wait before the first retry
+            on_step: optional callable invoked with a dictionary {
+                step: description of the step
+                attempt: 1 for the first try of the step
+                success: boolean
+                latency: seconds the attempt took
+                message: descriptive string
+            } after every attempt
+            deadline: optional Deadline of the whole sequence
+        Return:
+            dictionary {
+                success: boolean
+                timed_out: True if the failed step timed out
+                message: descriptive string
+                latencies: List<(description, seconds)> of the last attempt
+                    of each step that ran
+            }
+        '''
+        latencies = []
+        for step in steps:
+            delay = backoff
+            for attempt in range(1, retries + 2):
+                start = time.monotonic()
+                timed_out = False
+                try:
+                    service = self.service_proxy(step.name, step.service_type)
+                    response = self.call_service(service, roslibpy.ServiceRequest(step.request),
+                                                 deadline, limit=timeout)
+                    success = bool(step.succeeded(response))
+                    message = f"{step.description} {'succeeded' if success else 'failed'}"
+                except DeadlineExceeded as e:
+                    success, timed_out = False, True
+                    message = f"{step.description} timed out: {e}"
+                except Exception as e:
+                    success = False
+                    message = f"{step.description} failed: {e or type(e).__name__}"
+                latency = time.monotonic() - start
+                if on_step:
+                    on_step({"step": step.description, "attempt": attempt,
+                             "success": success, "latency": latency, "message": message})
+                if success or attempt > retries:
+                    break
+                if deadline is not None and deadline.remaining() <= delay:
+                    timed_out = True
+                    break
+                time.sleep(delay)
+                delay *= 2
+            latencies.append((step.description, latency))
+            if not success:
+                return {"success": False, "timed_out": timed_out, "message": message,
+                        "latencies": latencies}
+        return {"success": True, "message": "All steps succeeded", "latencies": latencies}
 
     @abstractmethod
-    def upload_mission(self, waypoints):
+    def upload_mission(self, waypoints, deadline=None):
         '''
-        Uploads list of waypoints for drone to follow
+        Uploads list of waypoints for drone to follow. On success the
+        waypoints are kept in self.waypoints as the last uploaded mission.
         Parameters:
-            waypoints: List<NavSatFix msgs>
+            waypoints: List<NavSatFix msgs> or array from waypoints.to_array
+            deadline: optional Deadline bounding the service calls
         Return:
             dictionary {
                 success: boolean
                 message: descriptive string
             }
+            with timed_out set to True if a service call timed out (see
+            Drone.timed_out); the same goes for the other commands
         '''
         pass
 
     @abstractmethod
-    def set_speed(self, speed):
+    def set_speed(self, speed, deadline=None):
         '''
         Sets the speed of the drone
         Parameters:
             speed: float32 representing speed to set
+            deadline: optional Deadline bounding the service call
         Return:
             dictionary {
                 success: boolean
@@ -90,10 +435,11 @@ class Drone(ABC):
         pass
 
     @abstractmethod
-    def get_speed(self, speed):
+    def get_speed(self, deadline=None):
         '''
         Sets the speed of the drone
         Parameters:
+            deadline: optional Deadline bounding the service call
         Return:
             dictionary {
                 speed: float32 representing speed gotten
@@ -104,11 +450,13 @@ class Drone(ABC):
         pass
 
     @abstractmethod
-    def start_mission(self):
+    def start_mission(self, on_step=None, deadline=None):
         '''
         Starts waypoint mission
         Parameters:
-            None
+            on_step: optional callable reporting the progress of each step
+                of the start sequence, see run_service_steps
+            deadline: optional Deadline bounding the service calls
         Return:
             dictionary {
                 success: boolean
@@ -118,11 +466,11 @@ class Drone(ABC):
         pass
 
     @abstractmethod
-    def pause_mission(self):
+    def pause_mission(self, deadline=None):
         '''
         Pauses current mission
         Parameters:
-            None
+            deadline: optional Deadline bounding the service call
         Return:
             dictionary {
                 success: boolean
@@ -132,11 +480,11 @@ class Drone(ABC):
         pass
 
     @abstractmethod
-    def resume_mission(self):
+    def resume_mission(self, deadline=None):
         '''
         Resumes current mission
         Parameters:
-            None
+            deadline: optional Deadline bounding the service call
         Return:
             dictionary {
                 success: boolean
@@ -146,11 +494,11 @@ class Drone(ABC):
         pass
 
     @abstractmethod
-    def land_drone(self):
+    def land_drone(self, deadline=None):
         '''
         Commands the drone to land
         Parameters:
-            None
+            deadline: optional Deadline bounding the service call
         Return:
             dictionary {
                 success: boolean
@@ -160,11 +508,11 @@ class Drone(ABC):
         pass
 
     @abstractmethod
-    def fly_home(self):
+    def fly_home(self, deadline=None):
         '''
         Commands the drone to fly home
         Parameters:
-            None
+            deadline: optional Deadline bounding the service call
         Return:
             dictionary {
                 success: boolean
@@ -0,0 +1,91 @@
+import threading
+from change_log import ChangeLog
+
+class FleetSnapshot:
+    '''
+    Versioned view of the registered drones, kept in the shape of the
+    isaacs_server/Drone[] list returned by the all_drones_available service.
+
+    The operator updates the snapshot one drone at a time whenever a drone is
+    registered, saves its topics or is shut down, so answering
+    all_drones_available does not have to walk every drone and copy its
+    topic lists. Every change increments the version, and the change log lets
+    clients that already hold an older version fetch only what changed.
+    '''
+
+    def __init__(self):
+        self._log = ChangeLog()
+        self._entries = dict() # Map between drone IDs and Drone.msg dicts
+        self._drones_available = []
+        self._stale = False
+        self._lock = threading.Lock()
+
+    def update_drone(self, drone, topics):
+        '''
+        Adds the drone to the snapshot, or refreshes its entry if it is
+        already in it.
+
+        :param drone: Drone instance with its id set
+        :param topics: list of {name, type} dicts of the drone's topics
+        '''
+        entry = {
+                "id" : drone.id,
+                "name" : drone.drone_name,
+                "type" : drone.drone_type,
+                "topics" : topics,
+                "services" : list(drone.services)
+        }
+        with self._lock:
+            self._entries[drone.id] = entry
+            self._changed(drone.id)
+
+    def remove_drone(self, drone_id):
+        '''
+        Removes the drone from the snapshot. Unknown ids are ignored.
+        '''
+        with self._lock:
+            if self._entries.pop(drone_id, None) is not None:
+                self._changed(drone_id)
+
+    def clear(self):
+        with self._lock:
+            for drone_id in list(self._entries):
+                del self._entries[drone_id]
+                self._changed(drone_id)
+
+    @property
+    def version(self):
+        return self._log.version
+
+    def drones_available(self):
+        '''
+        returns: (version, list of Drone.msg dicts)
+        The returned list is shared between callers and must not be modified.
+        '''
+        with self._lock:
+            if self._stale:
+                self._drones_available = list(self._entries.values())
+                self._stale = False
+            return self.version, self._drones_available
+
+    def changes_since(self, since_version):
+        '''
+        Returns what changed after the version a client last saw.
+
+        :param since_version: version from an earlier response
+        returns: (version, full, updated, removed) where updated is a list of
+        Drone.msg dicts of added or changed drones and removed is a list of
+        ids of drones that are gone. If the change log does not reach back
+        to since_version, full is True and updated holds every drone.
+        '''
+        with self._lock:
+            changed = self._log.changed_since(since_version)
+            if changed is None:
+                return self.version, True, list(self._entries.values()), []
+            updated = [self._entries[i] for i in changed if i in self._entries]
+            removed = [i for i in changed if i not in self._entries]
+            return self.version, False, updated, removed
+
+    def _changed(self, drone_id):
+        self._log.record(drone_id)
+        self._stale = True
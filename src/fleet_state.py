@@ -0,0 +1,160 @@
+import math
+import time
+import roslibpy
+from server_log import get_logger
+
+logger = get_logger('fleet_state')
+
+# Bits of DroneTelemetry.changed
+POSITION = 1
+FLIGHT_STATUS = 2
+
+# Meters per degree of latitude
+METERS_PER_DEGREE = 111320.0
+
+class FleetStatePublisher:
+    '''
+    Publishes the position and flight status of every drone as a single
+    isaacs_server/FleetState topic, so VR clients subscribe to one stream
+    instead of to the raw topics of every drone.
+
+    The state is sampled at a fixed rate. A drone is only included when one
+    of its fields changed (positions by more than position_tolerance meters),
+    and nothing is published while no drone changes. Every keyframe_interval
+    seconds a keyframe with every drone is published, so clients that just
+    subscribed or missed a message catch up.
+
+    With encoding 'packed' (or 'both') the same state is also published as
+    isaacs_server/FleetStatePacked on topic + '_packed', which holds parallel
+    arrays instead of one message per drone. Each client picks the topic it
+    subscribes to, and can ask rosbridge for cbor compression to receive
+    the packed arrays in binary.
+    '''
+
+    def __init__(self, ros, telemetry, get_drones, rate=10, keyframe_interval=5,
+            position_tolerance=0.1, topic='/isaacs_server/fleet_state', encoding='dicts'):
+        '''
+        :param ros: roslibpy.Ros connection
+        :param telemetry: Telemetry holding the drones' positions
+        :param get_drones: callable returning the dict of registered drones
+        :param rate: messages per second at most
+        :param keyframe_interval: seconds between keyframes
+        :param position_tolerance: meters a drone must move to be sent again
+        :param topic: name of the topic
+        :param encoding: 'dicts', 'packed' or 'both'
+        '''
+        self.ros = ros
+        self.telemetry = telemetry
+        self.get_drones = get_drones
+        self.period = 1.0 / rate
+        self.keyframe_interval = keyframe_interval
+        self.position_tolerance = position_tolerance
+        self.publishers = []
+        if encoding in ('dicts', 'both'):
+            self.publishers.append((roslibpy.Topic(ros, topic, 'isaacs_server/FleetState'), None))
+        if encoding in ('packed', 'both'):
+            self.publishers.append((roslibpy.Topic(ros, topic + '_packed',
+                    'isaacs_server/FleetStatePacked'), FleetStatePublisher.pack))
+        self.seq = 0
+        self._sent = dict() # Map between drone IDs and last sent DroneTelemetry
+        self._last_keyframe = None
+
+    def start(self):
+        for publisher, _ in self.publishers:
+            publisher.advertise()
+        self.ros.call_later(self.period, self._periodic_publish)
+
+    def request_keyframe(self):
+        '''
+        Makes the next message a keyframe, e.g. after a reconnect.
+        '''
+        self._last_keyframe = None
+
+    def sample(self, now=None):
+        '''
+        Builds the next FleetState message and records it as sent.
+
+        returns: FleetState message as a dict, or None if nothing changed and
+        no keyframe is due
+        '''
+        now = time.time() if now is None else now
+        keyframe = (self._last_keyframe is None
+                or now - self._last_keyframe >= self.keyframe_interval)
+        positions = self.telemetry.latest_positions()
+        drones = self.get_drones()
+        entries = []
+        for drone_id, drone in list(drones.items()):
+            entry = {"id": drone_id, "changed": 0, "latitude": 0.0, "longitude": 0.0,
+                     "altitude": 0.0, "flight_status": int(drone.flight_status)}
+            position = positions.get(drone_id)
+            if position is not None:
+                entry["latitude"] = float(position["latitude"])
+                entry["longitude"] = float(position["longitude"])
+                entry["altitude"] = float(position["altitude"])
+            sent = self._sent.get(drone_id)
+            if sent is None or keyframe:
+                entry["changed"] = POSITION | FLIGHT_STATUS
+            else:
+                if self._moved(sent, entry):
+                    entry["changed"] |= POSITION
+                if sent["flight_status"] != entry["flight_status"]:
+                    entry["changed"] |= FLIGHT_STATUS
+                if not entry["changed"]:
+                    continue
+                if not entry["changed"] & POSITION:
+                    # Keep comparing against the last position clients got
+                    for field in ("latitude", "longitude", "altitude"):
+                        entry[field] = sent[field]
+            self._sent[drone_id] = entry
+            entries.append(entry)
+        removed = [drone_id for drone_id in self._sent if drone_id not in drones]
+        for drone_id in removed:
+            del self._sent[drone_id]
+        if not entries and not removed and not keyframe:
+            return None
+        if keyframe:
+            self._last_keyframe = now
+        self.seq += 1
+        return {"seq": self.seq, "stamp": now, "keyframe": keyframe,
+                "drones": entries, "removed": removed}
+
+    @staticmethod
+    def pack(message):
+        '''
+        :param message: FleetState message as a dict
+        returns: the same state as a FleetStatePacked message dict
+        '''
+        drones = message["drones"]
+        positions = []
+        for entry in drones:
+            positions += (entry["latitude"], entry["longitude"], entry["altitude"])
+        return {"seq": message["seq"], "stamp": message["stamp"],
+                "keyframe": message["keyframe"],
+                "ids": [entry["id"] for entry in drones],
+                "changed": [entry["changed"] for entry in drones],
+                "flight_statuses": [entry["flight_status"] for entry in drones],
+                "positions": positions, "removed": message["removed"]}
+
+    def _moved(self, sent, entry):
+        # Distance on a local flat projection; plenty for a 0.1 m scale check
+        north = (entry["latitude"] - sent["latitude"]) * METERS_PER_DEGREE
+        east = ((entry["longitude"] - sent["longitude"]) * METERS_PER_DEGREE
+                * math.cos(math.radians(entry["latitude"])))
+        up = entry["altitude"] - sent["altitude"]
+        return north * north + east * east + up * up > self.position_tolerance ** 2
+
+    def _periodic_publish(self):
+        # Messages published while disconnected would be queued and all sent
+        # at once after the reconnect; the keyframe that follows a reconnect
+        # makes them unnecessary
+        if not self.ros.is_connected:
+            self.ros.call_later(self.period, self._periodic_publish)
+            return
+        try:
+            message = self.sample()
+            if message is not None:
+                for publisher, encode in self.publishers:
+                    publisher.publish(roslibpy.Message(encode(message) if encode else message))
+        except Exception as e:
+            logger.warning("Failed to publish fleet state: %s", e)
+        self.ros.call_later(self.period, self._periodic_publish)
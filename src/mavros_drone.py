@@ -1,8 +1,13 @@
 import roslibpy
 import numpy as np
+import waypoints as waypoint_arrays
+from deadline import DeadlineExceeded
 from drone import Drone
+from server_log import get_logger, summarize
 from enum import Enum
 
+logger = get_logger('mavros_drone')
+
 class MavrosDrone(Drone):
 
     drone_type = "Mavros"
@@ -32,22 +37,50 @@ class MavrosDrone(Drone):
         self.position= None
         self.prev_flight_status = Drone.Flight_Status.NULL
 
+    # Maps MAVROS flight modes to the Flight_Status of an armed drone
+    MODE_FLIGHT_STATUS = {
+        "AUTO": Drone.Flight_Status.FLYING,
+        "AUTO.MISSION": Drone.Flight_Status.FLYING,
+        "RTL": Drone.Flight_Status.FLYING_HOME,
+        "AUTO.RTL": Drone.Flight_Status.FLYING_HOME,
+        "LAND": Drone.Flight_Status.LANDING,
+        "AUTO.LAND": Drone.Flight_Status.LANDING,
+        "GUIDED": Drone.Flight_Status.PAUSED_IN_AIR
+    }
+
+    def telemetry_kind(self, name, topic_type):
+        if topic_type == "sensor_msgs/NavSatFix" and name.endswith("/mavros/global_position/global"):
+            return "position"
+        if topic_type == "mavros_msgs/State":
+            return "state"
+        return None
+
     def received_position_update(self, message):
         self.position= message
 
+    # Takes a mavros_msgs/State message
+    def received_state_update(self, message):
+        self.connection_status = message["connected"]
+        if not message["armed"]:
+            self.flight_status = Drone.Flight_Status.ON_GROUND_STANDBY
+        else:
+            self.flight_status = MavrosDrone.MODE_FLIGHT_STATUS.get(
+                message["mode"], Drone.Flight_Status.IN_AIR_STANDBY)
+
     # Takes a list of waypoints for drone to follow
     # Converts waypoints to MAVROS compattible format
     # Makes a service call to MAVROS mavros_msgs/WaypointPush
     # Returns dictionary describing if service call was successful
-    def upload_mission(self, waypoints):
-        self.waypoints = waypoints
+    def upload_mission(self, waypoints, deadline=None):
+        columns = waypoint_arrays.columns(waypoints)
+        invalid = waypoint_arrays.invalid_indices(columns)
+        if invalid.size:
+            return {"success": False,
+                    "message": "Invalid waypoints at indices {}".format(invalid.tolist())}
 
         # Converts all the NavSatFix messages to Waypoint so that
         # they're MAVROS compatible
-        converted_waypoint_objects = []
-        for navsatfix in waypoints:
-            converted_waypoint_objects.append(
-                self.convert_navsatfix_mavroswaypoint(navsatfix))
+        converted_waypoint_objects = self.convert_waypoints(columns)
 
         # Two takeoff commands prepended to the waypoint list for safety
         # converted_waypoint_objects = 2 * [
@@ -58,40 +91,92 @@ class MavrosDrone(Drone):
         #     'y_long': self.position['longitude'],
         #     'z_alt': 10}
         #     ] + converted_waypoint_objects
-        print(converted_waypoint_objects)
+        logger.debug("Converted %s waypoints", len(converted_waypoint_objects))
 
         try:
-            print("Attempting to upload mission...")
-            service = roslibpy.Service(self.ROS_master_connection,
-                                       self.drone_namespace + '/mavros/mission/push',
-                                       'mavros_msgs/WaypointPush')
+            logger.debug("Attempting to upload mission...")
+            service = self.service_proxy(self.drone_namespace + '/mavros/mission/push',
+                                         'mavros_msgs/WaypointPush')
             request = roslibpy.ServiceRequest(
                 {'waypoints': converted_waypoint_objects})
 
-            print('Calling /mavros/mission/push service...')
-            result = service.call(request)
-            print('Service response: {}'.format(result))
+            logger.debug("Calling /mavros/mission/push service...")
+            result = self.call_service(service, request, deadline)
+            logger.debug("Service response: %s", summarize(result))
             if result['success']:
+                self.waypoints = waypoints
                 result = {"success": True, "message": "Mission uploaded"}
             else:
                 result = {"success": False, "message": "Mission failed to uploaded"}
+        except DeadlineExceeded as e:
+            result = self.timed_out(e)
         except:
             result = {"success": False,
                       "message": "Failed to upload waypoints"}
 
         return result
 
+    # Uploads only the changed part of a mission of unchanged length
+    # WaypointPush with a start_index above 0 overwrites the waypoints from
+    # start_index on in place, without clearing the rest of the mission.
+    # Returns dictionary describing if service call was successful
+    def upload_mission_changes(self, waypoints, changed, deadline=None):
+        # start_index 0 means a full push, so a change to the first waypoint
+        # (or to the mission length) needs the whole mission
+        if changed is None or changed[0] == 0:
+            return self.upload_mission(waypoints, deadline)
+        start, end = int(changed[0]), int(changed[-1]) + 1
+        columns = waypoint_arrays.columns(waypoints[start:end])
+        invalid = waypoint_arrays.invalid_indices(columns)
+        if invalid.size:
+            return {"success": False,
+                    "message": "Invalid waypoints at indices {}".format((invalid + start).tolist())}
+        try:
+            logger.debug("Attempting to update waypoints %s to %s...", start, end - 1)
+            service = self.service_proxy(self.drone_namespace + '/mavros/mission/push',
+                                         'mavros_msgs/WaypointPush')
+            request = roslibpy.ServiceRequest(
+                {'start_index': start, 'waypoints': self.convert_waypoints(columns)})
+
+            logger.debug("Calling /mavros/mission/push service...")
+            result = self.call_service(service, request, deadline)
+            logger.debug("Service response: %s", summarize(result))
+            if result['success']:
+                self.waypoints = waypoints
+                result = {"success": True,
+                          "message": "Mission waypoints {} to {} updated".format(start, end - 1)}
+            else:
+                result = {"success": False, "message": "Mission failed to update"}
+        except DeadlineExceeded as e:
+            result = self.timed_out(e)
+        except:
+            result = {"success": False, "message": "Failed to update waypoints"}
+        return result
+
+    # Fields of a mavros_msgs/Waypoint that are the same for every waypoint
+    WAYPOINT_TEMPLATE = {'frame': FRAME_REFERENCE.RELATIVE_ALT.value,
+                         'command': MAV_CMD.NAVIGATE_TO_WAYPOINT.value,
+                         'is_current': False, 'autocontinue': True, 'param1': 0,
+                         'param2': 0, 'param3': 0}
+
     # Helper method for upload_mission()
+    # Converts a whole mission to mavros friendly format
+    def convert_waypoints(self, waypoints):
+        '''
+        Takes in a list of NavSatFix messages, an array from
+        waypoints.to_array or columns from waypoints.columns, and returns a
+        list of mavros_msgs/Waypoint messages as dictionaries.
+        '''
+        return waypoint_arrays.emit(waypoints, MavrosDrone.WAYPOINT_TEMPLATE,
+                                    'x_lat', 'y_long', 'z_alt')
+
     # Converts the given waypoints in NavSatFix format and converts to mavros friendly format
     def convert_navsatfix_mavroswaypoint(self, navsatfix):
         '''
         Takes in a NavSatFix message and returns a
         mavros_msgs/Waypoint message as a dictionary.
         '''
-        waypoint = {'frame': MavrosDrone.FRAME_REFERENCE.RELATIVE_ALT.value,
-                    'command': MavrosDrone.MAV_CMD.NAVIGATE_TO_WAYPOINT.value,
-                    'is_current': False, 'autocontinue': True, 'param1': 0,
-                    'param2': 0, 'param3': 0, 'x_lat': navsatfix['latitude'],
+        waypoint = {**MavrosDrone.WAYPOINT_TEMPLATE, 'x_lat': navsatfix['latitude'],
                     'y_long': navsatfix['longitude'],
                     'z_alt': navsatfix['altitude']}
 
@@ -100,90 +185,87 @@ class MavrosDrone(Drone):
     # Takes a float32 numbers as the speed to set drone to
     # Makes a service call to MAVROS mavros_msgs/CommandLong
     # Returns dictionary describing if service call was successful
-    def set_speed(self, speed):
+    def set_speed(self, speed, deadline=None):
         try:
-            print("Attempting to set speed...")
-            service = roslibpy.Service(self.ROS_master_connection,
-                                       self.drone_namespace + '/mavros/cmd/command',
-                                       'mavros_msgs/CommandLong')
+            logger.debug("Attempting to set speed...")
+            service = self.service_proxy(self.drone_namespace + '/mavros/cmd/command',
+                                         'mavros_msgs/CommandLong')
             request = roslibpy.ServiceRequest(
                 {"command": MavrosDrone.MAV_CMD.SET_SPEED.value,
                  "param1": 0, "param2": speed, "param3": -1, "param4": 0})
-            print('Calling mission_waypoint_setSpeed service...')
-            result = service.call(request)
-            print('Service response: {}'.format(result))
+            logger.debug("Calling mission_waypoint_setSpeed service...")
+            result = self.call_service(service, request, deadline)
+            logger.debug("Service response: %s", summarize(result))
+        except DeadlineExceeded as e:
+            result = self.timed_out(e)
         except:
             result = {"success": False,
                       "message": "Failed to set new drone speed"}
         return result
 
-    def get_speed(self):
+    def get_speed(self, deadline=None):
         raise NotImplementedError
 
+    # Seconds each service call of start_mission may take, how often a failed
+    # call is retried and how long to wait before the first retry
+    START_STEP_TIMEOUT = 5
+    START_STEP_RETRIES = 2
+    START_STEP_BACKOFF = 0.5
+
     # Starts a Waypoint Mission
-    # Makes appropriate MAVROS Service calls that lead to start_mission and takeoff 
+    # Makes appropriate MAVROS Service calls that lead to start_mission and takeoff:
+    # set_mode LOITER, arm, takeoff, then set_mode AUTO. Each call is bounded
+    # by START_STEP_TIMEOUT and by the deadline, and retried with backoff; the
+    # sequence stops at the first step that keeps failing.
     # Returns dictionary describing if service call was successful
-    def start_mission(self):
-        try:
-            print("Attempting to set to loiter...")
-            guided_service = roslibpy.Service(self.ROS_master_connection,
-                                              self.drone_namespace + '/mavros/set_mode',
-                                              'mavros_msgs/SetMode')
-            guided_request = roslibpy.ServiceRequest({"custom_mode": "LOITER"})
-            guided_service.call(guided_request)
-
-            print("Attempting to arm...")
-            arm_service = roslibpy.Service(self.ROS_master_connection,
-                                           self.drone_namespace + '/mavros/cmd/arming',
-                                           'mavros_msgs/CommandBool')
-            arm_request = roslibpy.ServiceRequest({'value': True})
-            arm_service.call(arm_request)
-
-            print("Attempting to takeoff...")
-            takeoff_service = roslibpy.Service(self.ROS_master_connection,
-                                               self.drone_namespace + '/mavros/cmd/takeoff',
-                                               'mavros_msgs/CommandTOL')
-            takeoff_request = roslibpy.ServiceRequest({'altitude': 3})
-            takeoff_service.call(takeoff_request)
-
-            mission_start_service = roslibpy.Service(
-                self.ROS_master_connection,
-                self.drone_namespace + '/mavros/set_mode',
-                'mavros_msgs/SetMode')
-            mission_start_request = roslibpy.ServiceRequest(
-                {"custom_mode": "AUTO"})
-            print('Calling mission_waypoint_action start service...')
-            result = mission_start_service.call(mission_start_request)
-            print('Service response: {}'.format(result))
-            if result['mode_sent']:
-                self.prev_flight_status = Drone.Flight_Status.FLYING
-                result = {"success": True, "message": "Mission starting"}
-            else:
-                result = {"success": False, "message": "Mission failed to start"}
-        except:
-            result = {"success": False, "message": "Mission failed to start"}
-        return result
+    def start_mission(self, on_step=None, deadline=None):
+        logger.debug("Attempting to start mission...")
+        steps = [
+            Drone.ServiceStep("set_mode LOITER", self.drone_namespace + '/mavros/set_mode',
+                              'mavros_msgs/SetMode', {"custom_mode": "LOITER"},
+                              lambda response: response['mode_sent']),
+            Drone.ServiceStep("arm", self.drone_namespace + '/mavros/cmd/arming',
+                              'mavros_msgs/CommandBool', {'value': True},
+                              lambda response: response['success']),
+            Drone.ServiceStep("takeoff", self.drone_namespace + '/mavros/cmd/takeoff',
+                              'mavros_msgs/CommandTOL', {'altitude': 3},
+                              lambda response: response['success']),
+            Drone.ServiceStep("set_mode AUTO", self.drone_namespace + '/mavros/set_mode',
+                              'mavros_msgs/SetMode', {"custom_mode": "AUTO"},
+                              lambda response: response['mode_sent'])
+        ]
+        result = self.run_service_steps(steps, MavrosDrone.START_STEP_TIMEOUT,
+                                         MavrosDrone.START_STEP_RETRIES,
+                                         MavrosDrone.START_STEP_BACKOFF, on_step, deadline)
+        logger.debug("Step latencies: %s", result['latencies'])
+        if result['success']:
+            self.prev_flight_status = Drone.Flight_Status.FLYING
+            return {"success": True, "message": "Mission starting"}
+        return {"success": False, "timed_out": result['timed_out'],
+                "message": "Mission failed to start: " + result['message']}
 
     # Stops a Waypoint Mission
     # Makes a service call to MAVROS mavros_msgs/WaypointClear
     # Returns dictionary describing if service call was successful
-    def stop_mission(self):
+    def stop_mission(self, deadline=None):
         try:
-            print("Attempting to stop drone mission...")
-            service = roslibpy.Service(self.ROS_master_connection,
-                                       self.drone_namespace + '/mavros/mission/clear',
-                                       'mavros_msgs/WaypointClear')
+            logger.debug("Attempting to stop drone mission...")
+            service = self.service_proxy(self.drone_namespace + '/mavros/mission/clear',
+                                         'mavros_msgs/WaypointClear')
             request = roslibpy.ServiceRequest()
 
-            print('Calling mission_waypoint_action stop service...')
-            result = service.call(request)
-            print('Service response: {}'.format(result))
+            logger.debug("Calling mission_waypoint_action stop service...")
+            result = self.call_service(service, request, deadline)
+            logger.debug("Service response: %s", summarize(result))
 
-            if result['mode_sent']:
+            if result['success']:
                 self.prev_flight_status = Drone.Flight_Status.IN_AIR_STANDBY
+                self.forget_mission()
                 result = {"success": True, "message": "Mission stopped"}
             else:
                 result = {"success": False, "message": "Mission failed to stop"}
+        except DeadlineExceeded as e:
+            result = self.timed_out(e)
         except:
             result = {"success": False, "message": "Mission failed to stop"}
         return result
@@ -191,23 +273,24 @@ class MavrosDrone(Drone):
     # Pauses a Waypoint Mission
     # Makes a service call to MAVROS mavros_msgs/SetMode and sets it to GUIDED
     # Returns dictionary describing if service call was successful
-    def pause_mission(self):
+    def pause_mission(self, deadline=None):
         try:
-            print("Attempting to pause drone mission...")
-            service = roslibpy.Service(self.ROS_master_connection,
-                                       self.drone_namespace + '/mavros/set_mode',
-                                       'mavros_msgs/SetMode')
+            logger.debug("Attempting to pause drone mission...")
+            service = self.service_proxy(self.drone_namespace + '/mavros/set_mode',
+                                         'mavros_msgs/SetMode')
             request = roslibpy.ServiceRequest({"custom_mode": "GUIDED"})
 
-            print('Calling pause mission service...')
-            result = service.call(request)
-            print('Service response: {}'.format(result))
+            logger.debug("Calling pause mission service...")
+            result = self.call_service(service, request, deadline)
+            logger.debug("Service response: %s", summarize(result))
 
             if result['mode_sent']:
                 self.prev_flight_status = Drone.Flight_Status.PAUSED_IN_AIR
                 result = {"success": True, "message": "Mission paused"}
             else:
                 result = {"success": False, "message": "Mission failed to pause"}
+        except DeadlineExceeded as e:
+            result = self.timed_out(e)
         except:
             result = {"success": False, "message": "Mission failed to pause"}
         return result
@@ -215,23 +298,24 @@ class MavrosDrone(Drone):
     # Resumes a Waypoint Mission
     # Makes a service call to MAVROS mavros_msgs/SetMode
     # Returns dictionary describing if service call was successful
-    def resume_mission(self):
+    def resume_mission(self, deadline=None):
         try:
-            print("Attempting to resume drone mission...")
-            service = roslibpy.Service(self.ROS_master_connection,
-                                       self.drone_namespace + '/mavros/set_mode',
-                                       'mavros_msgs/SetMode')
+            logger.debug("Attempting to resume drone mission...")
+            service = self.service_proxy(self.drone_namespace + '/mavros/set_mode',
+                                         'mavros_msgs/SetMode')
             request = roslibpy.ServiceRequest({"custom_mode": "AUTO"})
 
-            print('Calling mission_waypoint_action resume service...')
-            result = service.call(request)
-            print('Service response: {}'.format(result))
+            logger.debug("Calling mission_waypoint_action resume service...")
+            result = self.call_service(service, request, deadline)
+            logger.debug("Service response: %s", summarize(result))
 
             if result['mode_sent']:
                 self.prev_flight_status = Drone.Flight_Status.FLYING
                 result = {"success": True, "message": "Mission resuming"}
             else:
                 result = {"success": False, "message": "Mission failed to resume"}
+        except DeadlineExceeded as e:
+            result = self.timed_out(e)
         except:
             result = {"success": False, "message": "Mission failed to resume"}
         return result
@@ -239,22 +323,24 @@ class MavrosDrone(Drone):
     # Tells Drone to Land
     # Makes a service call to MAVROS mavros_msgs/WaypointClear
     # Returns dictionary describing if service call was successful
-    def land_drone(self):
+    def land_drone(self, deadline=None):
         try:
-            print("Attempting to call mavros drone specific service...")
-            service = roslibpy.Service(self.ROS_master_connection,
-                                       self.drone_namespace + '/mavros/cmd/land',
-                                       'mavros_msgs/CommandTOL')
+            logger.debug("Attempting to call mavros drone specific service...")
+            service = self.service_proxy(self.drone_namespace + '/mavros/cmd/land',
+                                         'mavros_msgs/CommandTOL', priority=True)
             request = roslibpy.ServiceRequest()
 
-            print('Calling mavros_land_drone service...')
-            result = service.call(request)
-            print('Service response: {}'.format(result))
-            if result['mode_sent']:
+            logger.debug("Calling mavros_land_drone service...")
+            result = self.call_service(service, request, deadline)
+            logger.debug("Service response: %s", summarize(result))
+            if result['success']:
                 self.prev_flight_status = Drone.Flight_Status.LANDING
+                self.forget_mission()
                 result = {"success": True, "message": "Drone lading"}
             else:
                 result = {"success": False, "message": "Drone failed to land"}
+        except DeadlineExceeded as e:
+            result = self.timed_out(e)
         except:
             result = {"success": False, "message": "Drone landing failed"}
         return result
@@ -262,23 +348,24 @@ class MavrosDrone(Drone):
     # Tells Drone to fly-home(home is predefined)
     # Makes a service call to MAVROS mavros_msgs/SetMode
     # Returns dictionary describing if service call was successful
-    def fly_home(self):
-        print(self.drone_namespace + '/mavros/set_mode')
+    def fly_home(self, deadline=None):
         try:
-            print("Attempting to make drone fly_home...")
-            service = roslibpy.Service(self.ROS_master_connection,
-                                       self.drone_namespace + '/mavros/set_mode',
-                                       'mavros_msgs/SetMode')
+            logger.debug("Attempting to make drone fly_home...")
+            service = self.service_proxy(self.drone_namespace + '/mavros/set_mode',
+                                         'mavros_msgs/SetMode', priority=True)
             request = roslibpy.ServiceRequest({"custom_mode": "RTL"})
 
-            print('Calling fly_home service...')
-            result = service.call(request)
-            print('Service response: {}'.format(result))
+            logger.debug("Calling fly_home service...")
+            result = self.call_service(service, request, deadline)
+            logger.debug("Service response: %s", summarize(result))
             if result['mode_sent']:
                 self.prev_flight_status = Drone.Flight_Status.FLYING_HOME
+                self.forget_mission()
                 result = {"success": True, "message": "Drone flying home"}
             else:
                 result = {"success": False, "message": "Drone failed to fly home"}
+        except DeadlineExceeded as e:
+            result = self.timed_out(e)
         except:
             result = {"success": False, "message": "Drone flying home failed"}
         return result
@@ -288,18 +375,21 @@ class MavrosDrone(Drone):
     # Returns dictionary describing if service call was successful
     def shutdown(self):
         try:
-            print("Attempting to shutdown drone...")
-            service = roslibpy.Service(self.ROS_master_connection,
-                                       self.drone_namespace + '/shutdown')
+            logger.debug("Attempting to shutdown drone...")
+            service = self.service_proxy(self.drone_namespace + '/shutdown',
+                                         'std_srvs/Trigger')
             request = roslibpy.ServiceRequest({})
 
-            print('Calling shutdown service...')
-            result = service.call(request)
-            print('Service response: {}'.format(result))
+            logger.debug("Calling shutdown service...")
+            result = self.call_service(service, request)
+            logger.debug("Service response: %s", summarize(result))
             if result['success']:
                 result = {"success": True, "message": "Drone shutdown successful"}
             else:
                 result = {"success": False, "message": "Drone failed to shutdown"}
+        except DeadlineExceeded as e:
+            result = self.timed_out(e)
         except:
             result = {"success": False, "message": "Drone failed to shutdown"}
+        self.clear_service_proxies()
         return result
@@ -0,0 +1,259 @@
+'''
+Latency and throughput metrics.
+
+Every service and action of the server, and every service call made to a
+drone, is timed into a Histogram together with its outcome. Histograms use
+fixed buckets, so recording is a bisect and an increment however many calls
+are made, and percentiles are estimated from the bucket counts.
+
+Other components' counters (service cache, command executor, connections)
+are registered as gauges and read only when the metrics are requested.
+get_metrics() returns the registry shared by the whole server.
+'''
+
+import bisect
+import math
+import os
+import threading
+from server_log import get_logger
+
+logger = get_logger('metrics')
+
+# Upper bounds of the latency buckets in seconds; the last bucket is
+# unbounded
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10, 30, 60)
+
+# Outcomes of a call
+OK = 'ok'
+ERROR = 'error'
+TIMEOUT = 'timeout'
+
+PREFIX = 'isaacs_server'
+
+
+def outcome(success, timed_out=False):
+    '''
+    returns: the outcome of a call from its result's success and timed_out
+    '''
+    if timed_out:
+        return TIMEOUT
+    return OK if success else ERROR
+
+
+class Histogram:
+    '''
+    Counts of observed latencies per bucket, with their sum and maximum.
+    Not thread-safe on its own; Metrics locks around it.
+    '''
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q):
+        '''
+        :param q: percentile between 0 and 100
+        returns: estimated latency in seconds, interpolated linearly within
+        the bucket the percentile falls in and never above the maximum seen
+        '''
+        if not self.count:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.max
+                estimate = lower + (upper - lower) * (rank - seen) / count
+                return min(estimate, self.max)
+            seen += count
+        return self.max
+
+
+class Metrics:
+    '''
+    Registry of the server's latency histograms and gauges.
+    '''
+
+    def __init__(self):
+        # Map between (metric, labels) and [Histogram, errors, timeouts],
+        # where labels is a tuple of (label, value) pairs
+        self._series = dict()
+        self._gauges = dict() # Map between gauge prefixes and callbacks
+        self._lock = threading.Lock()
+
+    def observe(self, metric, labels, seconds, outcome=OK):
+        '''
+        :param metric: name of the histogram, e.g. "request_seconds"
+        :param labels: tuple of (label, value) pairs of the series
+        :param seconds: latency of the call
+        :param outcome: OK, ERROR or TIMEOUT
+        '''
+        key = (metric, labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [Histogram(), 0, 0]
+            series[0].observe(seconds)
+            if outcome == ERROR:
+                series[1] += 1
+            elif outcome == TIMEOUT:
+                series[2] += 1
+
+    def observe_endpoint(self, kind, name, seconds, outcome=OK):
+        '''
+        Records a call of one of the server's services ("service") or
+        actions ("action").
+        '''
+        self.observe('request_seconds', (('kind', kind), ('endpoint', name)), seconds, outcome)
+
+    def observe_drone_call(self, backend, service, seconds, outcome=OK):
+        '''
+        Records a service call made to a drone.
+
+        :param backend: drone type, e.g. "Mavros"
+        :param service: name of the service without the drone's namespace
+        '''
+        self.observe('drone_call_seconds', (('backend', backend), ('service', service)), seconds, outcome)
+
+    def add_gauges(self, prefix, callback):
+        '''
+        :param prefix: prefix of the gauge names, e.g. "service_cache"
+        :param callback: returns a dict (or list) of numbers, possibly
+            nested; it is called each time the metrics are read
+        '''
+        with self._lock:
+            self._gauges[prefix] = callback
+
+    def endpoints(self):
+        '''
+        returns: list of dicts of {metric, labels, calls, errors, timeouts,
+        mean, p50, p95, p99, max}, one per series, latencies in seconds
+        '''
+        with self._lock:
+            series = [(metric, labels, histogram, errors, timeouts)
+                      for (metric, labels), (histogram, errors, timeouts) in self._series.items()]
+            return [{"metric": metric, "labels": dict(labels), "calls": histogram.count,
+                     "errors": errors, "timeouts": timeouts,
+                     "mean": histogram.sum / histogram.count if histogram.count else 0.0,
+                     "p50": histogram.percentile(50), "p95": histogram.percentile(95),
+                     "p99": histogram.percentile(99), "max": histogram.max}
+                    for metric, labels, histogram, errors, timeouts in sorted(series, key=lambda s: (s[0], s[1]))]
+
+    def gauges(self):
+        '''
+        returns: dict of {gauge name: value} of every registered gauge
+        '''
+        with self._lock:
+            callbacks = list(self._gauges.items())
+        values = dict()
+        for prefix, callback in callbacks:
+            try:
+                _flatten(prefix, callback(), values)
+            except Exception as e:
+                logger.warning("Reading %s gauges failed: %s", prefix, e)
+        return values
+
+    def prometheus(self):
+        '''
+        returns: the metrics in the Prometheus text exposition format
+        '''
+        with self._lock:
+            series = sorted(((metric, labels, histogram, errors, timeouts)
+                             for (metric, labels), (histogram, errors, timeouts) in self._series.items()),
+                            key=lambda s: (s[0], s[1]))
+            lines = []
+            for metric in sorted({s[0] for s in series}):
+                family = [s for s in series if s[0] == metric]
+                name = f'{PREFIX}_{metric}'
+                base = f'{PREFIX}_{metric[:-len("_seconds")] if metric.endswith("_seconds") else metric}'
+                lines.append(f'# TYPE {name} histogram')
+                for _, labels, histogram, _, _ in family:
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + (math.inf,), histogram.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == math.inf else repr(float(bound))
+                        lines.append(f'{name}_bucket{_labels(labels + (("le", le),))} {cumulative}')
+                    lines.append(f'{name}_sum{_labels(labels)} {histogram.sum!r}')
+                    lines.append(f'{name}_count{_labels(labels)} {histogram.count}')
+                lines.append(f'# TYPE {base}_errors_total counter')
+                lines.extend(f'{base}_errors_total{_labels(labels)} {errors}'
+                             for _, labels, _, errors, _ in family)
+                lines.append(f'# TYPE {base}_timeouts_total counter')
+                lines.extend(f'{base}_timeouts_total{_labels(labels)} {timeouts}'
+                             for _, labels, _, _, timeouts in family)
+        for gauge, value in sorted(self.gauges().items()):
+            lines.append(f'# TYPE {PREFIX}_{gauge} gauge')
+            lines.append(f'{PREFIX}_{gauge} {value!r}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        '''
+        Writes the Prometheus text to a file, replacing it atomically so a
+        collector never reads a partial file.
+        '''
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as f:
+            f.write(self.prometheus())
+        os.replace(temporary, path)
+
+    def schedule_dump(self, ros, path, interval):
+        '''
+        Writes the Prometheus text to path every interval seconds, on a
+        worker thread of the roslibpy.Ros connection.
+        '''
+        def dump():
+            try:
+                self.write_prometheus(path)
+            except OSError as e:
+                logger.warning("Writing metrics to %s failed: %s", path, e)
+
+        def tick():
+            ros.call_in_thread(dump)
+            ros.call_later(interval, tick)
+        ros.call_later(interval, tick)
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+def _flatten(prefix, value, values):
+    # Adds the numbers in a nested dict or list to values, named by their path
+    if isinstance(value, bool):
+        values[prefix] = float(value)
+    elif isinstance(value, (int, float)):
+        values[prefix] = float(value)
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            _flatten(f'{prefix}_{_name(key)}', item, values)
+    elif isinstance(value, (list, tuple)):
+        for index, item in enumerate(value):
+            _flatten(f'{prefix}_{index}', item, values)
+
+
+def _name(key):
+    return ''.join(c if c.isalnum() else '_' for c in str(key)).lower()
+
+
+_metrics = Metrics()
+
+
+def get_metrics():
+    '''
+    returns: the Metrics registry shared by the server
+    '''
+    return _metrics
@@ -1,8 +1,27 @@
+from action_server import ConcurrentActionServer
+from command_executor import CommandExecutor, CommandPreempted, Priority
+from concurrent.futures import CancelledError
+from connection import ConnectionManager, ConnectionPool
+from deadline import Deadline
 from drone import Drone
+from fleet_snapshot import FleetSnapshot
+from fleet_state import FleetStatePublisher
+from metrics import get_metrics, outcome as call_outcome
+from profiler import get_profiler
 from sensor import Sensor
+from telemetry import Telemetry
+from service_cache import ServiceCache
+from server_log import get_logger, summarize
+from topic_index import TopicIndex, pack_topics
 import roslibpy
 import roslibpy.actionlib
+from roslibpy.actionlib import GoalStatus
+import server_log
+import waypoints as waypoint_arrays
 import argparse
+import numpy as np
+import threading
+import time
 import constants
 #roslaunch rosbridge_server rosbridge_websocket.launch
 
@@ -14,7 +33,55 @@ import constants
 parser = argparse.ArgumentParser(
         description='Starts the operator of the server.')
 parser.add_argument('--ip', type=str, default=constants.IP_ADDRESS)
+parser.add_argument('--cache-size', type=int, default=constants.SERVICE_CACHE_SIZE,
+        help='Number of service responses remembered for repeat calls.')
+parser.add_argument('--cache-ttl', type=float, default=constants.SERVICE_CACHE_TTL,
+        help='Seconds a remembered service response stays valid (0 = forever).')
+parser.add_argument('--command-workers', type=int, default=constants.COMMAND_WORKERS,
+        help='Number of drone commands that may run at the same time.')
+parser.add_argument('--command-timeout', type=float, default=constants.COMMAND_TIMEOUT,
+        help='Seconds a drone command may take, including time spent queued, '
+        'when the goal does not set a timeout.')
+parser.add_argument('--emergency-workers', type=int, default=constants.EMERGENCY_WORKERS,
+        help='Number of land and fly_home commands that may run at the same time, '
+        'on top of --command-workers.')
+parser.add_argument('--reconnect-delay', type=float, default=constants.RECONNECT_INITIAL_DELAY,
+        help='Seconds before the first attempt to reconnect to rosbridge.')
+parser.add_argument('--reconnect-max-delay', type=float, default=constants.RECONNECT_MAX_DELAY,
+        help='Longest wait in seconds between attempts to reconnect to rosbridge.')
+parser.add_argument('--drone-connections', type=int, default=constants.DRONE_CONNECTIONS,
+        help='Number of extra rosbridge connections the drones are spread over '
+        '(0 = drones share the main connection).')
+parser.add_argument('--priority-connection', action='store_true',
+        help='Open a rosbridge connection reserved for land and fly_home commands.')
+parser.add_argument('--log-level', default=constants.LOG_LEVEL,
+        choices=('DEBUG', 'INFO', 'WARNING', 'ERROR'),
+        help='Lowest level of the messages logged; DEBUG includes every service call.')
+parser.add_argument('--log-file', type=str, default=None,
+        help='File to append the log to instead of standard error.')
+parser.add_argument('--log-sync', action='store_true',
+        help='Write log messages from the calling thread instead of a background thread.')
+parser.add_argument('--metrics-file', type=str, default=None,
+        help='File the metrics are written to in the Prometheus text format.')
+parser.add_argument('--metrics-interval', type=float, default=constants.METRICS_INTERVAL,
+        help='Seconds between writes of --metrics-file.')
+parser.add_argument('--profile-dir', type=str, default=constants.PROFILE_DIR,
+        help='Directory the profile service writes its results to.')
+parser.add_argument('--telemetry-samples', type=int, default=constants.TELEMETRY_SAMPLES,
+        help='Number of position and status samples kept per drone.')
+parser.add_argument('--telemetry-throttle', type=int, default=constants.TELEMETRY_THROTTLE_RATE,
+        help='Minimum milliseconds between telemetry messages of one topic.')
+parser.add_argument('--fleet-state-rate', type=float, default=constants.FLEET_STATE_RATE,
+        help='Messages per second on the fleet_state topic (0 = off).')
+parser.add_argument('--fleet-state-encoding', choices=('dicts', 'packed', 'both'),
+        default='dicts', help='Publish fleet_state as FleetState messages, '
+        'FleetStatePacked messages on fleet_state_packed, or both.')
+parser.add_argument('--fleet-state-keyframe', type=float, default=constants.FLEET_STATE_KEYFRAME_INTERVAL,
+        help='Seconds between fleet_state messages listing every drone.')
 args = parser.parse_args()
+# Writes log records on a background thread unless --log-sync is given
+log_listener = server_log.configure(args.log_level, args.log_file, not args.log_sync)
+logger = get_logger('operator')
 
 # HOST ip parameter
 HOST = args.ip
@@ -27,19 +94,79 @@ drones = dict() # Global map between drone IDs and drone instances
 sensors = dict() # Global map between sensor IDs and sensor instances
 drone_names = dict() # Global map between drone names and drone IDs
 sensor_names = dict() # Global map between sensor names and sensor IDs
-all_topics = dict() # Global map of topic names to topic types
+topic_index = TopicIndex() # Global index of topic names, types and owners
+fleet_snapshot = FleetSnapshot() # Versioned all_drones_available response
 # If an id of 0 is passed in, it acts as a wild card.
 next_id = 1 # ID to assign next drone or sensor
 services = [] # TODO list of all services
 actions = [] # TODO list of all actions
-latestService = [] # Remembers last service call
-#first element is request, second element is response, third element is servicename
+# Remembers recent service calls so that retries are answered from the cache
+service_cache = ServiceCache(args.cache_size, args.cache_ttl)
+# Runs drone commands in the background, one at a time per drone, with
+# land and fly_home ahead of everything else
+command_executor = CommandExecutor(args.command_workers, args.emergency_workers)
+# Services whose responses only read server state. Their cached responses are
+# dropped whenever another service changes that state.
+read_only_services = ("all_drones_available", "query_topics", "filter_topics",
+        "drones_changed_since", "topics_changed_since", "drone_state", "metrics",
+        "profile")
+# Call counts and latencies of every service, action and drone service call
+server_metrics = get_metrics()
+# Profiles the live handlers when asked to through the profile service
+server_profiler = get_profiler()
+server_profiler.directory = args.profile_dir
 
 ###################################
 # Set up and boot Roslibpy server #
 ###################################
 
 ROS_master_connection = roslibpy.Ros(host=HOST, port=9090)
+# Reconnects to rosbridge with bounded backoff if the connection drops
+connection = ConnectionManager(ROS_master_connection, args.reconnect_delay,
+        args.reconnect_max_delay)
+# Connections for the drones' own traffic
+drone_connections = ConnectionPool(ROS_master_connection, HOST, 9090,
+        args.drone_connections, args.priority_connection,
+        args.reconnect_delay, args.reconnect_max_delay)
+# Latest position and flight status samples of every drone
+telemetry = Telemetry(ROS_master_connection, args.telemetry_samples,
+        args.telemetry_throttle)
+# Aggregated position and flight status of all drones for the VR clients.
+# reset replaces the drones dict, so it is looked up on every sample.
+fleet_state = None
+if args.fleet_state_rate > 0:
+    fleet_state = FleetStatePublisher(ROS_master_connection, telemetry, lambda: drones,
+            args.fleet_state_rate, args.fleet_state_keyframe,
+            encoding=args.fleet_state_encoding)
+
+def drone_counters():
+    return {
+        "registered": len(drones),
+        "service_proxy_uses": sum(sum(d.service_proxy_uses.values()) for d in list(drones.values())),
+        "service_timeouts": sum(sum(d.service_timeouts.values()) for d in list(drones.values()))
+    }
+
+# Counters of the other components, read with the metrics
+server_metrics.add_gauges("service_cache", service_cache.stats)
+server_metrics.add_gauges("command_executor", command_executor.metrics)
+server_metrics.add_gauges("connection", connection.state)
+server_metrics.add_gauges("drone_connections", drone_connections.state)
+server_metrics.add_gauges("drones", drone_counters)
+
+def observe_call(kind, name, start, outcome):
+    '''
+    Records a service call or action goal in server_metrics, and as a span
+    if the profiler is tracing.
+
+    :param kind: "service" or "action"
+    :param start: time.perf_counter() when the call arrived
+    :param outcome: outcome of the call, see metrics.outcome
+    returns: duration of the call in seconds
+    '''
+    elapsed = time.perf_counter() - start
+    server_metrics.observe_endpoint(kind, name, elapsed, outcome)
+    server_profiler.span(kind, name, start, elapsed)
+    return elapsed
 
 def to_camel_case(snake_str):
     components = snake_str.split('_')
@@ -59,6 +186,17 @@ def custom_service(handler):
     Exceptions for the handler name to service type mapping can be added
     to the exceptions dictionary.
 
+    The handler is advertised wrapped in a dispatcher that takes care of what
+    every service needs, so handlers only have to fill in the response:
+      * a repeat of a recent request is answered from the service_cache
+        without calling the handler (except for services in `uncached`),
+      * successful responses are stored in the service_cache, and calls that
+        change server state drop the cached read_only_services responses,
+      * an exception raised by the handler is turned into an unsuccessful
+        response instead of failing the call on the client side,
+      * the time taken by each call and whether it succeeded are recorded
+        in server_metrics, and the handler runs under the server_profiler.
+
     parameter: handler(request, response) handles an incoming service request.
     returns: handler
     """
@@ -68,14 +206,55 @@ def custom_service(handler):
         'shutdown_drone': 'isaacs_server/TypeToTopic',
         'shutdown_sensor': 'isaacs_server/TypeToTopic'
     }
-    if handler.__name__ in exceptions:
-        serv_type = exceptions[handler.__name__]
+    # Services that always have to run instead of being replayed. Saving
+    # topics moves them to the caller, so a repeat must take back topics that
+    # another drone or sensor saved since; running it again is harmless.
+    uncached = {'reset', 'drone_state', 'metrics', 'profile',
+            'save_drone_topics', 'save_sensor_topics'}
+    # Services whose responses only hold fleet_snapshot entries, which are
+    # replaced rather than modified, so they are cached without a copy
+    immutable = {'all_drones_available', 'drones_changed_since'}
+    name = handler.__name__
+    if name in exceptions:
+        serv_type = exceptions[name]
     else:
-        serv_type = f'isaacs_server/{to_camel_case(handler.__name__)}'
+        serv_type = f'isaacs_server/{to_camel_case(name)}'
+
+    def dispatch(request, response):
+        start = time.perf_counter()
+        if name not in uncached:
+            cached = service_cache.get(name, request)
+            if cached is not None:
+                response.update(cached)
+                logger.debug("Replayed %s from cache %s", name, service_cache.stats())
+                observe_call("service", name, start, call_outcome(response.get("success", True)))
+                return True
+
+        logger.debug("Calling %s service...", name)
+        try:
+            server_profiler.call(handler, request, response)
+        except Exception as e:
+            response["success"] = False
+            response["message"] = f"{name} failed: {e}"
+            logger.exception("%s raised %s: %s", name, type(e).__name__, e)
+            observe_call("service", name, start, call_outcome(False))
+            return True
+
+        # Failed calls leave the server state untouched, so they are simply
+        # run again when retried.
+        if name not in uncached and response.get("success"):
+            service_cache.put(name, request, response, copy=name not in immutable)
+        if name not in read_only_services and response.get("success"):
+            for read_only in read_only_services:
+                service_cache.invalidate(read_only)
+        elapsed = observe_call("service", name, start, call_outcome(response.get("success", True)))
+        logger.debug("%s service finished in %.1f ms", name, elapsed * 1000)
+        return True
+
     service = roslibpy.Service(ROS_master_connection,
-            f'/isaacs_server/{handler.__name__}', serv_type)
-    print(service.name)
-    service.advertise(handler)
+            f'/isaacs_server/{name}', serv_type)
+    logger.debug("Advertising %s", service.name)
+    service.advertise(dispatch)
     services.append(service)
     return handler
 
@@ -91,19 +270,51 @@ def custom_action(handler):
     Exceptions for the handler name to service type mapping can be added
     to the exceptions dictionary.
 
+    Actions listed in `concurrent` are served by a ConcurrentActionServer,
+    which keeps several goals active at once. Their handler is called with
+    a GoalHandle for each goal instead of the goal itself, and reports
+    feedback and results through it.
+
+    The time from receiving each goal to its result, and whether it
+    succeeded, timed out or failed, are recorded in server_metrics.
+
     parameter: handler(request, response) handles an incoming action request.
     returns: handler
     """
     exceptions = {}
+    concurrent = {'control_drone', 'control_fleet', 'upload_mission', 'set_speed', 'get_speed'}
     if handler.__name__ in exceptions:
         action_type = exceptions[handler.__name__]
     else:
         action_type = f'isaacs_server/{to_camel_case(handler.__name__)}Action'
     
-    print(action_type)
-    server = roslibpy.actionlib.SimpleActionServer(ROS_master_connection,
-            f'isaacs_server/{handler.__name__}', action_type)
+    logger.debug("Advertising %s", action_type)
+    if handler.__name__ in concurrent:
+        server_class = ConcurrentActionServer
+    else:
+        server_class = roslibpy.actionlib.SimpleActionServer
+    name = handler.__name__
+    server = server_class(ROS_master_connection,
+            f'isaacs_server/{name}', action_type)
     handler = handler(server)
+    if server_class is ConcurrentActionServer:
+        def finished(goal_handle, status, result):
+            start = time.perf_counter() - (time.monotonic() - goal_handle.received)
+            observe_call("action", name, start,
+                    call_outcome(status == GoalStatus.SUCCEEDED and result.get("success", True),
+                            result.get("timed_out", False)))
+        server.on_finish = finished
+    else:
+        # The goal is finished when the handler returns
+        simple_handler = handler
+        def handler(goal):
+            start = time.perf_counter()
+            success = False
+            try:
+                server_profiler.call(simple_handler, goal)
+                success = True
+            finally:
+                observe_call("action", name, start, call_outcome(success))
     server.start(handler)
     actions.append(server)
     return handler
@@ -131,6 +342,73 @@ def get_id(client_type):
             cur_id, next_id = next_id + 1, next_id + 2
     return cur_id
 
+def refresh_drone_topics(owner_ids):
+    '''
+    Updates the fleet_snapshot entries of drones whose topics were moved to
+    another drone or sensor, so that they stop listing them.
+
+    :param owner_ids: ids returned by topic_index.add; None and ids of
+        sensors are skipped
+    '''
+    for owner_id in owner_ids:
+        drone = drones.get(owner_id)
+        if drone is not None:
+            fleet_snapshot.update_drone(drone, topic_index.topics_of(owner_id))
+
+def get_control_task(drone, control_task):
+    '''
+    Looks up the Drone method that performs a control task.
+
+    :param drone: Drone instance to control
+    :param control_task: name of the task, e.g. "land_drone"
+    returns: the bound method, or None if there is no such task
+    '''
+    tasks = {
+        "start_mission" : drone.start_mission,
+        "pause_mission" : drone.pause_mission,
+        "resume_mission" : drone.resume_mission,
+        "stop_mission" : drone.stop_mission,
+        "land_drone" : drone.land_drone,
+        "fly_home" : drone.fly_home,
+        "start_next_segment" : drone.start_next_segment
+    }
+    return tasks.get(control_task)
+
+def goal_deadline(goal):
+    '''
+    :param goal: action goal with an optional timeout field in seconds
+    returns: Deadline of the goal, starting now; goals without a timeout
+    get the --command-timeout
+    '''
+    return Deadline(goal.get("timeout") or args.command_timeout)
+
+def get_task_priority(task):
+    '''
+    :param task: name of a control task or of a drone action, e.g. "land_drone"
+    returns: the command_executor Priority the task is queued with. Safety
+    tasks preempt queued BULK work on the same drone.
+    '''
+    priorities = {
+        "land_drone" : Priority.EMERGENCY,
+        "fly_home" : Priority.EMERGENCY,
+        "upload_mission" : Priority.BULK,
+        "set_speed" : Priority.BULK
+    }
+    return priorities.get(task, Priority.NORMAL)
+
+def cancel_with_goal(goal_handle, future):
+    '''
+    Cancels a queued drone command when the client cancels its goal; the
+    future then raises CancelledError. A command that already started runs
+    to the end.
+
+    :param goal_handle: GoalHandle of the goal the command belongs to
+    :param future: future returned by command_executor.submit
+    returns: the future
+    '''
+    goal_handle.on_cancel(future.cancel)
+    return future
+
 def is_drone(client_id):
     '''
     Verifies that the client_id is a drone ID or not.
@@ -151,85 +429,202 @@ def is_sensor(client_id):
         return True
     return False
 
-def checkLatestService(request, serviceName):
-    if len(latestService) == 3 and serviceName == latestService[2] and request == latestService[0]:
-        print("Repeat service call")
-        print(latestService[1])
-        print(latestService[1]["success"])
-        return True
-    return False
-
-def saveLatestService(request, response, serviceName):
-    global latestService
-    latestService = [request, response, serviceName]
-
 ################################
 # Interface -> Server Handlers #
 ################################
 @custom_service
 def all_drones_available(request, response):
+    '''
+    Sends the fleet_snapshot, which is kept up to date as drones register,
+    save topics and shut down. The version in the response changes whenever
+    the list does, so clients can skip processing an unchanged list.
+    '''
+    version, drones_available = fleet_snapshot.drones_available()
+    response["success"] = True
+    response["message"] = "Successfully sent all available drones to VR"
+    response['drones_available'] = drones_available
+    response["version"] = version
 
-    print("Calling all_drones_available service...")
-    if checkLatestService(request, "all_drones_available"):
-        response["message"] = latestService[1]["message"]
-        response["success"] = latestService[1]["success"]
-        response["drones_available"] = latestService[1]["drones_available"]
-        return True
+    return True
 
-    drones_available = []
-    for k, v in drones.items():
-        avail = {
-                "id" : k,
-                "name" : v.drone_name,
-                "type" : v.drone_type,
-                "topics" : v.topics,
-                "services" : v.services
-        }
-        drones_available.append(avail)
+@custom_service
+def drone_state(request, response):
+    '''
+    Returns the latest telemetry of a drone.
 
+    :param request: dict of {id: uint32, samples: uint32}
+    samples is the number of recent positions to return in history.
+    '''
+    drone_id = request["id"]
+    d = drones.get(drone_id)
+    response["id"] = drone_id
+    if not d:
+        response["success"] = False
+        response["message"] = "No drone with that id."
+        return True
+    state = telemetry.state(drone_id, request.get("samples", 0))
+    response["flight_status"] = int(d.flight_status)
+    position = state and state["position"]
+    response["has_position"] = position is not None
+    if position is not None:
+        response["latitude"] = float(position["latitude"])
+        response["longitude"] = float(position["longitude"])
+        response["altitude"] = float(position["altitude"])
+        response["position_age"] = time.time() - float(position["stamp"])
+    if state:
+        history = state["history"]
+        response["history"] = np.column_stack((history["latitude"], history["longitude"],
+                history["altitude"], history["stamp"])).ravel().tolist()
+    response["pending_commands"] = command_executor.pending(drone_id)
+    response["service_timeouts"] = sum(d.service_timeouts.values())
     response["success"] = True
-    response["message"] = "Successfully sent all available drones to VR"
-    response['drones_available'] = drones_available
-    print("All_drones_available service finished!", response)
+    response["message"] = "Drone state" if state else "No telemetry topics saved for this drone"
+    return True
+
+@custom_service
+def metrics(request, response):
+    '''
+    Returns the call counts, error and timeout counts and latency
+    percentiles of every service and action and of the service calls made to
+    each drone type, and the counters of the server's components.
 
-    saveLatestService(request, response, "all_drones_available")
+    :param request: dict of {prometheus: bool}
+    If prometheus is set the same metrics are also returned as Prometheus text.
+    '''
+    response["endpoints"] = [{"metric": e["metric"],
+            "kind": e["labels"].get("kind", e["labels"].get("backend", "")),
+            "name": e["labels"].get("endpoint", e["labels"].get("service", "")),
+            "calls": e["calls"], "errors": e["errors"], "timeouts": e["timeouts"],
+            "mean": e["mean"], "p50": e["p50"], "p95": e["p95"], "p99": e["p99"], "max": e["max"]}
+            for e in server_metrics.endpoints()]
+    gauges = server_metrics.gauges()
+    response["gauge_names"] = list(gauges)
+    response["gauge_values"] = list(gauges.values())
+    response["prometheus_text"] = server_metrics.prometheus() if request.get("prometheus") else ""
+    response["success"] = True
+    response["message"] = "Metrics of {} endpoints".format(len(response["endpoints"]))
     return True
 
 @custom_service
-def query_topics(request, response):
-    print("Calling query_topics service...")
-    if checkLatestService(request, "query_topics"):
-        response["message"] = latestService[1]["message"]
-        response["success"] = latestService[1]["success"]
-        response["id"] = latestService[1]["id"]
+def profile(request, response):
+    '''
+    Starts or stops profiling the live server, see profiler.py. Results are
+    written to --profile-dir when the profile stops.
+
+    :param request: dict of {command: string, mode: string, interval: float,
+    trace: bool, duration: float}
+    command is "start", "stop" or "status". mode is "sample" (default) or
+    "cprofile", interval is in milliseconds and duration in seconds.
+    Ex: {command: "start", mode: "sample", trace: true, duration: 60}
+    '''
+    command = request["command"]
+    try:
+        if command == "start":
+            server_profiler.start(request.get("mode") or "sample",
+                    (request.get("interval") or 5) / 1000,
+                    request.get("trace", False), request.get("duration") or 0)
+            response["message"] = "Started profiling."
+        elif command == "stop":
+            server_profiler.stop()
+            response["message"] = "Stopped profiling."
+        elif command == "status":
+            state = server_profiler.state()
+            response["message"] = ("Profiling ({mode}) for {seconds:.1f} s, {samples} samples, "
+                    "{spans} spans.".format(**state) if state["active"] else "Not profiling.")
+        else:
+            response["success"] = False
+            response["message"] = f"Unknown command {command}, expected start, stop or status."
+            return True
+    except (ValueError, RuntimeError, OSError) as e:
+        response["success"] = False
+        response["message"] = f"Could not {command} profiling: {e}"
         return True
+    response["active"] = server_profiler.active
+    response["files"] = server_profiler.last_files
+    response["summary"] = server_profiler.last_summary
+    response["success"] = True
+    return True
 
+@custom_service
+def query_topics(request, response):
     client_id = request["id"]
     response["id"] = client_id
-    all_topics_response = []
     if client_id == 0:
-        for k,v in all_topics.items():
-            all_topics_response.append({"name": k, "type": v})
+        all_topics_response = topic_index.all_topics()
     else:
         if client_id in drones:
-            all_topics_response = drones[client_id].topics
-            for sensor_id in drones[client_id].sensors:
-                all_topics_response += sensors[sensor_id].topics
+            sensor_ids = [s.id for s in drones[client_id].sensors]
+            all_topics_response = topic_index.topics_of(client_id, *sensor_ids)
         elif client_id in sensors:
-            all_topics_response = sensors[client_id].topics
+            all_topics_response = topic_index.topics_of(client_id)
         else:
             response["success"] = False
             response["message"] = "No drone or sensor with that id."
-            saveLatestService(request, response, "query_topics")
             return True
 
     response["all_topics"] = all_topics_response
     response["success"] = True
     response["message"] = "Successfully queried topics."
-    print(all_topics_response)
-    print("Query_topics service finished!")
-    print(response)
-    saveLatestService(request, response, "query_topics")
+    return True
+
+@custom_service
+def filter_topics(request, response):
+    '''
+    Sends the topics under a namespace and/or of a message type, so that
+    clients interested in part of the fleet do not have to fetch and filter
+    every topic.
+
+    :param request: dict of {prefix: string, type: string, packed: bool}
+    An empty prefix or type matches every topic. If packed is set, the
+    topics are sent as parallel arrays (see topic_index.pack_topics).
+    Ex: {prefix: "/drone_3/mavros/", type: "sensor_msgs/NavSatFix"}
+    '''
+    topics = topic_index.find(request["prefix"], request["type"])
+    if request.get("packed"):
+        response["names"], response["types"], response["type_indices"] = pack_topics(topics)
+    else:
+        response["topics"] = topics
+    response["success"] = True
+    response["message"] = "Successfully filtered topics."
+    return True
+
+@custom_service
+def drones_changed_since(request, response):
+    '''
+    Sends only the drones that were added, changed or removed after the
+    version the client last saw in an all_drones_available or
+    drones_changed_since response.
+
+    :param request: dict of {version: uint32}
+    If the server no longer remembers that version, full is set and updated
+    holds every drone, which replaces the client's list.
+    '''
+    version, full, updated, removed = fleet_snapshot.changes_since(request["version"])
+    response["version"] = version
+    response["full"] = full
+    response["updated"] = updated
+    response["removed"] = removed
+    response["success"] = True
+    response["message"] = "Successfully sent drone changes"
+    return True
+
+@custom_service
+def topics_changed_since(request, response):
+    '''
+    Sends only the topics that were added, changed or removed after the
+    version the client last saw in a topics_changed_since response.
+
+    :param request: dict of {version: uint32}
+    If the server no longer remembers that version, full is set and updated
+    holds every topic, which replaces the client's list.
+    '''
+    version, full, updated, removed = topic_index.changes_since(request["version"])
+    response["version"] = version
+    response["full"] = full
+    response["updated"] = updated
+    response["removed"] = removed
+    response["success"] = True
+    response["message"] = "Successfully sent topic changes"
     return True
 
 ############################
@@ -240,13 +635,6 @@ def register_drone(request, response):
     '''
     :param request: dict of {drone_name: string, drone_type: string}
     '''
-    print("Calling register_drone service...")
-    if checkLatestService(request, "register_drone"):
-        response["message"] = latestService[1]["message"]
-        response["success"] = latestService[1]["success"]
-        response["id"] = latestService[1]["id"]
-        return True
-
     drone_name = request["drone_name"]
     drone_type = request["drone_type"]
 
@@ -254,20 +642,22 @@ def register_drone(request, response):
         response["success"] = False
         response["message"] = "A drone with this name already exists."
         response["id"] = 0
-        print("A drone with the name", drone_name, "already exists")
-        saveLatestService(request, response, "register_drone")
+        logger.warning("A drone with the name %s already exists", drone_name)
         return True
 
     # Create new drone instance using base class constructor, which should then
     # call child constructor corresponding to the drone_type
-    d=Drone.create(drone_name, drone_type, ROS_master_connection)
+    drone_connection = drone_connections.assign()
+    d=Drone.create(drone_name, drone_type, drone_connection,
+            priority_connection=drone_connections.priority)
     if d:
         drone_id = get_id(Drone)
-        print(f"Adding drone {id} to global drones map...")
+        logger.info("Registered %s drone %s as %s", drone_type, drone_name, drone_id)
         d.id = drone_id
         d.drone_namespace = '/drone_' + str(drone_id)
         drones[drone_id] = d
         drone_names[drone_name] = drone_id
+        fleet_snapshot.update_drone(d, [])
         response["success"] = True
         response["id"] = drone_id
         response["message"] = "Drone registered"
@@ -275,10 +665,8 @@ def register_drone(request, response):
         response["success"] = False
         response["message"] = "Failed to register drone"
         response["id"] = -1
-    print(drones)
-    print(drone_names)
-    print("Register_drone service finished!")
-    saveLatestService(request, response, "register_drone")
+        drone_connections.release(drone_connection)
+    logger.debug("Drones: %s", summarize(drone_names))
     return True
 
 
@@ -291,26 +679,20 @@ def save_drone_topics(request, response):
         and publishes: issacs_server/topic[]
     This service saves all topics provided into the appropriate drone object.
     """
-    print("Calling save_drone_topics...")
-    if checkLatestService(request, "save_drone_topics"):
-        response["message"] = latestService[1]["message"]
-        response["success"] = latestService[1]["success"]
-        return True
-
     publishes = request["publishes"]
     drone_id = request["id"]
     if not drone_id in drones:
         response["success"] = False
         response["message"] = "Drone id does not exist"
         return True
+    previous_owners = set()
     for topic in publishes:
-        all_topics[topic["name"]] = topic["type"]
-        drones[drone_id].topics.append(topic)
+        previous_owners.add(topic_index.add(drone_id, topic["name"], topic["type"]))
+    fleet_snapshot.update_drone(drones[drone_id], topic_index.topics_of(drone_id))
+    refresh_drone_topics(previous_owners)
+    telemetry.subscribe(drones[drone_id], topic_index.topics_of(drone_id))
     response["success"] = True
     response["message"] = "Successfully saved drone topics"
-    print(all_topics)
-    print("Save_drone_topics service finished!")
-    saveLatestService(request, response, "save_drone_topics")
     return True
 
 
@@ -321,34 +703,34 @@ def shutdown_drone(request, response):
 
     :param request: message that has a id: std_msgs/Int32
         and publishes: issacs_server/topic[]
+    All topics saved for the drone are removed, whether or not they are
+    listed in publishes, and its queued commands are dropped.
     '''
-    print("Calling shutdown_drone service...")
-    if checkLatestService(request, "shutdown_drone"):
-        response["message"] = latestService[1]["message"]
-        response["success"] = latestService[1]["success"]
-        return True
-
     drone_id = request["id"]
-    publishes = request["publishes"]
     d = drones.pop(drone_id, None)
     if d:
         drone_names.pop(d.drone_name)
-        for topic in publishes:
-            all_topics.pop(topic['name'])
+        dropped = command_executor.cancel_drone(drone_id, "shutdown_drone")
+        if dropped:
+            logger.info("Dropped %d queued command(s) of drone %s", dropped, drone_id)
+        fleet_snapshot.remove_drone(drone_id)
+        topic_index.remove_owner(drone_id)
+        telemetry.unsubscribe(drone_id)
+        drone_connections.release(d.ROS_master_connection)
         d.shutdown()
+        # The name is free again, so a new registration must not be answered
+        # with the response to the old one.
+        service_cache.invalidate("register_drone",
+                {"drone_name": d.drone_name, "drone_type": d.drone_type})
         response["success"] = True
         response["message"] = "Drone shutdown"
     else:
         response["success"] = False
         response["message"] = "failed to shutdown drone"
-        print("Failed to shutdown drone. ID", drone_id, "not found")
-        saveLatestService(request, response, "shutdown_drone")
+        logger.warning("Failed to shutdown drone. ID %s not found", drone_id)
         return True
 
-    print(drone_names)
-    print(drones)
-    print("Shutdown_drone service finished!")
-    saveLatestService(request, response, "shutdown_drone")
+    logger.debug("Drones: %s", summarize(drone_names))
     return True
 
 
@@ -361,13 +743,6 @@ def register_sensor(request, response):
     :param request: dict of {drone_name: string, drone_type: string}
     Parent drone must be initiated before sensors are registered.
     '''
-    print("Calling register_sensor service...")
-    if checkLatestService(request, "register_sensor"):
-        response["message"] = latestService[1]["message"]
-        response["success"] = latestService[1]["success"]
-        response["id"] = latestService[1]["id"]
-        return True
-
     sensor_name = request["sensor_name"]
     sensor_type = request["sensor_type"]
     parent_drone_name = request["parent_drone_name"]
@@ -376,8 +751,7 @@ def register_sensor(request, response):
         response["success"] = False
         response["message"] = "A sensor with this name already exists."
         response["id"] = 0
-        print("A sensor with the name", sensor_name, "already exists")
-        saveLatestService(request, response, "register_sensor")
+        logger.warning("A sensor with the name %s already exists", sensor_name)
         return True
 
     s = None
@@ -385,7 +759,7 @@ def register_sensor(request, response):
         parent_drone_id = drone_names[parent_drone_name]
         sensor_id = get_id(Sensor)
         s = Sensor.create(sensor_name, sensor_type, ROS_master_connection, parent_drone_id, sensor_id)
-        print(f"Adding sensor {id} to global sensor map.")
+        logger.info("Registered sensor %s as %s", sensor_name, sensor_id)
         sensors[sensor_id] = s
         sensor_names[sensor_name] = sensor_id
         drones.get(parent_drone_id).sensors.append(s)
@@ -397,10 +771,7 @@ def register_sensor(request, response):
         response["id"] = 0
         response["message"] = "No drone with that name."
 
-    print(sensor_names)
-    print(sensors)
-    print("Register_sensor service finished!")
-    saveLatestService(request, response, "register_sensor")
+    logger.debug("Sensors: %s", summarize(sensor_names))
     return True
 
 
@@ -412,28 +783,19 @@ def save_sensor_topics(request, response):
     This adds all of the sensor topics provided into the sensor object.
     This service is called by the sensor client.
     '''
-    print("Calling save_sensor_topics service...")
-    if checkLatestService(request, "save_sensor_topics"):
-        response["message"] = latestService[1]["message"]
-        response["success"] = latestService[1]["success"]
-        return True
-
     publishes = request["publishes"]
     sensor_id = request["id"]
     sensor = sensors.get(sensor_id)
     if not sensor:
         response["success"] = False
         response["message"] = "Sensor id does not exist"
-        saveLatestService(request, response, "save_sensor_topics")
         return True
+    previous_owners = set()
     for topic in publishes:
-        all_topics[topic["name"]] = topic["type"]
-        sensor.topics.append(topic)
+        previous_owners.add(topic_index.add(sensor_id, topic["name"], topic["type"]))
+    refresh_drone_topics(previous_owners)
     response["success"] = True
     response["message"] = "Successfully saved sensor topics"
-    print(all_topics)
-    print("Save_sensor_topics service finished!")
-    saveLatestService(request, response, "save_sensor_topics")
     return True
 
 
@@ -442,142 +804,386 @@ def shutdown_sensor(request, response):
     '''
     :param request: message that has a id: std_msgs/Int32
         and publishes: issacs_server/topic[]
+    All topics saved for the sensor are removed, whether or not they are
+    listed in publishes.
     '''
-    print("Calling shutdown_sensor service...")
-    if checkLatestService(request, "shutdown_sensor"):
-        response["message"] = latestService[1]["message"]
-        response["success"] = latestService[1]["success"]
-        return True
-
     sensor_id = request["id"]
-    publishes = request["publishes"]
     s = sensors.pop(sensor_id, None)
     if s:
+        # The parent drone may have been shut down before its sensor
+        parent = drones.get(s.parent_drone_id)
         sensor_names.pop(s.sensor_name)
-        for topic in publishes:
-            all_topics.pop(topic['name'])
-        drones.get(s.parent_drone_id).sensors.remove(s)
+        topic_index.remove_owner(sensor_id)
+        if parent and s in parent.sensors:
+            parent.sensors.remove(s)
         s.shutdown()
+        if parent:
+            service_cache.invalidate("register_sensor",
+                    {"sensor_name": s.sensor_name, "sensor_type": s.sensor_type,
+                     "parent_drone_name": parent.drone_name})
         response["success"] = True
         response["message"] = "Sensor successfully shutdown"
     else:
         response["success"] = False
         response["message"] = "Failed to shutdown sensor"
 
-    print(sensor_names)
-    print(sensors)
-    print("Shutdown_sensor service finished!")
-    saveLatestService(request, response, "shutdown_sensor")
+    logger.debug("Sensors: %s", summarize(sensor_names))
     return True
 
 @custom_service
 def reset(request, response):
-    print("Resetting server")
+    logger.info("Resetting server")
     global drones
     global sensor
     global drone_names
     global sensor_names
-    global all_topics
     global next_id
     global services
-    global latestService
+    # Queued commands would otherwise run against drones that no longer exist
+    for drone_id in drones:
+        command_executor.cancel_drone(drone_id, "reset")
     drones = dict() # Global map between drone IDs and drone instances
     sensors = dict() # Global map between sensor IDs and sensor instances
     drone_names = dict() # Global map between drone names and drone IDs
     sensor_names = dict() # Global map between sensor names and sensor IDs
-    all_topics = dict() # Global map of topic names to topic types
     # If an id of 0 is passed in, it acts as a wild card.
     next_id = 1 # ID to assign next drone or sensor
     services = [] # TODO list of all services
-    latestService = [] # Remembers last service call
+    service_cache.clear()
+    fleet_snapshot.clear()
+    topic_index.clear()
+    telemetry.clear()
+    drone_connections.reset()
     response["success"] = True
     response["message"] = "Server successfully reset."
-    print("Server Reset")
+    logger.info("Server reset")
     return True
 
 
-print('Services advertised.')
+logger.info('Services advertised.')
 
 @custom_action
 def control_drone(server):
-    def control_drone(goal):
-        print("Calling control_drone action...")
-        server.send_feedback({"progress": "Calling control_drone action..."})
+    '''
+    Queues the control task on the command_executor and returns right away,
+    so a slow drone does not hold up goals for other drones. Tasks for the
+    same drone still run in the order they were received, except land_drone
+    and fly_home, which run right away and cancel the mission uploads and
+    speed changes still queued for the drone. Cancelling the goal drops the
+    task if it has not started yet. Feedback reports when the task is
+    queued, when it starts and when it finishes, and for start_mission the
+    outcome and latency of every step.
+    '''
+    def control_drone(goal_handle):
+        goal = goal_handle.goal
+        logger.debug("Calling control_drone action...")
+        goal_handle.send_feedback({"progress": "Calling control_drone action..."})
 
         control_task = goal["control_task"]
+        deadline = goal_deadline(goal)
         drone = drones.get(goal["id"])
         if not drone:
-            print(f"could not find drone with id {goal['id']}")
-            server.set_succeeded({"id":goal["id"], "success":False, "message":"No drone with that id."})
-        else:
-            tasks = {
-                "start_mission" : drone.start_mission,
-                "pause_mission" : drone.pause_mission,
-                "resume_mission" : drone.resume_mission,
-                "stop_mission" : drone.stop_mission,
-                "land_drone" : drone.land_drone,
-                "fly_home" : drone.fly_home
-            }
-            print(f"Executing {control_task}...")
-            callback = tasks.get(control_task)()
-            print("Control_drone service finished!")
-            server.send_feedback({"progress": "Control_drone action finished!"})
-            server.set_succeeded({"id":drone.id, "control_task": control_task, "success":callback["success"], "message":callback["message"]})
+            logger.warning("Could not find drone with id %s", goal['id'])
+            goal_handle.set_succeeded({"id":goal["id"], "control_task": control_task, "success":False, "message":"No drone with that id."})
+            return
+        task = get_control_task(drone, control_task)
+        if not task:
+            goal_handle.set_succeeded({"id":drone.id, "control_task": control_task, "success":False, "message":f"Unknown control task {control_task}."})
+            return
+
+        def started():
+            logger.debug("Executing %s on drone %s...", control_task, drone.id)
+            goal_handle.send_feedback({"progress": f"Executing {control_task}..."})
+
+        def step_finished(step):
+            goal_handle.send_feedback({"progress": f"{step['message']} in {step['latency'] * 1000:.0f} ms (attempt {step['attempt']})",
+                    "step": step["step"], "attempt": step["attempt"], "latency": step["latency"]})
+
+        def finished(future):
+            try:
+                callback = future.result()
+            except CancelledError:
+                logger.info("Control_drone %s for drone %s canceled", control_task, drone.id)
+                goal_handle.set_canceled({"id":drone.id, "control_task": control_task, "success":False,
+                        "message":f"{control_task} canceled"})
+                return
+            except Exception as e:
+                callback = {"success": False, "message": f"{control_task} failed: {e}"}
+            logger.debug("Control_drone action finished!")
+            goal_handle.send_feedback({"progress": "Control_drone action finished!"})
+            goal_handle.set_succeeded({"id":drone.id, "control_task": control_task, "success":callback["success"],
+                    "message":callback["message"], "timed_out": callback.get("timed_out", False)})
+
+        ahead = command_executor.pending(drone.id)
+        command = lambda: task(deadline=deadline)
+        if control_task == "start_mission":
+            command = lambda: task(on_step=step_finished, deadline=deadline)
+        priority = get_task_priority(control_task)
+        future = cancel_with_goal(goal_handle, command_executor.submit(drone.id, command,
+                on_start=started, priority=priority, name=control_task))
+        if ahead and priority == Priority.EMERGENCY:
+            goal_handle.send_feedback({"progress": f"Running ahead of {ahead} command(s) for drone {drone.id}"})
+        elif ahead:
+            goal_handle.send_feedback({"progress": f"Queued behind {ahead} command(s) for drone {drone.id}"})
+        future.add_done_callback(finished)
     return control_drone
 
+@custom_action
+def control_fleet(server):
+    '''
+    Runs one control task on several drones at once, e.g. landing the whole
+    fleet. The task is queued on the command_executor for every drone, so
+    the drones are controlled concurrently instead of one goal at a time.
+    Feedback is sent as each drone finishes, and the result lists the
+    outcome for every drone.
+    '''
+    def control_fleet(goal_handle):
+        goal = goal_handle.goal
+        logger.debug("Calling control_fleet action...")
+        control_task = goal["control_task"]
+        deadline = goal_deadline(goal)
+        ids = list(dict.fromkeys(goal["ids"] or drones))
+        if not ids:
+            goal_handle.set_succeeded({"control_task": control_task, "success": False, "message": "No drones registered.", "results": []})
+            return
+
+        lock = threading.Lock()
+        results = dict()
+
+        def finished(drone_id, success, message, timed_out=False):
+            result = {"id": drone_id, "success": success, "message": message, "timed_out": timed_out}
+            with lock:
+                results[drone_id] = result
+                completed = len(results)
+            goal_handle.send_feedback({"result": result, "completed": completed, "total": len(ids),
+                    "progress": f"{control_task} on drone {drone_id}: {message}"})
+            if completed == len(ids):
+                ordered = [results[i] for i in ids]
+                failed = [r["id"] for r in ordered if not r["success"]]
+                if failed:
+                    message = f"{control_task} failed on drone(s) {failed}"
+                else:
+                    message = f"{control_task} succeeded on {len(ids)} drone(s)"
+                logger.debug("Control_fleet action finished!")
+                result = {"control_task": control_task, "success": not failed,
+                        "message": message, "results": ordered}
+                if goal_handle.cancel_requested():
+                    goal_handle.set_canceled(result)
+                else:
+                    goal_handle.set_succeeded(result)
+
+        def done_callback(drone_id):
+            def done(future):
+                try:
+                    callback = future.result()
+                except CancelledError:
+                    callback = {"success": False, "message": f"{control_task} canceled"}
+                except Exception as e:
+                    callback = {"success": False, "message": f"{control_task} failed: {e}"}
+                finished(drone_id, callback["success"], callback["message"], callback.get("timed_out", False))
+            return done
+
+        for drone_id in ids:
+            drone = drones.get(drone_id)
+            task = get_control_task(drone, control_task) if drone else None
+            if not drone:
+                finished(drone_id, False, "No drone with that id.")
+            elif not task:
+                finished(drone_id, False, f"Unknown control task {control_task}.")
+            else:
+                cancel_with_goal(goal_handle, command_executor.submit(drone_id,
+                        lambda task=task: task(deadline=deadline),
+                        priority=get_task_priority(control_task),
+                        name=control_task)).add_done_callback(done_callback(drone_id))
+    return control_fleet
+
 @custom_action
 def upload_mission(server):
-    def upload_mission(goal):
-        print("Calling upload_mission action...")
-        server.send_feedback({"progress": "Calling upload_mission action..."})
+    '''
+    Uploads a mission to a drone. If the goal sets simplify_tolerance, the
+    path is first simplified (see waypoints.simplify) so that dense, nearly
+    collinear waypoints are not uploaded; the result reports how many
+    waypoints were received and how many were uploaded.
+
+    Missions longer than the drone's max_mission_waypoints are split into
+    segments: the first is uploaded right away and the rest are staged on
+    the drone, to be uploaded one by one with the start_next_segment
+    control task. Feedback reports the split and each upload.
+
+    A mission that fits in one upload is compared with the one last
+    uploaded to the drone (see Drone.update_mission): an unchanged mission
+    is not uploaded again and a small change only uploads the changed part
+    where the vendor supports it.
+
+    Waypoints can be sent either as NavSatFix messages or, much more
+    compactly, as packed_waypoints. Either way they are handled as a
+    waypoints.WAYPOINT_DTYPE array from here on.
+
+    The upload is queued on the command_executor like the drone's other
+    commands. A land_drone or fly_home goal for the drone preempts it if it
+    has not started yet, and cancelling the goal drops it until then.
+    '''
+    def upload_mission(goal_handle):
+        goal = goal_handle.goal
+        deadline = goal_deadline(goal)
+        logger.debug("Calling upload_mission action...")
+        goal_handle.send_feedback({"progress": "Calling upload_mission action..."})
 
         d = drones.get(goal["id"])
+        try:
+            if goal.get("packed_waypoints"):
+                waypoints = waypoint_arrays.from_packed(goal["packed_waypoints"])
+            else:
+                waypoints = waypoint_arrays.to_array(goal["waypoints"])
+        except (ValueError, KeyError, TypeError) as e:
+            goal_handle.set_succeeded({"id":goal["id"], "success":False, "message":f"Invalid waypoints: {e}",
+                    "original_count": 0, "uploaded_count": 0})
+            return
+        original_count = len(waypoints)
         if not d:
-            print(f"could not find drone with id {goal['id']}")
-            server.set_succeeded({"id":goal["id"], "success":False, "message":"No drone with that id."})
-        else:
-            print("id: ", goal["id"], "waypoints: ", goal["waypoints"])
-            callback = d.upload_mission(goal["waypoints"])
-            print("Upload_mission action finished!")
-            server.send_feedback({"progress": "Upload_mission action finished!"})
-            server.set_succeeded({"id":d.id, "success":callback["success"], "message":callback["message"]})
+            logger.warning("Could not find drone with id %s", goal['id'])
+            goal_handle.set_succeeded({"id":goal["id"], "success":False, "message":"No drone with that id.",
+                    "original_count": original_count, "uploaded_count": 0})
+            return
+        tolerance = goal.get("simplify_tolerance", 0)
+        if tolerance > 0:
+            waypoints = waypoints[waypoint_arrays.simplify(waypoints, tolerance)]
+            goal_handle.send_feedback({"progress": f"Simplified mission from {original_count} to {len(waypoints)} waypoints"})
+
+        def upload():
+            segments = d.split_mission(waypoints)
+            if len(segments) > 1:
+                goal_handle.send_feedback({"progress": f"Mission split into {len(segments)} segments of at most {d.max_mission_waypoints} waypoints"})
+            logger.debug("Uploading %d waypoints in %d segment(s) to drone %s", len(waypoints), len(segments), goal["id"])
+            d.mission_segments = []
+            if len(segments) == 1:
+                callback = d.update_mission(waypoints, deadline=deadline)
+                goal_handle.send_feedback({"progress": f"{callback['update_action'].name}: {callback['message']}"})
+            else:
+                callback = d.upload_mission(segments[0], deadline=deadline)
+                callback["update_action"] = Drone.UpdateMissionAction.UPDATE_CURRENT_MISSION
+                goal_handle.send_feedback({"progress": f"Uploaded segment 1/{len(segments)} ({len(segments[0])} waypoints)"})
+            if callback["success"] and len(segments) > 1:
+                d.mission_segments = segments[1:]
+                callback = {"success": True, "update_action": callback["update_action"],
+                        "message": f"{callback['message']}; {len(segments) - 1} more segment(s) staged, "
+                        "run start_next_segment when each segment finishes"}
+            return callback
+
+        def finished(future):
+            try:
+                callback = future.result()
+            except CommandPreempted as e:
+                logger.info("Upload_mission for drone %s %s", d.id, e)
+                goal_handle.set_preempted({"id":d.id, "success":False, "message":f"Upload {e}",
+                        "original_count": original_count, "uploaded_count": 0})
+                return
+            except CancelledError:
+                logger.info("Upload_mission for drone %s canceled", d.id)
+                goal_handle.set_canceled({"id":d.id, "success":False, "message":"Upload canceled",
+                        "original_count": original_count, "uploaded_count": 0})
+                return
+            except Exception as e:
+                callback = {"success": False, "message": f"upload_mission failed: {e}",
+                        "update_action": Drone.UpdateMissionAction.UPDATE_CURRENT_MISSION}
+            logger.debug("Upload_mission action finished!")
+            goal_handle.send_feedback({"progress": "Upload_mission action finished!"})
+            goal_handle.set_succeeded({"id":d.id, "success":callback["success"], "message":callback["message"],
+                    "original_count": original_count, "uploaded_count": len(waypoints) if callback["success"] else 0,
+                    "update_action": int(callback["update_action"]), "timed_out": callback.get("timed_out", False)})
+
+        cancel_with_goal(goal_handle, command_executor.submit(d.id, upload,
+                priority=get_task_priority("upload_mission"),
+                name="upload_mission")).add_done_callback(finished)
     return upload_mission
 
 @custom_action
 def set_speed(server):
-    def set_speed(goal):
-        print("Calling set_speed action...")
+    '''
+    Sets the speed of a drone. Queued on the command_executor, where a
+    land_drone or fly_home goal for the drone, or cancelling the goal,
+    preempts it if it has not started yet.
+    '''
+    def set_speed(goal_handle):
+        goal = goal_handle.goal
+        deadline = goal_deadline(goal)
+        logger.debug("Calling set_speed action...")
 
         d = drones.get(goal["id"])
         if not d:
-            print(f"could not find drone with id {goal['id']}")
-            server.set_succeeded({"id":goal["id"], "success":False, "message":"No drone with that id."})
-        else:
-            print('Setting speed to {}...'.format(goal['speed']))
-            callback = d.set_speed(goal["speed"])
-            print("Set_speed service finished!")
-            server.send_feedback({"progress": "Set_speed service finished!"})
-            server.set_succeeded({"id":d.id, "success":callback["success"], "message":callback["message"]})
+            logger.warning("Could not find drone with id %s", goal['id'])
+            goal_handle.set_succeeded({"id":goal["id"], "success":False, "message":"No drone with that id."})
+            return
+
+        def finished(future):
+            try:
+                callback = future.result()
+            except CommandPreempted as e:
+                goal_handle.set_preempted({"id":d.id, "success":False, "message":f"Set_speed {e}"})
+                return
+            except CancelledError:
+                goal_handle.set_canceled({"id":d.id, "success":False, "message":"Set_speed canceled"})
+                return
+            except Exception as e:
+                callback = {"success": False, "message": f"set_speed failed: {e}"}
+            logger.debug("Set_speed service finished!")
+            goal_handle.send_feedback({"progress": "Set_speed service finished!"})
+            goal_handle.set_succeeded({"id":d.id, "success":callback["success"], "message":callback["message"],
+                    "timed_out": callback.get("timed_out", False)})
+
+        logger.debug('Setting speed to %s...', goal['speed'])
+        cancel_with_goal(goal_handle, command_executor.submit(d.id,
+                lambda: d.set_speed(goal["speed"], deadline=deadline),
+                priority=get_task_priority("set_speed"), name="set_speed")).add_done_callback(finished)
     return set_speed
 
 @custom_action
 def get_speed(server):
-    def get_speed(goal):
-        print("Calling get_speed service...")
+    '''
+    Reads the speed of a drone. Queued on the command_executor like the
+    drone's other commands.
+    '''
+    def get_speed(goal_handle):
+        goal = goal_handle.goal
+        deadline = goal_deadline(goal)
+        logger.debug("Calling get_speed service...")
 
         d = drones.get(goal["id"])
         if not d:
-            print(f"could not find drone with id {goal['id']}")
-            server.set_succeeded({"id":goal["id"], "success":False, "message":"No drone with that id.", "speed":0})
-        else:
-            print('Getting speed')
-            callback = d.get_speed()
-            print("Get_speed service finished!")
-            server.send_feedback({"progress": "Get_speed service finished!"})
-            server.set_succeeded({"id":d.id, "success":callback["success"], "message":callback["message"], "speed":callback["speed"]})
+            logger.warning("Could not find drone with id %s", goal['id'])
+            goal_handle.set_succeeded({"id":goal["id"], "success":False, "message":"No drone with that id.", "speed":0})
+            return
+
+        def finished(future):
+            try:
+                callback = future.result()
+            except CancelledError:
+                goal_handle.set_canceled({"id":d.id, "success":False, "message":"Get_speed canceled", "speed":0})
+                return
+            except Exception as e:
+                callback = {"success": False, "message": f"get_speed failed: {e!r}", "speed": 0}
+            logger.debug("Get_speed service finished!")
+            goal_handle.send_feedback({"progress": "Get_speed service finished!"})
+            goal_handle.set_succeeded({"id":d.id, "success":callback["success"], "message":callback["message"],
+                    "speed":callback.get("speed", 0), "timed_out": callback.get("timed_out", False)})
+
+        logger.debug('Getting speed')
+        cancel_with_goal(goal_handle, command_executor.submit(d.id,
+                lambda: d.get_speed(deadline=deadline),
+                priority=get_task_priority("get_speed"), name="get_speed")).add_done_callback(finished)
     return get_speed
 
-print("Starting actions...")
+logger.info("Starting actions...")
+
+if args.metrics_file:
+    server_metrics.schedule_dump(ROS_master_connection, args.metrics_file, args.metrics_interval)
+
+if fleet_state:
+    fleet_state.start()
+    # Clients may have missed changes while the connection was down
+    connection.on_reconnect(fleet_state.request_keyframe)
 
 ROS_master_connection.run_forever()
 ROS_master_connection.terminate()
+if log_listener:
+    log_listener.stop()
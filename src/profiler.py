@@ -0,0 +1,353 @@
+'''
+Profiling of the running server.
+
+A Profiler session is started and stopped at runtime through the profile
+service, so a sluggish server can be examined under real load without a
+restart. It has two modes:
+
+  * SAMPLE periodically records the stack of every thread (reactor, service
+    handlers, command executor workers), so it also shows where time goes
+    outside the handlers. Its cost does not depend on how busy the server
+    is.
+  * CPROFILE runs every service handler, simple action handler and drone
+    command under cProfile, giving exact call counts and times of each
+    function they call, at a noticeable cost to those calls. Since Python
+    3.12 cProfile only allows one profiler to be enabled at a time, so a
+    call that starts while another is profiled runs without its own
+    profile; the summary counts these calls.
+
+Either mode can also trace spans: the start and duration of every service
+call, action goal, drone command and drone service call, written as a
+Chrome trace (open it in chrome://tracing or https://ui.perfetto.dev).
+
+When a session is stopped its results are written to the profile directory
+and a short text summary is returned. get_profiler() returns the Profiler
+shared by the whole server.
+'''
+
+import collections
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from server_log import get_logger
+
+logger = get_logger('profiler')
+
+SAMPLE = 'sample'
+CPROFILE = 'cprofile'
+MODES = (SAMPLE, CPROFILE)
+
+# Leaf functions of threads that are waiting for work rather than running;
+# their samples are left out of the summary, but not of the folded stacks
+IDLE_FUNCTIONS = frozenset(('wait', 'select', 'poll', 'doPoll', '_worker',
+        'get', 'accept', 'recv', 'read', 'sleep'))
+
+
+class _Session:
+
+    def __init__(self, mode, interval, trace, duration):
+        self.mode = mode
+        self.interval = interval # Seconds between samples
+        self.trace = trace
+        self.duration = duration # Seconds until stopped automatically, 0 = never
+        self.started = time.perf_counter()
+        self.started_at = time.strftime('%Y%m%d-%H%M%S')
+        self.stopped = threading.Event()
+        self.samples = 0
+        # Map between stacks (tuples of thread name and function labels,
+        # outermost first) and the number of samples they were seen in
+        self.stacks = collections.Counter()
+        self.profiles = dict() # Map between thread ids and cProfile.Profile
+        self.running = set() # Ids of threads in a profiled call
+        self.unprofiled = 0 # Calls whose profile could not be enabled
+        self.condition = threading.Condition()
+        self.spans = None
+        self.sampler = None
+        self.timer = None
+
+
+class Profiler:
+    '''
+    Starts and stops profiling sessions and writes their results.
+    '''
+
+    MAX_SPANS = 200000 # Spans kept per session; the oldest are dropped
+    STOP_WAIT = 5 # Seconds stop() waits for profiled calls to return
+    SUMMARY_LINES = 30 # Functions listed in a summary
+
+    def __init__(self, directory='profiles'):
+        self.directory = directory
+        self._session = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.last_summary = ""
+        self.last_files = []
+
+    @property
+    def active(self):
+        return self._session is not None
+
+    def state(self):
+        '''
+        returns: dict of {active, mode, tracing, seconds, samples, spans} of
+        the current session
+        '''
+        session = self._session
+        if session is None:
+            return {"active": False, "mode": "", "tracing": False, "seconds": 0.0,
+                    "samples": 0, "spans": 0}
+        return {"active": True, "mode": session.mode, "tracing": session.trace,
+                "seconds": time.perf_counter() - session.started,
+                "samples": session.samples,
+                "spans": len(session.spans) if session.spans is not None else 0}
+
+    def start(self, mode=SAMPLE, interval=0.005, trace=False, duration=0):
+        '''
+        :param mode: SAMPLE or CPROFILE
+        :param interval: seconds between samples in SAMPLE mode
+        :param trace: also record spans of every call
+        :param duration: seconds after which the session stops by itself and
+            writes its results, 0 to run until stop() is called
+        raises: ValueError for an unknown mode, RuntimeError if a session is
+        already running
+        '''
+        if mode not in MODES:
+            raise ValueError(f"unknown profiling mode {mode!r}, expected one of {', '.join(MODES)}")
+        session = _Session(mode, max(interval, 0.001), trace, duration)
+        if trace:
+            session.spans = collections.deque(maxlen=self.MAX_SPANS)
+        with self._lock:
+            if self._session is not None:
+                raise RuntimeError(f"a {self._session.mode} profile is already running")
+            self._session = session
+        if mode == SAMPLE:
+            session.sampler = threading.Thread(target=self._sample, args=(session,),
+                    name='profiler_sampler', daemon=True)
+            session.sampler.start()
+        if duration > 0:
+            session.timer = threading.Timer(duration, self._stop_expired, args=(session,))
+            session.timer.daemon = True
+            session.timer.start()
+        logger.info("Started %s profile%s", mode, " with tracing" if trace else "")
+
+    def stop(self):
+        '''
+        Stops the session and writes its results to the profile directory.
+
+        returns: list of the files written
+        raises: RuntimeError if no session is running
+        '''
+        session = self._session
+        if session is None:
+            raise RuntimeError("no profile is running")
+        files = self._stop_session(session)
+        if files is None:
+            raise RuntimeError("no profile is running")
+        return files
+
+    def call(self, function, *args):
+        '''
+        Calls function(*args), under cProfile if a CPROFILE session is
+        running.
+
+        returns: what function returns
+        '''
+        session = self._session
+        if session is None or session.mode != CPROFILE or getattr(self._local, 'profiling', False):
+            return function(*args)
+        thread_id = threading.get_ident()
+        with session.condition:
+            profile = None
+            if not session.stopped.is_set():
+                profile = session.profiles.get(thread_id)
+                if profile is None:
+                    profile = session.profiles[thread_id] = cProfile.Profile()
+                session.running.add(thread_id)
+        if profile is None:
+            return function(*args)
+        self._local.profiling = True
+        try:
+            try:
+                profile.enable()
+            except ValueError:
+                # "Another profiling tool is already active": another
+                # thread's profile holds sys.monitoring (Python 3.12+)
+                with session.condition:
+                    session.unprofiled += 1
+                return function(*args)
+            try:
+                return function(*args)
+            finally:
+                profile.disable()
+        finally:
+            self._local.profiling = False
+            with session.condition:
+                session.running.discard(thread_id)
+                session.condition.notify_all()
+
+    def span(self, category, name, start, seconds):
+        '''
+        Records a span if the running session traces them.
+
+        :param category: kind of call, e.g. "service", "action", "drone"
+        :param name: name of the service, action or command
+        :param start: time.perf_counter() at the start of the call
+        :param seconds: duration of the call
+        '''
+        session = self._session
+        if session is None or session.spans is None:
+            return
+        thread = threading.current_thread()
+        session.spans.append((category, name, start - session.started, seconds,
+                thread.ident, thread.name))
+
+    def _stop_expired(self, session):
+        # Stops a session whose duration has passed; nobody waits for the
+        # result, so errors are only logged
+        try:
+            self._stop_session(session)
+        except OSError as e:
+            logger.error("Writing the profile to %s failed: %s", self.directory, e)
+
+    def _stop_session(self, session):
+        # Returns the files written, or None if the session was already
+        # stopped by another thread
+        with self._lock:
+            if self._session is not session:
+                return None
+            self._session = None
+        session.stopped.set()
+        if session.timer is not None:
+            session.timer.cancel()
+        if session.sampler is not None:
+            session.sampler.join()
+        seconds = time.perf_counter() - session.started
+        with session.condition:
+            thread_id = threading.get_ident()
+            if thread_id in session.running:
+                # Stopped from inside a profiled call, e.g. the profile
+                # service's own handler. Its profile is complete up to here,
+                # and waiting for the call to return would wait for ourselves.
+                session.profiles[thread_id].disable()
+                session.running.discard(thread_id)
+            session.condition.wait_for(lambda: not session.running, self.STOP_WAIT)
+            # Profiles of calls that are still running cannot be read safely,
+            # and those never enabled have nothing to read
+            profiles = [p for t, p in session.profiles.items()
+                    if t not in session.running and p.getstats()]
+            unfinished = len(session.running)
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, f'profile-{session.started_at}')
+        files = []
+        lines = [f"{session.mode} profile of {seconds:.1f} s"]
+        if session.mode == SAMPLE:
+            files.append(self._write_folded(base + '.folded', session))
+            lines += self._sample_summary(session)
+        else:
+            if unfinished:
+                lines.append(f"{unfinished} calls still running were left out")
+            if session.unprofiled:
+                lines.append(f"{session.unprofiled} calls ran while another was profiled "
+                        "and have no profile of their own")
+            if profiles:
+                stats = pstats.Stats(profiles[0])
+                for profile in profiles[1:]:
+                    stats.add(profile)
+                stats.dump_stats(base + '.pstats')
+                files.append(base + '.pstats')
+                lines += self._profile_summary(stats)
+            else:
+                lines.append("No handler ran while profiling")
+        if session.spans is not None:
+            files.append(self._write_trace(base + '.trace.json', session))
+        summary = '\n'.join(lines) + '\n'
+        with open(base + '.txt', 'w') as f:
+            f.write(summary)
+        files.append(base + '.txt')
+        self.last_summary = summary
+        self.last_files = files
+        logger.info("Stopped %s profile, wrote %s", session.mode, ', '.join(files))
+        return files
+
+    def _sample(self, session):
+        own = threading.get_ident()
+        while not session.stopped.wait(session.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                stack.reverse()
+                session.stacks[tuple(stack)] += 1
+            session.samples += 1
+
+    def _sample_summary(self, session):
+        total = collections.Counter() # Samples a function is on the stack
+        own = collections.Counter() # Samples a function is running itself
+        busy = 0
+        for stack, count in session.stacks.items():
+            if stack[-1].split(' ', 1)[0] in IDLE_FUNCTIONS:
+                continue
+            busy += count
+            own[stack[-1]] += count
+            for label in set(stack[1:]):
+                total[label] += count
+        lines = [f"{session.samples} samples every {session.interval * 1000:g} ms, "
+                 f"{busy} of running threads"]
+        if not busy:
+            return lines
+        lines.append(f"{'own %':>7} {'total %':>8}  function")
+        for label, count in own.most_common(self.SUMMARY_LINES):
+            lines.append(f"{100 * count / busy:7.1f} {100 * total[label] / busy:8.1f}  {label}")
+        return lines
+
+    def _profile_summary(self, stats):
+        output = io.StringIO()
+        stats.stream = output
+        stats.sort_stats('cumulative').print_stats(self.SUMMARY_LINES)
+        return [line for line in output.getvalue().splitlines() if line.strip()]
+
+    def _write_folded(self, path, session):
+        # One line per stack: frames separated by ";" and its sample count,
+        # the input format of flamegraph.pl and speedscope
+        with open(path, 'w') as f:
+            for stack, count in session.stacks.most_common():
+                f.write(';'.join(stack) + f' {count}\n')
+        return path
+
+    def _write_trace(self, path, session):
+        pid = os.getpid()
+        events = []
+        threads = dict()
+        for category, name, start, seconds, thread_id, thread_name in session.spans:
+            threads[thread_id] = thread_name
+            events.append({"name": name, "cat": category, "ph": "X", "pid": pid,
+                    "tid": thread_id, "ts": start * 1e6, "dur": seconds * 1e6})
+        events += [{"name": "thread_name", "ph": "M", "pid": pid, "tid": thread_id,
+                "args": {"name": thread_name}} for thread_id, thread_name in threads.items()]
+        with open(path, 'w') as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        return path
+
+
+def _label(code):
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+_profiler = Profiler()
+
+
+def get_profiler():
+    '''
+    returns: the Profiler shared by the server
+    '''
+    return _profiler
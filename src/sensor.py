@@ -9,7 +9,6 @@ class Sensor(ABC):
         self.sensor_type = sensor_type
         self.parent_drone_id = parent_drone_id
         self.id = id
-        self.topics = []
         self.services = []
         self.ROS_master_connection = ROS_master_connection
         self.sensor_namespace = '/sensor_' + str(self.id)
@@ -0,0 +1,101 @@
+'''
+Logging for the server.
+
+Modules log through get_logger() instead of print(), so that messages have
+levels and can be turned off, and payloads (drone maps, waypoint lists,
+service responses) are passed through summarize(): they are only formatted
+if the message is actually logged, and then only up to a size limit.
+
+configure() sets up the handler once, at startup. By default records are
+handed to a background thread that writes them, so a slow terminal or disk
+never holds up a service handler. Records are still formatted on the
+calling thread, while the payloads they refer to are consistent; the
+summaries keep that cheap.
+'''
+
+import logging
+import logging.handlers
+import queue
+import reprlib
+
+LOGGER_NAME = 'isaacs_server'
+FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+# Longest summary of a payload, in characters
+SUMMARY_LIMIT = 300
+
+_repr = reprlib.Repr()
+_repr.maxlevel = 3
+_repr.maxdict = 8
+_repr.maxlist = 8
+_repr.maxtuple = 8
+_repr.maxset = 8
+_repr.maxstring = 80
+_repr.maxother = 80
+
+
+def get_logger(name):
+    '''
+    :param name: name of the module or component, e.g. "operator"
+    returns: logging.Logger below the server's logger
+    '''
+    return logging.getLogger(f'{LOGGER_NAME}.{name}')
+
+
+class Summary:
+    '''
+    Formats a payload for a log message only when the message is emitted,
+    showing at most a few items of every container and at most limit
+    characters overall.
+    '''
+
+    __slots__ = ('value', 'limit')
+
+    def __init__(self, value, limit=SUMMARY_LIMIT):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self):
+        text = _repr.repr(self.value)
+        if len(text) > self.limit:
+            text = text[:self.limit - 3] + '...'
+        return text
+
+    __repr__ = __str__
+
+
+def summarize(value, limit=SUMMARY_LIMIT):
+    '''
+    :param value: payload to log, e.g. a dict of drones or a service response
+    :param limit: longest summary in characters
+    returns: Summary to pass as a logging argument, e.g.
+    logger.debug("Response: %s", summarize(response))
+    '''
+    return Summary(value, limit)
+
+
+def configure(level='INFO', log_file=None, background=True):
+    '''
+    Sets up the server's logger. Call once, at startup.
+
+    :param level: name or number of the lowest level logged
+    :param log_file: file to append to instead of standard error
+    :param background: write records from a background thread
+    returns: the logging.handlers.QueueListener writing the records, to be
+    stopped at shutdown, or None if not writing in the background
+    '''
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(level)
+    logger.propagate = False
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    handler = logging.FileHandler(log_file) if log_file else logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(FORMAT))
+    if not background:
+        logger.addHandler(handler)
+        return None
+    records = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    return listener
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from copy import deepcopy
+
+class ServiceCache:
+    '''
+    Bounded LRU/TTL cache of service responses, keyed on
+    (service name, canonical request hash).
+
+    Used by the operator to answer retried service calls without re-running
+    the handler. Entries are evicted least-recently-used first once max_size
+    is reached, and are treated as misses once they are older than ttl
+    seconds. A ttl of 0 or None disables expiry.
+    '''
+
+    def __init__(self, max_size=256, ttl=30.0, clock=time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(service_name, request):
+        '''
+        Builds the cache key for a request. The request is serialized with
+        sorted keys so that two requests with the same content but different
+        key order share an entry.
+
+        :param service_name: name of the service the request was made to
+        :param request: dict of the incoming service request
+        '''
+        canonical = json.dumps(dict(request), sort_keys=True, default=str,
+                separators=(',', ':'))
+        digest = hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+        return (service_name, digest)
+
+    def get(self, service_name, request):
+        '''
+        Returns the cached response for the request, or None if there is no
+        live entry for it.
+        '''
+        key = self.make_key(service_name, request)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry):
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, service_name, request, response, copy=True):
+        '''
+        Stores a copy of the response so later changes to server state do
+        not leak into the cached entry.
+
+        :param copy: deep copy the response. Pass False for responses built
+            from data that is replaced rather than modified (e.g. the
+            fleet_snapshot), which are then stored without copying what
+            they refer to.
+        '''
+        key = self.make_key(service_name, request)
+        stored = deepcopy(dict(response)) if copy else dict(response)
+        with self._lock:
+            self._entries[key] = (self.clock(), stored)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, service_name, request=None):
+        '''
+        Drops the entry for one request, or every entry of the service if no
+        request is given.
+        '''
+        with self._lock:
+            if request is not None:
+                self._entries.pop(self.make_key(service_name, request), None)
+                return
+            for key in [k for k in self._entries if k[0] == service_name]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        '''
+        Returns a dict of the cache counters.
+        '''
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+    def _expired(self, entry):
+        return bool(self.ttl) and self.clock() - entry[0] > self.ttl
+
+    def __len__(self):
+        return len(self._entries)
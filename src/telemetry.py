@@ -0,0 +1,189 @@
+import threading
+import time
+import numpy as np
+import roslibpy
+from server_log import get_logger
+
+logger = get_logger('telemetry')
+
+POSITION_DTYPE = np.dtype([
+    ('stamp', np.float64), # Time the sample was received, in unix seconds
+    ('latitude', np.float64),
+    ('longitude', np.float64),
+    ('altitude', np.float64)
+])
+
+STATUS_DTYPE = np.dtype([
+    ('stamp', np.float64),
+    ('flight_status', np.uint8) # Drone.Flight_Status
+])
+
+class RingBuffer:
+    '''
+    Fixed-size buffer of the most recent samples of a structured dtype.
+
+    The storage is allocated once; appending overwrites the oldest sample
+    when the buffer is full, so memory stays constant however long a drone
+    keeps publishing.
+    '''
+
+    def __init__(self, capacity, dtype):
+        self._data = np.zeros(capacity, dtype=dtype)
+        self._next = 0 # Index the next sample is written to
+        self._count = 0
+
+    def append(self, sample):
+        '''
+        :param sample: tuple with one value per field of the dtype
+        '''
+        self._data[self._next] = sample
+        self._next = (self._next + 1) % len(self._data)
+        self._count = min(self._count + 1, len(self._data))
+
+    def latest(self):
+        '''
+        returns: the most recent sample (a copy), or None if the buffer is empty
+        '''
+        if not self._count:
+            return None
+        return self._data[self._next - 1].copy()
+
+    def last(self, count):
+        '''
+        returns: array of up to count most recent samples, oldest first
+        '''
+        count = min(count, self._count)
+        if not count:
+            return self._data[:0].copy()
+        start = self._next - count
+        if start >= 0:
+            return self._data[start:self._next].copy()
+        return np.concatenate((self._data[start:], self._data[:self._next]))
+
+    def __len__(self):
+        return self._count
+
+
+class DroneTelemetry:
+    '''
+    Recent position and flight status samples of one drone, and the
+    roslibpy.Topic subscriptions feeding them.
+    '''
+
+    def __init__(self, drone, capacity):
+        self.drone = drone
+        self.positions = RingBuffer(capacity, POSITION_DTYPE)
+        self.statuses = RingBuffer(capacity, STATUS_DTYPE)
+        self.subscriptions = dict() # Map between topic names and roslibpy.Topics
+        self.lock = threading.Lock()
+
+    def received_position(self, message):
+        self.drone.received_position_update(message)
+        with self.lock:
+            self.positions.append((time.time(), message["latitude"],
+                    message["longitude"], message["altitude"]))
+
+    def received_state(self, message):
+        self.drone.received_state_update(message)
+        with self.lock:
+            self.statuses.append((time.time(), self.drone.flight_status))
+
+
+class Telemetry:
+    '''
+    Subscribes to the position and state topics of every drone and keeps
+    the last samples of each in ring buffers.
+
+    Drivers decide which of their topics carry telemetry with
+    Drone.telemetry_kind(). Each drone's topics are subscribed on that
+    drone's rosbridge connection, which it shares with other drones, so
+    rosbridge is asked to throttle them to at most one message every
+    throttle_rate milliseconds and to drop all but the newest queued
+    message, instead of forwarding every message of a high-rate GPS topic.
+    '''
+
+    def __init__(self, ros, capacity=600, throttle_rate=100, queue_length=1):
+        self.ros = ros
+        self.capacity = capacity
+        self.throttle_rate = throttle_rate
+        self.queue_length = queue_length
+        self._drones = dict() # Map between drone IDs and DroneTelemetry
+        self._lock = threading.Lock()
+
+    def subscribe(self, drone, topics):
+        '''
+        Subscribes to the drone's telemetry topics among the given ones.
+        Topics already subscribed to are left alone, so this can be called
+        every time the drone saves topics.
+
+        :param drone: Drone instance
+        :param topics: list of {name, type} dicts of the drone's topics
+        '''
+        with self._lock:
+            telemetry = self._drones.get(drone.id)
+            if telemetry is None:
+                telemetry = DroneTelemetry(drone, self.capacity)
+                self._drones[drone.id] = telemetry
+        handlers = {
+            "position": telemetry.received_position,
+            "state": telemetry.received_state
+        }
+        for topic in topics:
+            kind = drone.telemetry_kind(topic["name"], topic["type"])
+            if kind not in handlers or topic["name"] in telemetry.subscriptions:
+                continue
+            listener = roslibpy.Topic(drone.ROS_master_connection or self.ros, topic["name"], topic["type"],
+                    throttle_rate=self.throttle_rate, queue_length=self.queue_length)
+            listener.subscribe(handlers[kind])
+            telemetry.subscriptions[topic["name"]] = listener
+            logger.info("Subscribed to %s topic %s of drone %s", kind, topic['name'], drone.id)
+
+    def unsubscribe(self, drone_id):
+        '''
+        Stops listening to the drone's topics and drops its samples.
+        '''
+        with self._lock:
+            telemetry = self._drones.pop(drone_id, None)
+        if telemetry:
+            for listener in telemetry.subscriptions.values():
+                listener.unsubscribe()
+
+    def clear(self):
+        with self._lock:
+            drone_ids = list(self._drones)
+        for drone_id in drone_ids:
+            self.unsubscribe(drone_id)
+
+    def latest_positions(self):
+        '''
+        returns: dict of {drone id: latest position sample} of the drones
+        that have received a position
+        '''
+        with self._lock:
+            drones = list(self._drones.items())
+        positions = dict()
+        for drone_id, telemetry in drones:
+            with telemetry.lock:
+                position = telemetry.positions.latest()
+            if position is not None:
+                positions[drone_id] = position
+        return positions
+
+    def state(self, drone_id, samples=0):
+        '''
+        :param drone_id: id of the drone
+        :param samples: number of recent position samples to include
+        returns: dict with the latest position sample (or None), the latest
+        flight status sample (or None) and an array of up to samples recent
+        positions, or None if the drone has no telemetry
+        '''
+        with self._lock:
+            telemetry = self._drones.get(drone_id)
+        if telemetry is None:
+            return None
+        with telemetry.lock:
+            return {
+                "position": telemetry.positions.latest(),
+                "status": telemetry.statuses.latest(),
+                "history": telemetry.positions.last(samples)
+            }
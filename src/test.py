@@ -3,6 +3,32 @@ import roslibpy
 import roslibpy.actionlib
 import timeout_decorator
 import constants
+import cProfile
+import threading
+import time
+import json
+import logging
+import os
+import pstats
+import tempfile
+from unittest import mock
+from action_server import ConcurrentActionServer
+from change_log import ChangeLog
+from command_executor import CommandExecutor, CommandPreempted, Priority
+from connection import ConnectionManager, ConnectionPool
+from deadline import Deadline, DeadlineExceeded
+from drone import Drone
+from fleet_state import FleetStatePublisher, POSITION, FLIGHT_STATUS
+from djimatrice_drone import DjiMatriceDrone
+from mavros_drone import MavrosDrone
+from service_cache import ServiceCache
+import metrics
+import server_log
+from profiler import Profiler, CPROFILE, SAMPLE
+from telemetry import DroneTelemetry, RingBuffer, POSITION_DTYPE
+from topic_index import TopicIndex, pack_topics
+import numpy as np
+import waypoints as waypoint_arrays
 
 '''
 Make sure to restart operator.py before running make
@@ -140,6 +166,90 @@ class TestVRConnection(unittest.TestCase):
         self.assertTrue(result["success"])
         self.assertNotIn(test_drone, result['drones_available'])
 
+    @timeout_decorator.timeout(TIMEOUT)
+    def test_all_drones_available_version(self):
+        if not client.is_connected:
+            client.run()
+        serverReset()
+        available = roslibpy.Service(client, 'isaacs_server/all_drones_available', 'isaacs_server/AllDronesAvailable')
+        result = wrapped_service_call(available, roslibpy.ServiceRequest({}))
+        self.assertTrue(result["success"])
+        version = result["version"]
+
+        # Polling again without changes keeps the version
+        result = wrapped_service_call(available, roslibpy.ServiceRequest({}))
+        self.assertEqual(result["version"], version)
+
+        # Registering a drone changes it
+        service = roslibpy.Service(client, 'isaacs_server/register_drone', 'isaacs_server/RegisterDrone')
+        request = roslibpy.ServiceRequest({'drone_name': "version_dji", "drone_type":"DjiMatrice"})
+        result = wrapped_service_call(service, request)
+        self.assertTrue(result["success"])
+        result = wrapped_service_call(available, roslibpy.ServiceRequest({}))
+        self.assertGreater(result["version"], version)
+        self.assertEqual(len(result["drones_available"]), 1)
+
+    @timeout_decorator.timeout(TIMEOUT)
+    def test_drones_changed_since(self):
+        if not client.is_connected:
+            client.run()
+        serverReset()
+        available = roslibpy.Service(client, 'isaacs_server/all_drones_available', 'isaacs_server/AllDronesAvailable')
+        version = wrapped_service_call(available, roslibpy.ServiceRequest({}))["version"]
+
+        service = roslibpy.Service(client, 'isaacs_server/register_drone', 'isaacs_server/RegisterDrone')
+        request = roslibpy.ServiceRequest({'drone_name': "delta_mavros", "drone_type":"Mavros"})
+        uid = wrapped_service_call(service, request)["id"]
+
+        changes = roslibpy.Service(client, 'isaacs_server/drones_changed_since', 'isaacs_server/DronesChangedSince')
+        result = wrapped_service_call(changes, roslibpy.ServiceRequest({"version": version}))
+        self.assertTrue(result["success"])
+        self.assertFalse(result["full"])
+        self.assertEqual([d["id"] for d in result["updated"]], [uid])
+        self.assertEqual(result["removed"], [])
+        version = result["version"]
+
+        # Nothing changed since the last response
+        result = wrapped_service_call(changes, roslibpy.ServiceRequest({"version": version}))
+        self.assertEqual(result["updated"], [])
+        self.assertEqual(result["removed"], [])
+
+    @timeout_decorator.timeout(TIMEOUT)
+    def test_control_fleet(self):
+        if not client.is_connected:
+            client.run()
+        serverReset()
+        service = roslibpy.Service(client, 'isaacs_server/register_drone', 'isaacs_server/RegisterDrone')
+        ids = [wrapped_service_call(service, roslibpy.ServiceRequest({'drone_name': f"fleet_dji_{i}", "drone_type":"DjiMatrice"}))["id"]
+                for i in range(3)]
+
+        action_client = roslibpy.actionlib.ActionClient(client,"isaacs_server/control_fleet",'isaacs_server/ControlFleetAction')
+        goal = roslibpy.actionlib.Goal(action_client, roslibpy.Message({'ids': ids + [9999], "control_task":"land_drone"}))
+        feedback = []
+        goal.on('feedback', feedback.append)
+        goal.send()
+        result = goal.wait(10)
+        # The unknown id fails, so the fleet as a whole fails
+        self.assertFalse(result["success"])
+        self.assertEqual([r["id"] for r in result["results"]], ids + [9999])
+        self.assertFalse(result["results"][-1]["success"])
+        self.assertEqual(max(f["completed"] for f in feedback), len(ids) + 1)
+
+    @timeout_decorator.timeout(TIMEOUT)
+    def test_drone_state(self):
+        if not client.is_connected:
+            client.run()
+        serverReset()
+        service = roslibpy.Service(client, 'isaacs_server/register_drone', 'isaacs_server/RegisterDrone')
+        uid = wrapped_service_call(service, roslibpy.ServiceRequest({'drone_name': "state_mavros", "drone_type":"Mavros"}))["id"]
+
+        service = roslibpy.Service(client, 'isaacs_server/drone_state', 'isaacs_server/DroneState')
+        result = wrapped_service_call(service, roslibpy.ServiceRequest({"id": uid, "samples": 10}))
+        self.assertTrue(result["success"])
+        self.assertFalse(result["has_position"])
+        result = wrapped_service_call(service, roslibpy.ServiceRequest({"id": 9999, "samples": 0}))
+        self.assertFalse(result["success"])
+
     @timeout_decorator.timeout(TIMEOUT)
     def test_query_topics_dji(self):
         # Register Dji Drone
@@ -917,5 +1027,900 @@ class TestIsolatedControl(unittest.TestCase):
         result = goal.wait(10)
         self.assertTrue(result["success"])
 
+class TestChangeLog(unittest.TestCase):
+
+    def test_changed_since(self):
+        log = ChangeLog(max_length=3)
+        log.record(1)
+        v = log.record(3)
+        log.record(3)
+        self.assertEqual(log.changed_since(v), {3})
+        self.assertEqual(log.changed_since(log.version), set())
+        log.record(5)
+        # The record of the first change has been dropped
+        self.assertIsNone(log.changed_since(0))
+        self.assertEqual(log.changed_since(1), {3, 5})
+        # Versions the log has not reached yet need a full resync
+        self.assertIsNone(log.changed_since(log.version + 1))
+
+
+class TestTopicIndex(unittest.TestCase):
+
+    def test_owner_queries_and_removal(self):
+        index = TopicIndex()
+        index.add(1, "/drone_1/gps", "sensor_msgs/NavSatFix")
+        index.add(1, "/drone_1/state", "mavros_msgs/State")
+        index.add(2, "/sensor_2/depth", "sensor_msgs/PointCloud2")
+        index.add(3, "/drone_3/gps", "sensor_msgs/NavSatFix")
+        self.assertEqual(index.topics_of(1, 2), [
+            {"name": "/drone_1/gps", "type": "sensor_msgs/NavSatFix"},
+            {"name": "/drone_1/state", "type": "mavros_msgs/State"},
+            {"name": "/sensor_2/depth", "type": "sensor_msgs/PointCloud2"}])
+        # Querying does not change what is stored
+        self.assertEqual(len(index.topics_of(1)), 2)
+
+        self.assertEqual(sorted(index.remove_owner(1)), ["/drone_1/gps", "/drone_1/state"])
+        self.assertNotIn("/drone_1/gps", index)
+        self.assertEqual(index.topics_of(1), [])
+        self.assertEqual(len(index), 2)
+
+    def test_topic_moves_to_new_owner(self):
+        index = TopicIndex()
+        self.assertIsNone(index.add(1, "/shared", "std_msgs/String"))
+        self.assertEqual(index.add(3, "/shared", "std_msgs/String"), 1)
+        self.assertIsNone(index.add(3, "/shared", "std_msgs/String"))
+        self.assertEqual(index.get("/shared"), ("std_msgs/String", 3))
+        self.assertEqual(index.topics_of(1), [])
+
+    def test_pack_topics(self):
+        topics = [{"name": "/a", "type": "t1"}, {"name": "/b", "type": "t2"}, {"name": "/c", "type": "t1"}]
+        names, types, type_indices = pack_topics(topics)
+        self.assertEqual(names, ["/a", "/b", "/c"])
+        self.assertEqual([types[i] for i in type_indices], ["t1", "t2", "t1"])
+        self.assertEqual(len(types), 2)
+
+    def test_find(self):
+        index = TopicIndex()
+        index.add(1, "/drone_1/mavros/global_position/global", "sensor_msgs/NavSatFix")
+        index.add(1, "/drone_1/mavros/state", "mavros_msgs/State")
+        index.add(3, "/drone_3/mavros/global_position/global", "sensor_msgs/NavSatFix")
+        index.add(3, "/drone_3/mavros/state", "mavros_msgs/State")
+        index.add(4, "/drone_3_camera/points", "sensor_msgs/PointCloud2")
+        names = lambda topics: [t["name"] for t in topics]
+        self.assertEqual(names(index.find("/drone_3/")),
+            ["/drone_3/mavros/global_position/global", "/drone_3/mavros/state"])
+        self.assertEqual(names(index.find(topic_type="sensor_msgs/NavSatFix")),
+            ["/drone_1/mavros/global_position/global", "/drone_3/mavros/global_position/global"])
+        self.assertEqual(names(index.find("/drone_3", "sensor_msgs/PointCloud2")),
+            ["/drone_3_camera/points"])
+        self.assertEqual(index.find("/drone_5/"), [])
+        self.assertEqual(len(index.find()), 5)
+        index.remove_owner(3)
+        self.assertEqual(names(index.find("/drone_3")), ["/drone_3_camera/points"])
+
+    def test_changes_since(self):
+        index = TopicIndex()
+        index.add(1, "/a", "std_msgs/String")
+        version = index.changes.version
+        index.add(1, "/b", "std_msgs/String")
+        index.remove("/a")
+        _, full, updated, removed = index.changes_since(version)
+        self.assertFalse(full)
+        self.assertEqual(updated, [{"name": "/b", "type": "std_msgs/String"}])
+        self.assertEqual(removed, ["/a"])
+
+
+class TestServiceCache(unittest.TestCase):
+
+    def test_put_without_copy(self):
+        cache = ServiceCache(max_size=8, ttl=0)
+        drones = [{"id": 1, "topics": []}]
+        cache.put("all_drones_available", {}, {"success": True, "drones_available": drones}, copy=False)
+        cache.put("query_topics", {"id": 1}, {"success": True, "all_topics": drones})
+        self.assertIs(cache.get("all_drones_available", {})["drones_available"], drones)
+        self.assertIsNot(cache.get("query_topics", {"id": 1})["all_topics"], drones)
+
+    def test_retry_after_interleaved_calls(self):
+        cache = ServiceCache(max_size=8, ttl=0)
+        cache.put("register_drone", {"drone_name": "a", "drone_type": "Mavros"}, {"success": True, "id": 1})
+        cache.put("register_drone", {"drone_name": "b", "drone_type": "Mavros"}, {"success": True, "id": 3})
+        cache.put("save_drone_topics", {"id": 1, "publishes": []}, {"success": True})
+        # Key order of the request does not matter
+        cached = cache.get("register_drone", {"drone_type": "Mavros", "drone_name": "a"})
+        self.assertEqual(cached["id"], 1)
+        self.assertEqual(cache.hits, 1)
+        self.assertIsNone(cache.get("register_drone", {"drone_name": "c", "drone_type": "Mavros"}))
+        self.assertEqual(cache.misses, 1)
+
+    def test_lru_eviction(self):
+        cache = ServiceCache(max_size=2, ttl=0)
+        cache.put("s", {"id": 1}, {"success": True})
+        cache.put("s", {"id": 2}, {"success": True})
+        cache.get("s", {"id": 1})
+        cache.put("s", {"id": 3}, {"success": True})
+        self.assertIsNotNone(cache.get("s", {"id": 1}))
+        self.assertIsNone(cache.get("s", {"id": 2}))
+        self.assertEqual(cache.evictions, 1)
+
+    def test_ttl_and_invalidate(self):
+        now = [0.0]
+        cache = ServiceCache(max_size=8, ttl=5, clock=lambda: now[0])
+        cache.put("all_drones_available", {}, {"success": True})
+        cache.put("query_topics", {"id": 0}, {"success": True})
+        now[0] = 6.0
+        self.assertIsNone(cache.get("all_drones_available", {}))
+        cache.put("all_drones_available", {}, {"success": True})
+        cache.invalidate("all_drones_available")
+        self.assertIsNone(cache.get("all_drones_available", {}))
+
+
+class TestCommandExecutor(unittest.TestCase):
+
+    def test_same_drone_in_order(self):
+        executor = CommandExecutor(max_workers=4)
+        order = []
+        futures = [executor.submit(1, lambda i=i: order.append(i)) for i in range(20)]
+        for future in futures:
+            future.result(timeout=5)
+        self.assertEqual(order, list(range(20)))
+        self.assertEqual(executor.pending(1), 0)
+        executor.shutdown()
+
+    def test_slow_drone_does_not_block_others(self):
+        executor = CommandExecutor(max_workers=2)
+        release = threading.Event()
+        slow = executor.submit(1, lambda: release.wait(5))
+        queued = executor.submit(1, lambda: "second")
+        self.assertEqual(executor.pending(1), 2)
+        self.assertEqual(executor.submit(2, lambda: "fast").result(timeout=2), "fast")
+        self.assertFalse(queued.done())
+        release.set()
+        self.assertTrue(slow.result(timeout=5))
+        self.assertEqual(queued.result(timeout=5), "second")
+        executor.shutdown()
+
+    def test_exception_is_reported(self):
+        executor = CommandExecutor(max_workers=1)
+        def fail():
+            raise RuntimeError("no link")
+        future = executor.submit(1, fail)
+        self.assertRaises(RuntimeError, future.result, 5)
+        self.assertEqual(executor.submit(1, lambda: 1).result(timeout=5), 1)
+        executor.shutdown()
+
+    def test_emergency_preempts_bulk(self):
+        executor = CommandExecutor(max_workers=1)
+        release = threading.Event()
+        order = []
+        running = executor.submit(1, lambda: release.wait(5), priority=Priority.BULK)
+        upload = executor.submit(1, lambda: order.append("upload"), priority=Priority.BULK)
+        start = executor.submit(1, lambda: order.append("start"))
+        land = executor.submit(1, lambda: order.append("land"), priority=Priority.EMERGENCY, name="land_drone")
+        # The land does not wait for the running command
+        land.result(timeout=2)
+        self.assertFalse(running.done())
+        with self.assertRaises(CommandPreempted) as preempted:
+            upload.result(timeout=0)
+        self.assertEqual(preempted.exception.by, "land_drone")
+        release.set()
+        start.result(timeout=5)
+        self.assertEqual(order, ["land", "start"])
+        self.assertEqual(executor.metrics()["preemptions"], 1)
+        executor.shutdown()
+
+    def test_emergency_latency_under_load(self):
+        # Every worker is busy with slow uploads for other drones, and the
+        # drone itself has an upload running and more queued
+        executor = CommandExecutor(max_workers=4)
+        release = threading.Event()
+        for drone_id in range(1, 21):
+            for _ in range(5):
+                executor.submit(drone_id, lambda: release.wait(5), priority=Priority.BULK)
+        latencies = []
+        for drone_id in range(1, 21):
+            submitted = time.monotonic()
+            executor.submit(drone_id, lambda: None, priority=Priority.EMERGENCY).result(timeout=1)
+            latencies.append(time.monotonic() - submitted)
+        release.set()
+        self.assertLess(max(latencies), 0.1)
+        metrics = executor.metrics()
+        self.assertEqual(metrics["waits"]["EMERGENCY"]["started"], 20)
+        self.assertEqual(metrics["max_depth"], 4)
+        self.assertEqual(metrics["preemptions"], 80)
+        executor.shutdown()
+
+    def test_cancel_drone(self):
+        executor = CommandExecutor(max_workers=2)
+        release = threading.Event()
+        ran = []
+        running = executor.submit(1, lambda: release.wait(5))
+        queued = [executor.submit(1, lambda: ran.append("queued")),
+                executor.submit(1, lambda: ran.append("upload"), priority=Priority.BULK)]
+        other = executor.submit(2, lambda: ran.append("other"))
+        self.assertEqual(executor.cancel_drone(1, "shutdown_drone"), 2)
+        for future in queued:
+            with self.assertRaises(CommandPreempted) as preempted:
+                future.result(timeout=0)
+            self.assertEqual(preempted.exception.by, "shutdown_drone")
+        other.result(timeout=5)
+        # The running command is left to finish
+        release.set()
+        self.assertTrue(running.result(timeout=5))
+        self.assertEqual(ran, ["other"])
+        self.assertEqual(executor.pending(1), 0)
+        self.assertEqual(executor.cancel_drone(1, "reset"), 0)
+        executor.shutdown()
+
+
+class TestActionServer(unittest.TestCase):
+
+    class FakeRos:
+        id_counter = 0
+        is_connected = True
+
+        def __init__(self):
+            self.sent = []
+
+        def send_on_ready(self, message):
+            self.sent.append(message)
+
+        def on(self, event, callback):
+            pass
+
+        def call_later(self, delay, callback):
+            pass
+
+        def results(self):
+            return {m["msg"]["status"]["goal_id"]["id"]: (m["msg"]["status"]["status"], m["msg"]["result"])
+                    for m in self.sent if m["op"] == "publish" and m["topic"].endswith("/result")}
+
+    def goal(self, goal_id):
+        return {"goal_id": {"id": goal_id, "stamp": {"secs": 0, "nsecs": 0}}, "goal": {}}
+
+    def test_cancel_queued_command(self):
+        ros = self.FakeRos()
+        server = ConcurrentActionServer(ros, 'test_action', 'isaacs_server/TestAction')
+        executor = CommandExecutor(max_workers=1)
+        release = threading.Event()
+        ran = []
+
+        def handler(goal_handle):
+            def command():
+                ran.append(goal_handle.goal_id["id"])
+                release.wait(5)
+            def finished(future):
+                if future.cancelled():
+                    goal_handle.set_canceled({"success": False})
+                else:
+                    goal_handle.set_succeeded({"success": True})
+            future = executor.submit(1, command)
+            goal_handle.on_cancel(future.cancel)
+            future.add_done_callback(finished)
+
+        server.start(handler)
+        server._on_goal_message(self.goal("running"))
+        server._on_goal_message(self.goal("queued"))
+        # Only the queued command can still be dropped
+        server._on_cancel_message({"id": "", "stamp": {"secs": 0, "nsecs": 0}})
+        self.assertEqual(ros.results(), {"queued": (roslibpy.actionlib.GoalStatus.PREEMPTED, {"success": False})})
+        release.set()
+        executor.submit(1, lambda: None).result(timeout=5)
+        self.assertEqual(ran, ["running"])
+        self.assertEqual(ros.results()["running"], (roslibpy.actionlib.GoalStatus.SUCCEEDED, {"success": True}))
+        self.assertEqual(server.active_goals(), [])
+        executor.shutdown()
+
+    def test_cancel_before_callback_registered(self):
+        ros = self.FakeRos()
+        server = ConcurrentActionServer(ros, 'test_action', 'isaacs_server/TestAction')
+        handles = []
+        server.start(handles.append)
+        server._on_goal_message(self.goal("late"))
+        server._on_cancel_message({"id": "late", "stamp": {"secs": 1, "nsecs": 0}})
+        cancelled = []
+        handles[0].on_cancel(lambda: cancelled.append(True))
+        self.assertEqual(cancelled, [True])
+        self.assertTrue(handles[0].cancel_requested())
+
+
+class TestServiceSteps(unittest.TestCase):
+
+    class FakeService:
+        name = "fake"
+
+        def __init__(self, responses):
+            self.responses = list(responses)
+            self.calls = 0
+            self.timeouts = []
+
+        def call(self, request, timeout=None):
+            self.calls += 1
+            self.timeouts.append(timeout)
+            response = self.responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+    def make_drone(self, services):
+        drone = MavrosDrone("steps_mavros", "Mavros", None, 1)
+        drone.service_proxy = lambda name, service_type: services[name]
+        return drone
+
+    def test_retry_then_succeed(self):
+        first = self.FakeService([TimeoutError(), {"ok": True}])
+        second = self.FakeService([{"ok": True}])
+        drone = self.make_drone({"a": first, "b": second})
+        steps = [Drone.ServiceStep("first", "a", "t", {}, lambda r: r["ok"]),
+                 Drone.ServiceStep("second", "b", "t", {}, lambda r: r["ok"])]
+        reports = []
+        result = drone.run_service_steps(steps, timeout=1, retries=1, backoff=0, on_step=reports.append)
+        self.assertTrue(result["success"])
+        self.assertEqual([r["step"] for r in reports], ["first", "first", "second"])
+        self.assertEqual([r["attempt"] for r in reports], [1, 2, 1])
+        self.assertEqual(first.calls, 2)
+
+    def test_abort_after_retries(self):
+        first = self.FakeService([{"ok": False}] * 3)
+        second = self.FakeService([])
+        drone = self.make_drone({"a": first, "b": second})
+        steps = [Drone.ServiceStep("first", "a", "t", {}, lambda r: r["ok"]),
+                 Drone.ServiceStep("second", "b", "t", {}, lambda r: r["ok"])]
+        result = drone.run_service_steps(steps, timeout=1, retries=2, backoff=0)
+        self.assertFalse(result["success"])
+        self.assertEqual(result["message"], "first failed")
+        self.assertEqual(first.calls, 3)
+        self.assertEqual(second.calls, 0)
+
+    def test_deadline_bounds_steps(self):
+        first = self.FakeService([TimeoutError()] * 3)
+        drone = self.make_drone({"a": first})
+        steps = [Drone.ServiceStep("first", "a", "t", {}, lambda r: r["ok"])]
+        result = drone.run_service_steps(steps, timeout=5, retries=2, backoff=0.2,
+                deadline=Deadline(0.1))
+        # The backoff would outlast the deadline, so no retry is made
+        self.assertFalse(result["success"])
+        self.assertTrue(result["timed_out"])
+        self.assertEqual(first.calls, 1)
+        self.assertLessEqual(first.timeouts[0], 0.1)
+        self.assertEqual(drone.service_timeouts, {"fake": 1})
+
+
+class TestDeadline(unittest.TestCase):
+
+    def test_remaining(self):
+        deadline = Deadline(10)
+        self.assertFalse(deadline.expired)
+        self.assertLessEqual(deadline.timeout(), 10)
+        self.assertEqual(deadline.timeout(limit=2), 2)
+        expired = Deadline(0)
+        self.assertTrue(expired.expired)
+        self.assertEqual(expired.remaining(), 0)
+        self.assertRaises(DeadlineExceeded, expired.timeout)
+
+    def test_timeout_reported(self):
+        drone = DjiMatriceDrone("deadline_dji", "DjiMatrice", None, 1)
+        class SlowService:
+            name = "isaacs_server/fake_drone_control"
+            def call(self, request, timeout=None):
+                raise roslibpy.core.RosTimeoutError("no response")
+        drone.service_proxy = lambda name, service_type, priority=False: SlowService()
+        result = drone.land_drone(deadline=Deadline(5))
+        self.assertFalse(result["success"])
+        self.assertTrue(result["timed_out"])
+        # A passed deadline fails without calling the drone
+        result = drone.fly_home(deadline=Deadline(0))
+        self.assertTrue(result["timed_out"])
+        self.assertEqual(drone.service_timeouts["isaacs_server/fake_drone_control"], 2)
+
+
+class TestWaypoints(unittest.TestCase):
+
+    mission = [navsatfix(-35.362881, 149.165222, 0), navsatfix(-35.362881, 149.163501, 40)]
+
+    def test_invalid_indices(self):
+        mission = self.mission + [navsatfix(91, 0, 10), navsatfix(0, -181, 10),
+                navsatfix(0, 0, 501), navsatfix(0, 0, float("nan"))]
+        array = waypoint_arrays.to_array(mission)
+        self.assertEqual(waypoint_arrays.invalid_indices(array).tolist(), [2, 3, 4, 5])
+        self.assertEqual(waypoint_arrays.invalid_indices(mission).tolist(), [2, 3, 4, 5])
+
+    def test_mavros_matches_single_conversion(self):
+        drone = MavrosDrone("waypoints_mavros", "Mavros", None, 1)
+        array = waypoint_arrays.to_array(self.mission)
+        expected = [drone.convert_navsatfix_mavroswaypoint(wp) for wp in self.mission]
+        self.assertEqual(drone.convert_waypoints(array), expected)
+        self.assertEqual(drone.convert_waypoints(self.mission), expected)
+
+    def test_simplify(self):
+        # ~1 km east along a parallel with 1e-7 degree (~1 cm) jitter, then a turn north
+        mission = [navsatfix(-35.36 + (i % 2) * 1e-7, 149.16 + i * 1e-3, 20) for i in range(11)]
+        mission += [navsatfix(-35.36 + i * 1e-3, 149.17, 20) for i in range(1, 6)]
+        array = waypoint_arrays.to_array(mission)
+        self.assertEqual(waypoint_arrays.simplify(array, 1).tolist(), [0, 10, 15])
+        self.assertEqual(len(waypoint_arrays.simplify(array, 0)), len(mission))
+
+    def test_simplify_keeps_altitude_changes(self):
+        mission = [navsatfix(-35.36, 149.16, 20), navsatfix(-35.36, 149.161, 40), navsatfix(-35.36, 149.162, 20)]
+        array = waypoint_arrays.to_array(mission)
+        self.assertEqual(waypoint_arrays.simplify(array, 5).tolist(), [0, 1, 2])
+        self.assertEqual(waypoint_arrays.simplify(array, 25).tolist(), [0, 2])
+
+    def test_split_mission(self):
+        drone = DjiMatriceDrone("segments_dji", "DjiMatrice", None, 1)
+        mission = [navsatfix(-35.36, 149.16 + i * 1e-4, 20) for i in range(250)]
+        segments = drone.split_mission(mission)
+        self.assertEqual([len(s) for s in segments], [99, 99, 54])
+        # Consecutive segments share their boundary waypoint
+        self.assertIs(segments[0][-1], segments[1][0])
+        self.assertIs(segments[-1][-1], mission[-1])
+        self.assertEqual(len(drone.split_mission(mission[:99])), 1)
+        self.assertEqual(len(MavrosDrone("segments_mavros", "Mavros", None, 2).split_mission(mission)), 1)
+
+    def test_plan_mission_update(self):
+        drone = MavrosDrone("update_mavros", "Mavros", None, 1)
+        drone.waypoints = [navsatfix(-35.36, 149.16 + i * 1e-4, 20) for i in range(10)]
+        replanned = [navsatfix(-35.36, 149.16 + i * 1e-4, 20) for i in range(10)]
+        action, changed = drone.plan_mission_update(replanned)
+        self.assertEqual(action, Drone.UpdateMissionAction.CONTINUE_MISSION)
+        replanned[4] = navsatfix(-35.361, 149.1604, 25)
+        replanned[6] = navsatfix(-35.361, 149.1606, 25)
+        action, changed = drone.plan_mission_update(replanned)
+        self.assertEqual(action, Drone.UpdateMissionAction.UPDATE_CURRENT_MISSION)
+        self.assertEqual(changed.tolist(), [4, 6])
+        action, changed = drone.plan_mission_update(replanned[:5])
+        self.assertIsNone(changed)
+        action, changed = drone.plan_mission_update([])
+        self.assertEqual(action, Drone.UpdateMissionAction.END_AND_HOVER)
+
+    def test_refused_upload(self):
+        drone = DjiMatriceDrone("refused_dji", "DjiMatrice", None, 1)
+        class RefusingUpload:
+            name = "isaacs_server/fake_mission_waypoint_upload"
+            def call(self, request, timeout=None):
+                return {"result": False, "cmd_set": 0, "cmd_id": 0, "ack_data": 0}
+        drone.service_proxy = lambda name, service_type, priority=False: RefusingUpload()
+        result = drone.upload_mission(self.mission)
+        self.assertFalse(result["success"])
+        self.assertEqual(result["message"], "Drone refused the mission upload")
+        self.assertEqual(drone.waypoints, [])
+
+    def test_mavros_end_and_hover(self):
+        drone = MavrosDrone("hover_mavros", "Mavros", None, 1)
+        drone.waypoints = list(self.mission)
+        requests = []
+        class FakeClear:
+            name = "/hover_mavros/mavros/mission/clear"
+            def call(self, request, timeout=None):
+                requests.append(request)
+                return {"success": True}
+        drone.service_proxy = lambda name, service_type: FakeClear()
+        result = drone.update_mission([])
+        self.assertTrue(result["success"])
+        self.assertEqual(result["update_action"], Drone.UpdateMissionAction.END_AND_HOVER)
+        self.assertEqual(len(requests), 1)
+        self.assertEqual(drone.waypoints, [])
+
+    def test_mission_forgotten_after_stop(self):
+        drone = DjiMatriceDrone("forget_dji", "DjiMatrice", None, 1)
+        calls = []
+        class FakeService:
+            def __init__(self, name):
+                self.name = name
+            def call(self, request, timeout=None):
+                calls.append(self.name)
+                return {"result": True, "cmd_set": 0, "cmd_id": 0, "ack_data": 0}
+        drone.service_proxy = lambda name, service_type, priority=False: FakeService(name)
+        self.assertTrue(drone.update_mission(self.mission)["success"])
+        drone.mission_segments = [self.mission]
+        self.assertTrue(drone.stop_mission()["success"])
+        self.assertEqual((drone.waypoints, drone.mission_segments), ([], []))
+        # The same mission is uploaded again rather than skipped
+        result = drone.update_mission(self.mission)
+        self.assertEqual(result["update_action"], Drone.UpdateMissionAction.UPDATE_CURRENT_MISSION)
+        self.assertEqual(calls.count("isaacs_server/fake_mission_waypoint_upload"), 2)
+        self.assertTrue(drone.land_drone()["success"])
+        self.assertEqual(drone.waypoints, [])
+
+    def test_next_segment_is_tracked(self):
+        drone = MavrosDrone("segment_mavros", "Mavros", None, 1)
+        mission = [navsatfix(-35.36, 149.16 + i * 1e-4, 20) for i in range(6)]
+        segments = [mission[:3], mission[2:]]
+        drone.waypoints = segments[0]
+        drone.mission_segments = segments[1:]
+        class FakeService:
+            name = "fake"
+            def call(self, request, timeout=None):
+                return {"success": True, "mode_sent": True, "wp_transfered": 3}
+        drone.service_proxy = lambda name, service_type: FakeService()
+        self.assertTrue(drone.start_next_segment()["success"])
+        self.assertEqual(drone.waypoints, segments[1])
+        self.assertEqual(drone.plan_mission_update(segments[0])[0],
+                Drone.UpdateMissionAction.UPDATE_CURRENT_MISSION)
+
+    def test_partial_mission_update(self):
+        drone = MavrosDrone("update_mavros", "Mavros", None, 1)
+        drone.waypoints = [navsatfix(-35.36, 149.16 + i * 1e-4, 20) for i in range(10)]
+        replanned = list(drone.waypoints)
+        replanned[4] = navsatfix(-35.361, 149.1604, 25)
+        replanned[6] = navsatfix(-35.361, 149.1606, 25)
+        requests = []
+        class FakePush:
+            name = "/update_mavros/mavros/mission/push"
+            def call(self, request, timeout=None):
+                requests.append(request)
+                return {"success": True, "wp_transfered": len(request["waypoints"])}
+        drone.service_proxy = lambda name, service_type: FakePush()
+        result = drone.update_mission(replanned)
+        self.assertTrue(result["success"])
+        self.assertEqual(requests[0]["start_index"], 4)
+        self.assertEqual(len(requests[0]["waypoints"]), 3)
+        self.assertIs(drone.waypoints, replanned)
+        # Uploading the same mission again is skipped
+        result = drone.update_mission(list(replanned))
+        self.assertEqual(result["update_action"], Drone.UpdateMissionAction.CONTINUE_MISSION)
+        self.assertEqual(len(requests), 1)
+
+    def test_packed_round_trip(self):
+        array = waypoint_arrays.to_array(self.mission)
+        packed = waypoint_arrays.to_packed(array)
+        self.assertEqual(packed, [-35.362881, 149.165222, 0, -35.362881, 149.163501, 40])
+        self.assertTrue(np.array_equal(waypoint_arrays.from_packed(packed), array))
+        self.assertRaises(ValueError, waypoint_arrays.from_packed, packed[:-1])
+
+    def test_to_array_matches_fields_by_name(self):
+        reordered = np.array([(40.0, 149.0, -35.0)],
+                dtype=[('altitude', 'f4'), ('longitude', 'f8'), ('latitude', 'f8')])
+        array = waypoint_arrays.to_array(reordered)
+        self.assertEqual(array[0]['latitude'], -35.0)
+        self.assertEqual(array[0]['altitude'], 40.0)
+
+
+class TestTelemetry(unittest.TestCase):
+
+    def test_ring_buffer_wraps(self):
+        buffer = RingBuffer(4, POSITION_DTYPE)
+        self.assertIsNone(buffer.latest())
+        for i in range(6):
+            buffer.append((i, i, i, i))
+        self.assertEqual(len(buffer), 4)
+        self.assertEqual(buffer.latest()["stamp"], 5)
+        self.assertEqual(buffer.last(3)["stamp"].tolist(), [3, 4, 5])
+        self.assertEqual(buffer.last(10)["stamp"].tolist(), [2, 3, 4, 5])
+        self.assertEqual(len(buffer.last(0)), 0)
+
+    def test_mavros_state_updates_drone(self):
+        drone = MavrosDrone("telemetry_mavros", "Mavros", None, 1)
+        self.assertEqual(drone.telemetry_kind("/drone_1/mavros/global_position/global", "sensor_msgs/NavSatFix"), "position")
+        self.assertIsNone(drone.telemetry_kind("/drone_1/mavros/global_position/raw/fix", "sensor_msgs/NavSatFix"))
+        telemetry = DroneTelemetry(drone, 8)
+        telemetry.received_position(navsatfix(-35.36, 149.16, 20))
+        telemetry.received_state({"connected": True, "armed": True, "guided": True, "mode": "RTL"})
+        self.assertEqual(drone.position["latitude"], -35.36)
+        self.assertEqual(drone.flight_status, Drone.Flight_Status.FLYING_HOME)
+        self.assertEqual(telemetry.statuses.latest()["flight_status"], Drone.Flight_Status.FLYING_HOME)
+        telemetry.received_state({"connected": True, "armed": False, "guided": False, "mode": "RTL"})
+        self.assertEqual(drone.flight_status, Drone.Flight_Status.ON_GROUND_STANDBY)
+
+
+class TestFleetState(unittest.TestCase):
+
+    class FakeTelemetry:
+        def __init__(self):
+            self.positions = dict()
+
+        def latest_positions(self):
+            return dict(self.positions)
+
+    def test_change_suppression(self):
+        telemetry = self.FakeTelemetry()
+        drones = {1: MavrosDrone("fleet_mavros_1", "Mavros", None, 1),
+                  2: MavrosDrone("fleet_mavros_2", "Mavros", None, 2)}
+        telemetry.positions[1] = {"latitude": -35.36, "longitude": 149.16, "altitude": 20}
+        publisher = FleetStatePublisher(None, telemetry, lambda: drones, rate=10,
+                keyframe_interval=5, position_tolerance=0.5)
+
+        message = publisher.sample(now=0)
+        self.assertTrue(message["keyframe"])
+        self.assertEqual(len(message["drones"]), 2)
+        # Nothing changed
+        self.assertIsNone(publisher.sample(now=0.1))
+        # Moving ~0.1 m stays below the tolerance
+        telemetry.positions[1] = {"latitude": -35.360001, "longitude": 149.16, "altitude": 20}
+        self.assertIsNone(publisher.sample(now=0.2))
+        # Only the changed field of the changed drone is flagged
+        drones[2].flight_status = Drone.Flight_Status.FLYING
+        message = publisher.sample(now=0.3)
+        self.assertEqual([(d["id"], d["changed"]) for d in message["drones"]], [(2, FLIGHT_STATUS)])
+        telemetry.positions[1] = {"latitude": -35.36001, "longitude": 149.16, "altitude": 20}
+        message = publisher.sample(now=0.4)
+        self.assertEqual([(d["id"], d["changed"]) for d in message["drones"]], [(1, POSITION)])
+        del drones[2]
+        message = publisher.sample(now=0.5)
+        self.assertEqual(message["removed"], [2])
+        message = publisher.sample(now=5.1)
+        self.assertTrue(message["keyframe"])
+        self.assertEqual(message["seq"], 5)
+
+
+class TestConnectionManager(unittest.TestCase):
+
+    class FakeRos:
+        class Factory:
+            initialDelay = delay = 1.0
+            maxDelay = 3600
+            maxRetries = None
+
+        def __init__(self):
+            self.factory = self.Factory()
+            self.handlers = dict()
+
+        def on(self, event, callback):
+            self.handlers.setdefault(event, []).append(callback)
+
+        def emit(self, event):
+            for callback in self.handlers.get(event, []):
+                callback(None)
+
+        def call_in_thread(self, callback):
+            callback()
+
+    def test_reconnect(self):
+        ros = self.FakeRos()
+        manager = ConnectionManager(ros, initial_delay=0.5, max_delay=10)
+        self.assertEqual((ros.factory.delay, ros.factory.maxDelay), (0.5, 10))
+        self.assertEqual(self.FakeRos.Factory.maxDelay, 3600)
+        reconnects = []
+        manager.on_reconnect(lambda: reconnects.append(True))
+        ros.emit('ready')
+        self.assertTrue(manager.is_connected)
+        self.assertEqual(reconnects, [])
+        ros.emit('close')
+        self.assertFalse(manager.is_connected)
+        ros.emit('close')
+        self.assertEqual(manager.state()["disconnects"], 1)
+        ros.emit('ready')
+        self.assertEqual(reconnects, [True])
+        self.assertIsNotNone(manager.last_downtime)
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def test_assign_least_loaded(self):
+        default = object()
+        self.assertIs(ConnectionPool(default, 'localhost', 9090).assign(), default)
+        pool = ConnectionPool(default, 'localhost', 9090, size=2)
+        first, second, third = pool.assign(), pool.assign(), pool.assign()
+        self.assertIsNot(first, second)
+        self.assertIs(third, first)
+        pool.release(second)
+        pool.release(first)
+        self.assertIs(pool.assign(), second)
+        self.assertEqual([c["drones"] for c in pool.state()], [1, 1])
+        self.assertIsNone(pool.priority)
+
+    def test_priority_proxy(self):
+        main = roslibpy.Ros(host='localhost', port=9090)
+        priority = roslibpy.Ros(host='localhost', port=9090)
+        drone = Drone.create("pool_mavros", "Mavros", main, 1, priority_connection=priority)
+        land = drone.service_proxy("/mavros/cmd/land", "mavros_msgs/CommandTOL", priority=True)
+        mission = drone.service_proxy("/mavros/mission/push", "mavros_msgs/WaypointPush")
+        self.assertIs(land.ros, priority)
+        self.assertIs(mission.ros, main)
+        drone.priority_connection = None
+        drone.clear_service_proxies()
+        land = drone.service_proxy("/mavros/cmd/land", "mavros_msgs/CommandTOL", priority=True)
+        self.assertIs(land.ros, main)
+
+
+class TestServerLog(unittest.TestCase):
+
+    def tearDown(self):
+        logger = logging.getLogger(server_log.LOGGER_NAME)
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+            handler.close()
+        logger.propagate = True
+
+    def test_summary_is_truncated(self):
+        drones = {i: "drone_%d" % i for i in range(10000)}
+        text = str(server_log.summarize(drones))
+        self.assertLessEqual(len(text), server_log.SUMMARY_LIMIT)
+        self.assertIn("drone_0", text)
+        self.assertEqual(str(server_log.summarize(list(range(100000)), limit=20))[-3:], "...")
+
+    def test_lazy_and_background(self):
+        formatted = []
+        class Payload:
+            def __repr__(self):
+                formatted.append(True)
+                return "payload"
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "server.log")
+            listener = server_log.configure("INFO", path)
+            logger = server_log.get_logger("test")
+            logger.debug("Skipped %s", server_log.summarize(Payload()))
+            logger.info("Logged %s", server_log.summarize(Payload()))
+            listener.stop()
+            with open(path) as log:
+                lines = log.read().splitlines()
+        self.assertEqual(formatted, [True])
+        self.assertEqual(len(lines), 1)
+        self.assertTrue(lines[0].endswith("INFO isaacs_server.test: Logged payload"))
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_percentiles(self):
+        histogram = metrics.Histogram()
+        for i in range(1, 101):
+            histogram.observe(i / 1000)
+        self.assertEqual(histogram.count, 100)
+        self.assertEqual(histogram.max, 0.1)
+        self.assertLessEqual(histogram.percentile(50), 0.05)
+        self.assertGreater(histogram.percentile(50), 0.025)
+        self.assertGreater(histogram.percentile(99), 0.05)
+        self.assertLessEqual(histogram.percentile(100), histogram.max)
+        self.assertEqual(metrics.Histogram().percentile(50), 0.0)
+
+    def test_outcomes(self):
+        registry = metrics.Metrics()
+        registry.observe_endpoint("service", "query_topics", 0.002)
+        registry.observe_endpoint("service", "query_topics", 0.004, metrics.outcome(False))
+        registry.observe_drone_call("Mavros", "mavros/cmd/arming", 12, metrics.outcome(False, True))
+        endpoints = registry.endpoints()
+        self.assertEqual(len(endpoints), 2)
+        drone_call, service = endpoints
+        self.assertEqual(drone_call["labels"], {"backend": "Mavros", "service": "mavros/cmd/arming"})
+        self.assertEqual((drone_call["calls"], drone_call["errors"], drone_call["timeouts"]), (1, 0, 1))
+        self.assertEqual((service["calls"], service["errors"], service["timeouts"]), (2, 1, 0))
+        self.assertAlmostEqual(service["mean"], 0.003)
+
+    def test_prometheus(self):
+        registry = metrics.Metrics()
+        registry.observe_endpoint("service", "a", 0.002)
+        registry.observe_endpoint("action", "b", 3)
+        registry.add_gauges("executor", lambda: {"queued": 2, "waits": {"EMERGENCY": {"p50": 0.5}}})
+        registry.add_gauges("broken", lambda: 1 / 0)
+        self.assertEqual(registry.gauges(), {"executor_queued": 2.0, "executor_waits_emergency_p50": 0.5})
+        lines = registry.prometheus().splitlines()
+        # Every sample follows the TYPE line of its own family
+        families = [line.split()[2] for line in lines if line.startswith("# TYPE")]
+        self.assertEqual(len(families), len(set(families)))
+        family = None
+        for line in lines:
+            if line.startswith("# TYPE"):
+                family = line.split()[2]
+            else:
+                self.assertTrue(line.startswith(family), line)
+        self.assertIn('isaacs_server_request_seconds_bucket{kind="action",endpoint="b",le="+Inf"} 1', lines)
+        self.assertIn('isaacs_server_request_seconds_count{kind="service",endpoint="a"} 1', lines)
+        self.assertIn("isaacs_server_executor_queued 2.0", lines)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "metrics.prom")
+            registry.write_prometheus(path)
+            with open(path) as f:
+                self.assertEqual(f.read().splitlines(), lines)
+
+
+class TestProfiler(unittest.TestCase):
+
+    def busy(self, seconds):
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            sum(range(100))
+
+    def test_sample(self):
+        with tempfile.TemporaryDirectory() as directory:
+            profiler = Profiler(directory)
+            profiler.start(SAMPLE, interval=0.001)
+            self.assertRaises(RuntimeError, profiler.start)
+            worker = threading.Thread(target=self.busy, args=(0.2,), name="busy_worker")
+            worker.start()
+            worker.join()
+            files = profiler.stop()
+            self.assertFalse(profiler.active)
+            self.assertRaises(RuntimeError, profiler.stop)
+            self.assertEqual([os.path.splitext(f)[1] for f in files], [".folded", ".txt"])
+            with open(files[0]) as f:
+                stacks = f.read()
+            self.assertIn("busy_worker;", stacks)
+            self.assertIn("busy (test.py", profiler.last_summary)
+
+    def test_cprofile_and_trace(self):
+        with tempfile.TemporaryDirectory() as directory:
+            profiler = Profiler(directory)
+            self.assertRaises(ValueError, profiler.start, "perf")
+            profiler.start(CPROFILE, trace=True)
+            threads = [threading.Thread(target=profiler.call, args=(self.busy, 0.05)) for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            start = time.perf_counter()
+            self.assertEqual(profiler.call(lambda x: x + 1, 1), 2)
+            profiler.span("service", "query_topics", start, 0.001)
+            self.assertEqual(profiler.state()["spans"], 1)
+            files = profiler.stop()
+            self.assertEqual([f.split(".", 1)[1] for f in files], ["pstats", "trace.json", "txt"])
+            self.assertIn("busy", profiler.last_summary)
+            with open(files[1]) as f:
+                events = json.load(f)["traceEvents"]
+            self.assertEqual(events[0]["name"], "query_topics")
+            self.assertEqual(events[0]["dur"], 1000)
+            # Spans are not kept without a tracing session
+            profiler.span("service", "query_topics", start, 0.001)
+            self.assertEqual(profiler.state()["spans"], 0)
+
+    def test_stop_from_profiled_call(self):
+        with tempfile.TemporaryDirectory() as directory:
+            profiler = Profiler(directory)
+            profiler.start(CPROFILE)
+            for _ in range(3):
+                profiler.call(self.busy, 0.01)
+            start = time.perf_counter()
+            files = profiler.call(profiler.stop)
+            self.assertLess(time.perf_counter() - start, 1)
+            self.assertNotIn("left out", profiler.last_summary)
+            self.assertIn("busy", profiler.last_summary)
+            stats = pstats.Stats(files[0])
+            self.assertTrue(any(name == "busy" for _, _, name in stats.stats))
+
+    class ExclusiveProfile(cProfile.Profile):
+        # Only one enabled at a time, like cProfile on sys.monitoring (Python 3.12+)
+        lock = threading.Lock()
+        active = None
+
+        def enable(self):
+            cls = TestProfiler.ExclusiveProfile
+            with cls.lock:
+                if cls.active not in (None, self):
+                    raise ValueError("Another profiling tool is already active")
+                cls.active = self
+            super().enable()
+
+        def disable(self):
+            super().disable()
+            cls = TestProfiler.ExclusiveProfile
+            with cls.lock:
+                if cls.active is self:
+                    cls.active = None
+
+    def concurrent_calls(self, profiler):
+        # Two profiled calls that are both running before either returns
+        barrier = threading.Barrier(2, timeout=5)
+        def call():
+            barrier.wait()
+            self.busy(0.02)
+            return True
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(profiler.call(call))) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_profiled_calls(self):
+        for profile_class in (cProfile.Profile, self.ExclusiveProfile):
+            with tempfile.TemporaryDirectory() as directory, mock.patch('cProfile.Profile', profile_class):
+                profiler = Profiler(directory)
+                profiler.start(CPROFILE)
+                self.assertEqual(self.concurrent_calls(profiler), [True, True])
+                profiler.stop()
+                self.assertIn("busy", profiler.last_summary)
+                if profile_class is self.ExclusiveProfile:
+                    self.assertIn("1 calls ran while another was profiled", profiler.last_summary)
+                else:
+                    self.assertNotIn("while another was profiled", profiler.last_summary)
+
+    def test_duration(self):
+        with tempfile.TemporaryDirectory() as directory:
+            profiler = Profiler(directory)
+            profiler.start(SAMPLE, duration=0.05)
+            time.sleep(0.5)
+            self.assertFalse(profiler.active)
+            self.assertEqual(len(os.listdir(directory)), 2)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,184 @@
+import threading
+from bisect import bisect_left, insort
+from change_log import ChangeLog
+
+class TopicIndex:
+    '''
+    Index of the topics published by registered drones and sensors.
+
+    Maps each topic name to its (type, owner id), and each owner id to the
+    names of the topics it publishes, so topics can be added, removed and
+    looked up per owner without scanning every topic. Every change is
+    recorded in the change log for the topics_changed_since service.
+
+    The names are also kept sorted and grouped by type, so find() can serve
+    namespace prefix and message type queries with work proportional to the
+    number of matches.
+    '''
+
+    def __init__(self):
+        self.changes = ChangeLog()
+        self._topics = dict() # Map between topic names and (type, owner id)
+        self._owners = dict() # Map between owner ids and {topic name: None}
+        self._types = dict() # Map between topic types and {topic name: None}
+        self._sorted_names = [] # Every topic name, in sorted order
+        self._lock = threading.Lock()
+
+    def add(self, owner_id, name, topic_type):
+        '''
+        Adds or updates a topic. A topic that was published by another owner
+        before is moved to the new one.
+
+        :param owner_id: id of the drone or sensor publishing the topic
+        :param name: topic name
+        :param topic_type: message type of the topic
+        returns: id of the owner the topic was moved from, or None if it had
+        no other owner
+        '''
+        with self._lock:
+            previous = self._topics.get(name)
+            if previous == (topic_type, owner_id):
+                return None
+            if previous is None:
+                insort(self._sorted_names, name)
+            else:
+                self._unlink(self._owners, previous[1], name)
+                self._unlink(self._types, previous[0], name)
+            self._topics[name] = (topic_type, owner_id)
+            self._owners.setdefault(owner_id, dict())[name] = None
+            self._types.setdefault(topic_type, dict())[name] = None
+            self.changes.record(name)
+            if previous is not None and previous[1] != owner_id:
+                return previous[1]
+            return None
+
+    def remove(self, name):
+        with self._lock:
+            self._remove(name)
+
+    def remove_owner(self, owner_id):
+        '''
+        Removes every topic of a drone or sensor.
+
+        returns: list of the removed topic names
+        '''
+        with self._lock:
+            names = list(self._owners.get(owner_id, ()))
+            for name in names:
+                self._remove(name)
+            return names
+
+    def clear(self):
+        with self._lock:
+            for name in list(self._topics):
+                self._remove(name)
+
+    def topics_of(self, *owner_ids):
+        '''
+        returns: list of {name, type} dicts of the topics published by the
+        given owners, in the order they were added.
+        '''
+        with self._lock:
+            return [{"name": name, "type": self._topics[name][0]}
+                    for owner_id in owner_ids
+                    for name in self._owners.get(owner_id, ())]
+
+    def all_topics(self):
+        '''
+        returns: list of {name, type} dicts of every topic.
+        '''
+        with self._lock:
+            return [{"name": name, "type": entry[0]}
+                    for name, entry in self._topics.items()]
+
+    def find(self, prefix="", topic_type=""):
+        '''
+        Finds the topics whose name starts with prefix and whose type is
+        topic_type. An empty prefix or type matches every topic.
+
+        returns: list of {name, type} dicts, sorted by name.
+        '''
+        with self._lock:
+            if prefix:
+                lo = bisect_left(self._sorted_names, prefix)
+                # Smallest string greater than every name starting with prefix
+                end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+                hi = bisect_left(self._sorted_names, end, lo)
+            if topic_type:
+                typed = self._types.get(topic_type, ())
+                if not prefix or len(typed) < hi - lo:
+                    names = sorted(n for n in typed if n.startswith(prefix))
+                    return [{"name": n, "type": topic_type} for n in names]
+            if prefix:
+                names = self._sorted_names[lo:hi]
+            else:
+                names = self._sorted_names
+            return [{"name": n, "type": self._topics[n][0]} for n in names
+                    if not topic_type or self._topics[n][0] == topic_type]
+
+    def get(self, name):
+        '''
+        returns: (type, owner id) of the topic, or None if it is unknown.
+        '''
+        return self._topics.get(name)
+
+    def changes_since(self, since_version):
+        '''
+        Returns what changed after the version a client last saw.
+
+        :param since_version: version from an earlier response
+        returns: (version, full, updated, removed) where updated is a list of
+        {name, type} dicts of added or changed topics and removed is a list
+        of names of topics that are gone. If the change log does not reach
+        back to since_version, full is True and updated holds every topic.
+        '''
+        with self._lock:
+            changed = self.changes.changed_since(since_version)
+            if changed is None:
+                updated = [{"name": name, "type": entry[0]}
+                        for name, entry in self._topics.items()]
+                return self.changes.version, True, updated, []
+            updated = [{"name": name, "type": self._topics[name][0]}
+                    for name in changed if name in self._topics]
+            removed = [name for name in changed if name not in self._topics]
+            return self.changes.version, False, updated, removed
+
+    def _remove(self, name):
+        entry = self._topics.pop(name, None)
+        if entry is None:
+            return
+        del self._sorted_names[bisect_left(self._sorted_names, name)]
+        self._unlink(self._types, entry[0], name)
+        self._unlink(self._owners, entry[1], name)
+        self.changes.record(name)
+
+    @staticmethod
+    def _unlink(groups, key, name):
+        group = groups.get(key)
+        if group is not None:
+            group.pop(name, None)
+            if not group:
+                del groups[key]
+
+    def __contains__(self, name):
+        return name in self._topics
+
+    def __len__(self):
+        return len(self._topics)
+
+
+def pack_topics(topics):
+    '''
+    Packs a topic listing into parallel arrays, sending every type name once.
+
+    :param topics: list of {name, type} dicts
+    returns: (names, types, type_indices) where names[i] has the type
+    types[type_indices[i]]
+    '''
+    type_ids = dict()
+    names = []
+    type_indices = []
+    for topic in topics:
+        names.append(topic["name"])
+        type_indices.append(type_ids.setdefault(topic["type"], len(type_ids)))
+    return names, list(type_ids), type_indices
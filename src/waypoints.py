@@ -0,0 +1,214 @@
+'''
+Batched waypoint conversion.
+
+Missions arrive as lists of sensor_msgs/NavSatFix dicts, or as NumPy
+structured arrays once the server has packed them. The drivers read the
+coordinates out once as columns of floats, validate every waypoint at once,
+and then emit the vendor payloads in a single pass. A list is never packed
+into an array just to be converted, as that costs as much as the conversion.
+'''
+
+import numpy as np
+
+WAYPOINT_DTYPE = np.dtype([
+    ('latitude', np.float64),
+    ('longitude', np.float64),
+    ('altitude', np.float64)
+])
+
+# Altitude range in meters accepted for a waypoint (DJI SDK mission limits)
+MIN_ALTITUDE = -200
+MAX_ALTITUDE = 500
+
+
+def to_array(waypoints):
+    '''
+    Packs waypoints into a structured array of WAYPOINT_DTYPE.
+
+    :param waypoints: list of NavSatFix dicts, or an array that already has
+        latitude, longitude and altitude fields
+    returns: numpy structured array
+    '''
+    if isinstance(waypoints, np.ndarray):
+        if waypoints.dtype == WAYPOINT_DTYPE:
+            return waypoints
+        # Copy field by field; astype would match fields by position
+        array = np.empty(len(waypoints), dtype=WAYPOINT_DTYPE)
+        for field in WAYPOINT_DTYPE.names:
+            array[field] = waypoints[field]
+        return array
+    return np.fromiter(
+        ((wp["latitude"], wp["longitude"], wp["altitude"]) for wp in waypoints),
+        dtype=WAYPOINT_DTYPE, count=len(waypoints))
+
+
+def columns(waypoints):
+    '''
+    Reads the coordinates out of waypoints.
+
+    :param waypoints: list of NavSatFix dicts, an array with latitude,
+        longitude and altitude fields, or columns this function returned
+    returns: tuple of (latitudes, longitudes, altitudes), the fields of an
+    array as they are and lists of floats otherwise
+    '''
+    if isinstance(waypoints, tuple):
+        return waypoints
+    if isinstance(waypoints, np.ndarray):
+        return waypoints['latitude'], waypoints['longitude'], waypoints['altitude']
+    return ([wp["latitude"] for wp in waypoints], [wp["longitude"] for wp in waypoints],
+            [wp["altitude"] for wp in waypoints])
+
+
+def invalid_indices(waypoints):
+    '''
+    :param waypoints: anything columns() takes
+    returns: array of the indices of waypoints whose latitude, longitude or
+    altitude is out of range or not a finite number
+    '''
+    lat, lon, alt = (np.asarray(c, dtype=np.float64) for c in columns(waypoints))
+    # NaN fails every comparison, so it is caught by the range checks
+    valid = ((lat >= -90) & (lat <= 90)
+             & (lon >= -180) & (lon <= 180)
+             & (alt >= MIN_ALTITUDE) & (alt <= MAX_ALTITUDE))
+    return np.flatnonzero(~valid)
+
+
+def emit(waypoints, template, latitude_key, longitude_key, altitude_key):
+    '''
+    Builds one payload dict per waypoint from a template of the fields that
+    are the same for every waypoint.
+
+    :param waypoints: anything columns() takes
+    :param template: dict of the constant fields
+    :param latitude_key: payload key of the latitude, e.g. "x_lat"
+    :param longitude_key: payload key of the longitude
+    :param altitude_key: payload key of the altitude
+    returns: list of dicts
+    '''
+    # tolist() converts whole array fields to Python floats at once, which
+    # is also what the JSON encoder needs
+    lats, lons, alts = (c.tolist() if isinstance(c, np.ndarray) else c
+                        for c in columns(waypoints))
+    payloads = []
+    append = payloads.append
+    copy = template.copy
+    for lat, lon, alt in zip(lats, lons, alts):
+        payload = copy()
+        payload[latitude_key] = lat
+        payload[longitude_key] = lon
+        payload[altitude_key] = alt
+        append(payload)
+    return payloads
+
+
+# Mean radius of the earth in meters
+EARTH_RADIUS = 6371008.8
+
+
+def to_local_meters(array):
+    '''
+    Projects waypoints onto a local east/north/up frame in meters, centered
+    on the mission (equirectangular approximation, accurate to well under a
+    percent over the few kilometers a mission spans).
+
+    :param array: structured array of WAYPOINT_DTYPE
+    returns: (n, 3) float array of x (east), y (north), z (altitude)
+    '''
+    lat = np.radians(array['latitude'])
+    lat0 = lat.mean()
+    lon0 = array['longitude'][0]
+    # Wrap so missions crossing the antimeridian stay contiguous
+    dlon = (array['longitude'] - lon0 + 180) % 360 - 180
+    points = np.empty((len(array), 3))
+    points[:, 0] = np.radians(dlon) * EARTH_RADIUS * np.cos(lat0)
+    points[:, 1] = (lat - lat0) * EARTH_RADIUS
+    points[:, 2] = array['altitude']
+    return points
+
+
+def _distances_to_segment(points, start, end):
+    # Distance of every point to the segment from start to end
+    direction = end - start
+    length_squared = direction.dot(direction)
+    if length_squared == 0:
+        return np.linalg.norm(points - start, axis=1)
+    t = np.clip((points - start).dot(direction) / length_squared, 0, 1)
+    return np.linalg.norm(points - (start + t[:, None] * direction), axis=1)
+
+
+def simplify(array, tolerance):
+    '''
+    Simplifies a mission with the Ramer-Douglas-Peucker algorithm. Waypoints
+    are dropped as long as the path stays within tolerance meters of every
+    original waypoint, in all three dimensions. The first and last waypoints
+    are always kept.
+
+    :param array: structured array of WAYPOINT_DTYPE
+    :param tolerance: maximum deviation in meters; 0 keeps every waypoint
+    returns: sorted array of the indices of the waypoints to keep
+    '''
+    count = len(array)
+    if count < 3 or tolerance <= 0:
+        return np.arange(count)
+    points = to_local_meters(array)
+    keep = np.zeros(count, dtype=bool)
+    keep[0] = keep[-1] = True
+    # Iterative rather than recursive, so long paths cannot hit the recursion limit
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        distances = _distances_to_segment(points[first + 1:last], points[first], points[last])
+        farthest = int(distances.argmax())
+        if distances[farthest] > tolerance:
+            index = first + 1 + farthest
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return np.flatnonzero(keep)
+
+
+def changed_indices(old, new):
+    '''
+    Compares two missions waypoint by waypoint.
+
+    :param old: structured array of WAYPOINT_DTYPE
+    :param new: structured array of WAYPOINT_DTYPE
+    returns: sorted array of the indices of waypoints that differ, or None if
+    the missions have different lengths
+    '''
+    if len(old) != len(new):
+        return None
+    changed = ((old['latitude'] != new['latitude'])
+               | (old['longitude'] != new['longitude'])
+               | (old['altitude'] != new['altitude']))
+    return np.flatnonzero(changed)
+
+
+def from_packed(values):
+    '''
+    Unpacks waypoints sent as a flat list of latitude, longitude, altitude
+    triples, the compact alternative to a list of NavSatFix messages.
+
+    :param values: sequence of floats whose length is a multiple of 3
+    returns: structured array of WAYPOINT_DTYPE
+    '''
+    flat = np.asarray(values, dtype=np.float64)
+    if flat.size % 3:
+        raise ValueError(f"packed waypoints hold {flat.size} values, not a multiple of 3")
+    array = np.empty(flat.size // 3, dtype=WAYPOINT_DTYPE)
+    triples = flat.reshape(-1, 3)
+    array['latitude'] = triples[:, 0]
+    array['longitude'] = triples[:, 1]
+    array['altitude'] = triples[:, 2]
+    return array
+
+
+def to_packed(array):
+    '''
+    :param array: structured array of WAYPOINT_DTYPE
+    returns: list of floats of latitude, longitude, altitude triples
+    '''
+    return np.column_stack((array['latitude'], array['longitude'],
+                            array['altitude'])).ravel().tolist()